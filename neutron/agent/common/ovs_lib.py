@@ -407,6 +407,38 @@ class OVSBridge(BaseOVS):
                           port_name)
         return ofport
 
+    @_ovsdb_retry
+    def _get_ports_ofport(self, port_names):
+        ifaces = self.ovsdb.db_list(
+            'Interface', port_names, columns=['name', 'ofport'],
+            if_exists=True).execute(check_error=True)
+        ofports = {iface['name']: iface['ofport'] for iface in ifaces}
+        if (len(ofports) < len(port_names) or
+                any(_ovsdb_result_pending(ofport)
+                    for ofport in ofports.values())):
+            # Retry until every port has been assigned an ofport
+            return []
+        return ofports
+
+    def get_ports_ofport(self, port_names):
+        """Get the assigned ofport of several ports in a single request.
+
+        Retry until an ofport is assigned to every port; the ports still
+        without ofport after ovsdb_timeout get INVALID_OFPORT.
+        """
+        try:
+            return self._get_ports_ofport(port_names)
+        except tenacity.RetryError:
+            LOG.exception("Timed out retrieving ofport on ports %s.",
+                          port_names)
+        ifaces = self.ovsdb.db_list(
+            'Interface', port_names, columns=['name', 'ofport'],
+            if_exists=True).execute(check_error=True)
+        ofports = dict.fromkeys(port_names, INVALID_OFPORT)
+        ofports.update({iface['name']: iface['ofport'] for iface in ifaces
+                        if not _ovsdb_result_pending(iface['ofport'])})
+        return ofports
+
     @_ovsdb_retry
     def _get_datapath_id(self):
         return self.db_get_val('Bridge', self.br_name, 'datapath_id')
@@ -505,12 +537,9 @@ class OVSBridge(BaseOVS):
     def deferred(self, *args, **kwargs):
         return DeferredOVSBridge(self, *args, **kwargs)
 
-    def add_tunnel_port(self, port_name, remote_ip, local_ip,
-                        tunnel_type=p_const.TYPE_GRE,
-                        vxlan_udp_port=p_const.VXLAN_UDP_PORT,
-                        dont_fragment=True,
-                        tunnel_csum=False,
-                        tos=None):
+    def _get_tunnel_port_attrs(self, remote_ip, local_ip, tunnel_type,
+                               vxlan_udp_port, dont_fragment, tunnel_csum,
+                               tos):
         if tunnel_type == p_const.TYPE_GRE:
             tunnel_type = get_gre_tunnel_port_type(remote_ip, local_ip)
         attrs = [('type', tunnel_type)]
@@ -541,9 +570,39 @@ class OVSBridge(BaseOVS):
             # over IPv6 are not supported.
             options['packet_type'] = 'legacy_l2'
         attrs.append(('options', options))
+        return attrs
 
+    def add_tunnel_port(self, port_name, remote_ip, local_ip,
+                        tunnel_type=p_const.TYPE_GRE,
+                        vxlan_udp_port=p_const.VXLAN_UDP_PORT,
+                        dont_fragment=True,
+                        tunnel_csum=False,
+                        tos=None):
+        attrs = self._get_tunnel_port_attrs(
+            remote_ip, local_ip, tunnel_type, vxlan_udp_port, dont_fragment,
+            tunnel_csum, tos)
         return self.add_port(port_name, *attrs)
 
+    def add_tunnel_ports(self, tunnels, local_ip,
+                         tunnel_type=p_const.TYPE_GRE,
+                         vxlan_udp_port=p_const.VXLAN_UDP_PORT,
+                         dont_fragment=True,
+                         tunnel_csum=False,
+                         tos=None):
+        """Add several tunnel ports in a single OVSDB transaction.
+
+        :param tunnels: dict of remote IPs indexed by tunnel port name.
+        :returns: dict of ofports indexed by tunnel port name.
+        """
+        with self.ovsdb.transaction() as txn:
+            for port_name, remote_ip in tunnels.items():
+                txn.add(self.ovsdb.add_port(self.br_name, port_name))
+                txn.add(self.ovsdb.db_set(
+                    'Interface', port_name, *self._get_tunnel_port_attrs(
+                        remote_ip, local_ip, tunnel_type, vxlan_udp_port,
+                        dont_fragment, tunnel_csum, tos)))
+        return self.get_ports_ofport(list(tunnels))
+
     def add_patch_port(self, local_name, remote_name):
         attrs = [('type', 'patch'),
                  ('options', {'peer': remote_name})]
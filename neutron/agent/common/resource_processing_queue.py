@@ -168,6 +168,20 @@ class ResourceProcessingQueue(object):
         update.tries -= 1
         self._queue.put(update)
 
+    def empty(self):
+        return self._queue.empty()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def oldest_update_age(self):
+        """Returns the time elapsed since the oldest queued update was created
+
+        0 is returned if no update is queued.
+        """
+        return max([update.time_elapsed_since_create
+                    for update in list(self._queue.queue)], default=0)
+
     def each_update_to_next_resource(self):
         """Grabs the next resource from the queue and processes
 
@@ -52,6 +52,9 @@ DEFAULT_PRIORITY = 255
 
 DHCP_PROCESS_GREENLET_MAX = 32
 DHCP_PROCESS_GREENLET_MIN = 8
+DHCP_PROCESS_GREENLET_ADAPTIVE_MAX = 256
+DHCP_PROCESS_POOL_ADAPT_INTERVAL = 5
+DHCP_PROCESS_LATENCIES_MAX = 4096
 DELETED_PORT_MAX_AGE = 86400
 
 DHCP_READY_PORTS_SYNC_MAX = 64
@@ -147,6 +150,10 @@ class DhcpAgent(manager.Manager):
         self._pool_size = DHCP_PROCESS_GREENLET_MIN
         self._pool = eventlet.GreenPool(size=self._pool_size)
         self._queue = queue.ResourceProcessingQueue()
+        # latencies of the updates processed since the pool was last adapted
+        self._update_latencies = collections.deque(
+            maxlen=DHCP_PROCESS_LATENCIES_MAX)
+        self._updates_in_progress = set()
         self._network_bulk_allocations = {}
         # Each dhcp-agent restart should trigger a restart of all
         # metadata-proxies too. This way we can ensure that changes in
@@ -192,6 +199,8 @@ class DhcpAgent(manager.Manager):
         eventlet.spawn_n(self._process_loop)
         if self.conf.bulk_reload_interval:
             eventlet.spawn_n(self._reload_bulk_allocations)
+        if self.conf.adaptive_process_pool:
+            eventlet.spawn_n(self._adapt_process_pool)
 
     def _reload_bulk_allocations(self):
         while True:
@@ -279,10 +288,27 @@ class DhcpAgent(manager.Manager):
         known_network_ids = set(self.cache.get_network_ids())
 
         try:
-            active_networks = self.plugin_rpc.get_active_networks_info(
-                enable_dhcp_filter=False)
-            LOG.info('All active networks have been fetched through RPC.')
-            active_network_ids = set(network.id for network in active_networks)
+            if self.conf.resync_by_revision:
+                # the networks to resync are fetched whatever their revision
+                network_revisions = {
+                    network_id: utils.get_dhcp_network_revision(
+                        self.cache.get_network_by_id(network_id))
+                    for network_id in known_network_ids
+                    if network_id not in only_nets}
+                active_networks, active_network_ids = (
+                    self.plugin_rpc.get_changed_networks_info(
+                        network_revisions, enable_dhcp_filter=False))
+                LOG.info('%(changed)d changed networks of the %(total)d '
+                         'active networks have been fetched through RPC.',
+                         {'changed': len(active_networks),
+                          'total': len(active_network_ids)})
+            else:
+                active_networks = self.plugin_rpc.get_active_networks_info(
+                    enable_dhcp_filter=False)
+                LOG.info('All active networks have been fetched through '
+                         'RPC.')
+                active_network_ids = set(
+                    network.id for network in active_networks)
             for deleted_id in known_network_ids - active_network_ids:
                 try:
                     self.disable_dhcp_helper(deleted_id)
@@ -293,6 +319,7 @@ class DhcpAgent(manager.Manager):
 
             for network in active_networks:
                 if (not only_nets or  # specifically resync all
+                        self.conf.resync_by_revision or  # changed net
                         network.id not in known_network_ids or  # missing net
                         network.id in only_nets):  # specific network to sync
                     pool.spawn(self.safe_configure_dhcp_for_network, network)
@@ -579,10 +606,20 @@ class DhcpAgent(manager.Manager):
         self.refresh_dhcp_helper(network.id)
 
     @lockutils.synchronized('resize_greenpool')
-    def _resize_process_pool(self):
+    def _resize_process_pool(self, adapt=False):
         num_nets = len(self.cache.get_network_ids())
-        pool_size = max([DHCP_PROCESS_GREENLET_MIN,
-                         min([DHCP_PROCESS_GREENLET_MAX, num_nets])])
+        if not self.conf.adaptive_process_pool:
+            pool_size = max([DHCP_PROCESS_GREENLET_MIN,
+                             min([DHCP_PROCESS_GREENLET_MAX, num_nets])])
+        else:
+            pool_size = self._pool_size
+            if adapt:
+                pool_size = self._get_adaptive_pool_size()
+            # more threads than networks would only wait for the network
+            # processed by another thread
+            pool_size = max([DHCP_PROCESS_GREENLET_MIN,
+                             min([DHCP_PROCESS_GREENLET_ADAPTIVE_MAX,
+                                  num_nets, pool_size])])
         if pool_size == self._pool_size:
             return
         LOG.info("Resizing dhcp processing queue green pool size to: %d",
@@ -590,6 +627,41 @@ class DhcpAgent(manager.Manager):
         self._pool.resize(pool_size)
         self._pool_size = pool_size
 
+    def _get_adaptive_pool_size(self):
+        """Returns the pool size for the current backlog and latencies.
+
+        The latency is the 95th percentile of the latencies recorded since the
+        previous call, or the age of the oldest queued or in progress update
+        if it is higher, so that updates stuck behind slow ones are accounted
+        for before they complete. The pool is doubled when updates are
+        waiting and the latency exceeds the target, and halved when no update
+        is waiting and it is below half of it.
+        """
+        latencies = sorted(self._update_latencies)
+        self._update_latencies.clear()
+        latency = latencies[int(len(latencies) * 0.95)] if latencies else 0
+        oldest = max([self._queue.oldest_update_age()] +
+                     [update.time_elapsed_since_create
+                      for update in self._updates_in_progress])
+        backlog = self._queue.qsize()
+        target = self.conf.process_pool_target_latency
+        LOG.debug("DHCP processing queue backlog: %(backlog)d updates, 95th "
+                  "percentile latency of %(count)d updates: %(latency).3f s, "
+                  "oldest pending update: %(oldest).3f s",
+                  {'backlog': backlog, 'count': len(latencies),
+                   'latency': latency, 'oldest': oldest})
+        latency = max(latency, oldest)
+        if backlog and latency > target:
+            return self._pool_size * 2
+        if not backlog and latency < target / 2:
+            return self._pool_size // 2
+        return self._pool_size
+
+    def _adapt_process_pool(self):
+        while True:
+            eventlet.greenthread.sleep(DHCP_PROCESS_POOL_ADAPT_INTERVAL)
+            self._resize_process_pool(adapt=True)
+
     def _process_loop(self):
         LOG.debug("Starting _process_loop")
 
@@ -599,7 +671,14 @@ class DhcpAgent(manager.Manager):
     def _process_resource_update(self):
         for tmp, update in self._queue.each_update_to_next_resource():
             method = getattr(self, update.action)
-            method(update.resource)
+            self._updates_in_progress.add(update)
+            try:
+                method(update.resource)
+            finally:
+                self._updates_in_progress.discard(update)
+            if self.conf.adaptive_process_pool:
+                self._update_latencies.append(
+                    update.time_elapsed_since_create)
 
     def port_update_end(self, context, payload):
         """Handle the port.update.end notification event."""
@@ -847,6 +926,7 @@ class DhcpPluginApi(object):
         1.5 - Added dhcp_ready_on_ports
         1.7 - Added get_networks
         1.8 - Added get_dhcp_port
+        1.10 - Added get_changed_networks_info
     """
 
     def __init__(self, topic, host):
@@ -873,6 +953,22 @@ class DhcpPluginApi(object):
                               host=self.host, **kwargs)
         return [dhcp.NetModel(n) for n in networks]
 
+    def get_changed_networks_info(self, network_revisions, **kwargs):
+        """Make a remote process call to retrieve the changed networks.
+
+        :param network_revisions: The revision of each network cached, as
+                                  computed by get_dhcp_network_revision.
+        :return: A tuple of the NetModel of each network whose revision is
+                 not the one in network_revisions, and of the set of ids of
+                 all the active networks.
+        """
+        cctxt = self.client.prepare(version='1.10')
+        result = cctxt.call(self.context, 'get_changed_networks_info',
+                            host=self.host,
+                            network_revisions=network_revisions, **kwargs)
+        return ([dhcp.NetModel(n) for n in result['networks']],
+                set(result['network_ids']))
+
     def get_network_info(self, network_id):
         """Make a remote process call to retrieve network info."""
         cctxt = self.client.prepare()
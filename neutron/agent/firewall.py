@@ -143,6 +143,16 @@ class FirewallDriver(object, metaclass=abc.ABCMeta):
         """Update group members in a security group."""
         raise NotImplementedError()
 
+    def update_security_group_members_delta(self, sg_id, added, removed):
+        """Add and remove group members in a security group.
+
+        added and removed are dicts of sets of (ip, mac) tuples keyed by
+        ethertype. Return True if the driver updated the filters of the
+        ports using the group as remote group, False if these ports must be
+        refreshed.
+        """
+        return False
+
     def update_security_group_rules(self, sg_id, rules):
         """Update rules in a security group."""
         raise NotImplementedError()
@@ -196,6 +206,9 @@ class NoopFirewallDriver(FirewallDriver):
     def update_security_group_members(self, sg_id, ips):
         pass
 
+    def update_security_group_members_delta(self, sg_id, added, removed):
+        return True
+
     def update_security_group_rules(self, sg_id, rules):
         pass
 
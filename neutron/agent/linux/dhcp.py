@@ -22,7 +22,9 @@ import os
 import re
 import shutil
 import time
+import zlib
 
+from eventlet import tpool
 import netaddr
 from neutron_lib.api.definitions import extra_dhcp_opt as edo_ext
 from neutron_lib import constants
@@ -373,6 +375,15 @@ class Dnsmasq(DhcpLocalProcess):
     _IS_DHCP_RELEASE6_SUPPORTED = None
     _IS_HOST_TAG_SUPPORTED = None
 
+    # The host entries last written to the host.d and addn_hosts.d
+    # directories of each network when dnsmasq_incremental_reload is
+    # enabled, keyed by network id, then by directory kind and port id.
+    _HOSTS_DIRS_ENTRIES = {}
+
+    # The leases parsed from the hosts and leases files, keyed by file name,
+    # with the stat of the file they were parsed from.
+    _PARSED_LEASES = {}
+
     @classmethod
     def check_version(cls):
         pass
@@ -400,8 +411,18 @@ class Dnsmasq(DhcpLocalProcess):
             '--no-hosts',
             _no_resolv,
             '--pid-file=%s' % pid_file,
-            '--dhcp-hostsfile=%s' % self.get_conf_file_name('host'),
-            '--addn-hosts=%s' % self.get_conf_file_name('addn_hosts'),
+        ]
+        if self.conf.dnsmasq_incremental_reload:
+            cmd += [
+                '--dhcp-hostsdir=%s' % self.get_conf_file_name('host.d'),
+                '--hostsdir=%s' % self.get_conf_file_name('addn_hosts.d'),
+            ]
+        else:
+            cmd += [
+                '--dhcp-hostsfile=%s' % self.get_conf_file_name('host'),
+                '--addn-hosts=%s' % self.get_conf_file_name('addn_hosts'),
+            ]
+        cmd += [
             '--dhcp-optsfile=%s' % self.get_conf_file_name('opts'),
             '--dhcp-leasefile=%s' % self.get_conf_file_name('leases'),
             '--dhcp-match=set:ipxe,175',
@@ -517,12 +538,19 @@ class Dnsmasq(DhcpLocalProcess):
         or it's reloaded if the process is not running.
         """
 
-        self._output_config_files()
+        start = time.monotonic()
+        reload_needed = self._output_config_files(
+            full_sync=not reload_with_HUP)
+        LOG.debug('Rendered the dnsmasq configuration of network %(net)s '
+                  'in %(time).3f s, reload needed: %(reload)s',
+                  {'net': self.network.id, 'time': time.monotonic() - start,
+                   'reload': reload_needed})
 
         pm = self._get_process_manager(
             cmd_callback=self._build_cmdline_callback)
 
-        pm.enable(reload_cfg=reload_with_HUP, ensure_active=True)
+        pm.enable(reload_cfg=reload_with_HUP and reload_needed,
+                  ensure_active=True)
 
         self.process_monitor.register(uuid=self.network.id,
                                       service_name=DNSMASQ_SERVICE_NAME,
@@ -568,10 +596,67 @@ class Dnsmasq(DhcpLocalProcess):
             LOG.warning('DHCP release failed for params %(params)s. '
                         'Reason: %(e)s', {'params': params, 'e': e})
 
-    def _output_config_files(self):
-        self._output_hosts_file()
-        self._output_addn_hosts_file()
-        self._output_opts_file()
+    def _release_leases_v4(self, leases):
+        """Release IPv4 DHCP leases with a single privileged call.
+
+        The DHCPRELEASE packets are sent to dnsmasq by the privileged daemon,
+        from the address of the DHCP port in the subnet of each lease.
+
+        :param leases: list of (mac_address, ip, client_id) tuples
+        """
+        try:
+            cidrs = [netaddr.IPNetwork(address['cidr']) for address in
+                     ip_lib.get_devices_with_ip(self.network.namespace,
+                                                name=self.interface_name)]
+            cidrs = [cidr for cidr in cidrs
+                     if cidr.version == constants.IP_VERSION_4]
+            packets = []
+            for mac_address, ip, client_id in leases:
+                server = next((cidr.ip for cidr in cidrs
+                               if netaddr.IPAddress(ip) in cidr), None)
+                if server is None:
+                    # dhcp_release does not release such leases either
+                    LOG.debug('No address of %(interface)s in the subnet of '
+                              'the lease of %(ip)s, not releasing it',
+                              {'interface': self.interface_name, 'ip': ip})
+                    continue
+                packets.append((ip, mac_address, client_id, str(server)))
+            if packets:
+                priv_dhcp.send_dhcp_release(
+                    self.interface_name, packets,
+                    namespace=self.network.namespace)
+        except OSError as e:
+            LOG.warning('DHCP release failed for the leases of %(ips)s. '
+                        'Reason: %(e)s',
+                        {'ips': ', '.join(ip for m, ip, c in leases),
+                         'e': e})
+
+    def _output_config_files(self, full_sync=True):
+        """Writes the dnsmasq configuration files of the network.
+
+        :param full_sync: when the incremental reload is enabled, read back
+                          the host entries written instead of trusting the
+                          ones rendered by the previous call
+        :returns: True if dnsmasq must be reloaded to apply the changes
+        """
+        if not self.conf.dnsmasq_incremental_reload:
+            self._output_hosts_file()
+            self._output_addn_hosts_file()
+            self._output_opts_file()
+            return True
+
+        reload_needed = self._output_hosts_dirs(full_sync)
+        opts = self._get_opts_file_data()
+        if self._get_value_from_conf_file('opts') != opts:
+            file_utils.replace_file(self.get_conf_file_name('opts'), opts)
+            reload_needed = True
+        return reload_needed
+
+    def _remove_config_files(self):
+        self._HOSTS_DIRS_ENTRIES.pop(self.network.id, None)
+        for kind in ('host', 'leases'):
+            self._PARSED_LEASES.pop(self.get_conf_file_name(kind), None)
+        super(Dnsmasq, self)._remove_config_files()
 
     def reload_allocations(self):
         """Rebuild the dnsmasq config and signal the dnsmasq to reload."""
@@ -873,10 +958,33 @@ class Dnsmasq(DhcpLocalProcess):
         should receive a dhcp lease, the hosts resolution in itself is
         defined by the `_output_addn_hosts_file` method.
         """
-        buf = io.StringIO()
         filename = self.get_conf_file_name('host')
 
         LOG.debug('Building host file: %s', filename)
+        entries = self._render_entries(self._get_hosts_file_entries)
+        file_utils.replace_file(filename, ''.join(entries.values()))
+        LOG.debug('Done building host file %s', filename)
+        return filename
+
+    def _render_entries(self, get_entries):
+        """Returns get_entries(), called in a native thread if configured.
+
+        Rendering the host entries of a large network never yields to the
+        other green threads, which keep running while a native thread renders
+        them.
+        """
+        if not self.conf.dnsmasq_render_in_native_thread:
+            return get_entries()
+        # this check runs a command the first time, from this green thread
+        self._is_dnsmasq_host_tag_supported()
+        return tpool.execute(get_entries)
+
+    def _get_hosts_file_entries(self):
+        """Returns the dhcp hosts file lines of each port, keyed by port id.
+
+        See `_output_hosts_file` for the format of the lines.
+        """
+        entries = {}
         dhcp_enabled_subnet_ids = [s.id for s in
                                    self._get_all_subnets(self.network)
                                    if s.enable_dhcp]
@@ -884,6 +992,7 @@ class Dnsmasq(DhcpLocalProcess):
         # avoid potential performance drop when lots of hosts are dumped
         for host_tuple in self._iter_hosts(merge_addr6_list=True):
             port, alloc, hostname, name, no_dhcp, no_opts, tag = host_tuple
+            buf = entries.setdefault(port.id, io.StringIO())
             if no_dhcp:
                 if not no_opts and self._get_port_extra_dhcp_opts(port):
                     buf.write('%s,%s%s%s\n' % (
@@ -916,9 +1025,110 @@ class Dnsmasq(DhcpLocalProcess):
                 buf.write('%s,%s%s,%s\n' %
                           (port.mac_address, tag, name, ip_address))
 
-        file_utils.replace_file(filename, buf.getvalue())
-        LOG.debug('Done building host file %s', filename)
-        return filename
+        return {port_id: buf.getvalue() for port_id, buf in entries.items()
+                if buf.tell()}
+
+    def _output_hosts_dirs(self, full_sync):
+        """Writes the host entries of the ports to the host directories.
+
+        The dhcp hosts file lines and the additional hosts file lines of each
+        port are written to files of the host.d and addn_hosts.d directories,
+        passed to the --dhcp-hostsdir and --hostsdir options of dnsmasq. The
+        entries of each port are written to a file named after the port, or
+        when dnsmasq_hosts_shards is set, to the shard file chosen by hash of
+        the port id. Only the files whose entries changed since the previous
+        call are rewritten, and the files left without entries are deleted.
+
+        dnsmasq reads the new and changed files of these directories on its
+        own, but it only forgets the entries removed from a file when it is
+        reloaded.
+
+        :param full_sync: read the entries from the files instead of the ones
+                          written by the previous call
+        :returns: True if entries were removed from the files
+        """
+        entries_by_kind = self._HOSTS_DIRS_ENTRIES.pop(self.network.id, {})
+        if full_sync:
+            entries_by_kind = {}
+        reload_needed = False
+        stats = {'added': 0, 'changed': 0, 'removed': 0}
+        new_entries_by_kind = {}
+        for kind, entries in (
+                ('host', self._render_entries(self._get_hosts_file_entries)),
+                ('addn_hosts',
+                 self._render_entries(self._get_addn_hosts_file_entries))):
+            entries = self._shard_hosts_dir_entries(entries)
+            dirname = self.get_conf_file_name('%s.d' % kind)
+            old_entries = entries_by_kind.get(kind)
+            if old_entries is None:
+                old_entries = self._read_hosts_dir(dirname)
+            for name, data in entries.items():
+                old_data = old_entries.get(name)
+                if data == old_data:
+                    continue
+                self._replace_hosts_dir_file(dirname, name, data)
+                if old_data is None:
+                    stats['added'] += 1
+                    continue
+                stats['changed'] += 1
+                if not set(old_data.splitlines()).issubset(
+                        data.splitlines()):
+                    reload_needed = True
+            for name in set(old_entries) - set(entries):
+                try:
+                    os.unlink(os.path.join(dirname, name))
+                except FileNotFoundError:
+                    pass
+                stats['removed'] += 1
+                reload_needed = True
+            new_entries_by_kind[kind] = entries
+        self._HOSTS_DIRS_ENTRIES[self.network.id] = new_entries_by_kind
+        LOG.debug('Host files of network %(net)s: %(added)d added, '
+                  '%(changed)d changed, %(removed)d removed',
+                  dict(stats, net=self.network.id))
+        return reload_needed
+
+    def _shard_hosts_dir_entries(self, entries):
+        """Groups the entries of the ports by shard file, if enabled."""
+        shards = self.conf.dnsmasq_hosts_shards
+        if not shards:
+            return entries
+        shard_entries = collections.defaultdict(list)
+        for port_id, data in entries.items():
+            index = zlib.crc32(port_id.encode()) % shards
+            shard_entries['shard-%02d' % index].append(data)
+        return {name: ''.join(data) for name, data in shard_entries.items()}
+
+    def _get_hosts_dir_entries(self, kind):
+        entries_by_kind = self._HOSTS_DIRS_ENTRIES.get(self.network.id, {})
+        entries = entries_by_kind.get(kind)
+        if entries is None:
+            entries = self._read_hosts_dir(
+                self.get_conf_file_name('%s.d' % kind))
+        return entries
+
+    @staticmethod
+    def _read_hosts_dir(dirname):
+        fileutils.ensure_tree(dirname, mode=0o755)
+        entries = {}
+        for name in os.listdir(dirname):
+            # dnsmasq ignores the files whose name starts with a dot, they
+            # are the files left half written by _replace_hosts_dir_file
+            if name.startswith('.'):
+                continue
+            with open(os.path.join(dirname, name)) as f:
+                entries[name] = f.read()
+        return entries
+
+    @staticmethod
+    def _replace_hosts_dir_file(dirname, name, data):
+        # The file is written under a name ignored by dnsmasq then renamed,
+        # so that dnsmasq never reads it partially written.
+        tmp_name = os.path.join(dirname, '.%s' % name)
+        with open(tmp_name, 'w') as f:
+            f.write(data)
+        os.chmod(tmp_name, 0o644)
+        os.rename(tmp_name, os.path.join(dirname, name))
 
     def _get_client_id(self, port):
         if self._get_port_extra_dhcp_opts(port):
@@ -933,27 +1143,61 @@ class Dnsmasq(DhcpLocalProcess):
         ip_list = [ip.strip('[]') for ip in ip_list]
         return [ip for ip in ip_list if netutils.is_valid_ip(ip)]
 
+    def _read_parsed_leases(self, filename, parse):
+        """Returns the leases parsed from the lines of a file.
+
+        The leases parsed from a file are kept until the file changes, so
+        the files which did not change since the previous reload are not
+        parsed again. A file modified less than a second ago is parsed
+        without keeping its leases, as a write in the same clock tick would
+        not change its modification time.
+
+        :param filename: hosts or leases file
+        :param parse: function returning the leases of an iterable of lines
+        :return: the leases, which must not be modified by the caller
+        """
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            stat = None
+        if stat:
+            key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            cached = self._PARSED_LEASES.get(filename)
+            if cached and cached[0] == key:
+                return cached[1]
+        with open(filename) as f:
+            leases = parse(f)
+        if stat and time.time() - stat.st_mtime >= 1:
+            self._PARSED_LEASES[filename] = (key, leases)
+        else:
+            self._PARSED_LEASES.pop(filename, None)
+        return leases
+
     def _read_hosts_file_leases(self, filename):
-        leases = set()
         try:
-            with open(filename) as f:
-                for line in f.readlines():
-                    host = line.strip().split(',')
-                    mac = host[0]
-                    client_id = None
-                    if host[1].startswith('set:'):
-                        continue
-                    if host[1].startswith(self._ID):
-                        ips = self._parse_ip_addresses(host[3:])
-                        client_id = host[1][len(self._ID):]
-                    elif host[1].startswith('tag:'):
-                        ips = self._parse_ip_addresses(host[3:])
-                    else:
-                        ips = self._parse_ip_addresses(host[2:])
-                    for ip in ips:
-                        leases.add((ip, mac, client_id))
+            return self._read_parsed_leases(filename,
+                                            self._parse_hosts_file_leases)
         except (OSError, IOError):
             LOG.debug('Error while reading hosts file %s', filename)
+        return set()
+
+    def _parse_hosts_file_leases(self, lines):
+        leases = set()
+        for line in lines:
+            host = line.strip().split(',')
+            mac = host[0]
+            client_id = None
+            if host[1].startswith('set:'):
+                continue
+            if host[1].startswith(self._ID):
+                ips = self._parse_ip_addresses(host[3:])
+                client_id = host[1][len(self._ID):]
+            elif host[1].startswith('tag:'):
+                ips = self._parse_ip_addresses(host[3:])
+            else:
+                ips = self._parse_ip_addresses(host[2:])
+            for ip in ips:
+                leases.add((ip, mac, client_id))
         return leases
 
     def _read_leases_file_leases(self, filename):
@@ -994,36 +1238,47 @@ class Dnsmasq(DhcpLocalProcess):
         :return: dict, keys are IP(v6) addresses, values are dicts containing
                 iaid, client_id and server_id
         """
+        if not os.path.exists(filename):
+            return {}
+        return self._read_parsed_leases(
+            filename,
+            lambda lines: self._parse_leases_file_leases(filename, lines))
+
+    @staticmethod
+    def _parse_leases_file_leases(filename, lines):
         leases = {}
         server_id = None
-        if os.path.exists(filename):
-            with open(filename) as f:
-                for line in f.readlines():
-                    if line.startswith('duid'):
-                        if not server_id:
-                            server_id = line.strip().split()[1]
-                        else:
-                            LOG.warning('Multiple DUID entries in %s '
-                                        'lease file, dnsmasq is possibly '
-                                        'not functioning properly',
-                                        filename)
-                        continue
-                    parts = line.strip().split()
-                    if len(parts) != 5:
-                        LOG.warning('Invalid lease entry %s found in %s '
-                                    'lease file, ignoring', parts, filename)
-                        continue
-                    (iaid, ip, client_id) = parts[1], parts[2], parts[4]
-                    ip = ip.strip('[]')
-                    leases[ip] = {'iaid': iaid,
-                                  'client_id': client_id,
-                                  'server_id': server_id
-                                  }
+        for line in lines:
+            if line.startswith('duid'):
+                if not server_id:
+                    server_id = line.strip().split()[1]
+                else:
+                    LOG.warning('Multiple DUID entries in %s '
+                                'lease file, dnsmasq is possibly '
+                                'not functioning properly',
+                                filename)
+                continue
+            parts = line.strip().split()
+            if len(parts) != 5:
+                LOG.warning('Invalid lease entry %s found in %s '
+                            'lease file, ignoring', parts, filename)
+                continue
+            (iaid, ip, client_id) = parts[1], parts[2], parts[4]
+            ip = ip.strip('[]')
+            leases[ip] = {'iaid': iaid,
+                          'client_id': client_id,
+                          'server_id': server_id
+                          }
         return leases
 
     def _release_unused_leases(self):
-        filename = self.get_conf_file_name('host')
-        old_leases = self._read_hosts_file_leases(filename)
+        if self.conf.dnsmasq_incremental_reload:
+            entries = self._get_hosts_dir_entries('host')
+            old_leases = self._parse_hosts_file_leases(
+                ''.join(entries.values()).splitlines())
+        else:
+            filename = self.get_conf_file_name('host')
+            old_leases = self._read_hosts_file_leases(filename)
         leases_filename = self.get_conf_file_name('leases')
         cur_leases = self._read_leases_file_leases(leases_filename)
         if not cur_leases:
@@ -1070,6 +1325,7 @@ class Dnsmasq(DhcpLocalProcess):
         # entries.
         for i in range(DHCP_RELEASE_TRIES + 1):
             entries_not_present = set()
+            v4_releases = []
             for ip, mac, client_id in entries_to_release:
                 try:
                     entry = cur_leases[ip]
@@ -1081,8 +1337,13 @@ class Dnsmasq(DhcpLocalProcess):
                     ip_version = netaddr.IPAddress(ip).version
                     if ip_version == constants.IP_VERSION_6:
                         client_id = entry['client_id']
+                    elif self.conf.dnsmasq_direct_release:
+                        v4_releases.append((mac, ip, client_id))
+                        continue
                     self._release_lease(mac, ip, ip_version, client_id,
                                         entry['server_id'], entry['iaid'])
+            if v4_releases:
+                self._release_leases_v4(v4_releases)
 
             # Remove elements that were not in the current leases file,
             # no need to look for them again, and see if we're done.
@@ -1111,26 +1372,37 @@ class Dnsmasq(DhcpLocalProcess):
         Each line in this file is in the same form as a standard /etc/hosts
         file.
         """
-        buf = io.StringIO()
+        entries = self._render_entries(self._get_addn_hosts_file_entries)
+        addn_hosts = self.get_conf_file_name('addn_hosts')
+        file_utils.replace_file(addn_hosts, ''.join(entries.values()))
+        return addn_hosts
+
+    def _get_addn_hosts_file_entries(self):
+        """Returns the additional hosts file lines of each port.
+
+        The lines are keyed by port id.
+        """
+        entries = {}
         for host_tuple in self._iter_hosts():
             port, alloc, hostname, fqdn, no_dhcp, no_opts, tag = host_tuple
             # It is compulsory to write the `fqdn` before the `hostname` in
             # order to obtain it in PTR responses.
             if alloc:
-                buf.write('%s\t%s %s\n' % (alloc.ip_address, fqdn, hostname))
-        addn_hosts = self.get_conf_file_name('addn_hosts')
-        file_utils.replace_file(addn_hosts, buf.getvalue())
-        return addn_hosts
+                entries[port.id] = entries.get(port.id, '') + (
+                    '%s\t%s %s\n' % (alloc.ip_address, fqdn, hostname))
+        return entries
 
     def _output_opts_file(self):
         """Write a dnsmasq compatible options file."""
-        options, subnet_index_map = self._generate_opts_per_subnet()
-        options += self._generate_opts_per_port(subnet_index_map)
-
         name = self.get_conf_file_name('opts')
-        file_utils.replace_file(name, '\n'.join(options))
+        file_utils.replace_file(name, self._get_opts_file_data())
         return name
 
+    def _get_opts_file_data(self):
+        options, subnet_index_map = self._generate_opts_per_subnet()
+        options += self._generate_opts_per_port(subnet_index_map)
+        return '\n'.join(options)
+
     def _generate_opts_per_subnet(self):
         options = []
         subnets_without_nameservers = set()
@@ -12,12 +12,16 @@
 #    limitations under the License.
 
 import copy
+import itertools
 
 import netaddr
+from oslo_log import log as logging
 
 from neutron.agent.linux import utils as linux_utils
 from oslo_concurrency import lockutils
 
+LOG = logging.getLogger(__name__)
+
 IPSET_ADD_BULK_THRESHOLD = 5
 NET_PREFIX = 'N'
 SWAP_SUFFIX = '-n'
@@ -29,12 +33,19 @@ class IpsetManager(object):
 
        Keeps track of ip addresses per set, using bulk
        or single ip add/remove for smaller changes.
+
+       While the apply is deferred, the changes of all the sets are
+       accumulated and applied by a single ipset restore when it is
+       turned off.
     """
 
     def __init__(self, execute=None, namespace=None):
         self.execute = execute or linux_utils.execute
         self.namespace = namespace
         self.ipset_sets = {}
+        self.ipset_apply_deferred = False
+        # ipset restore commands of the deferred changes, per set
+        self._deferred_sets = {}
 
     def _sanitize_addresses(self, addresses):
         """This method converts any address to ipset format.
@@ -84,6 +95,9 @@ class IpsetManager(object):
         return add_ips, del_ips
 
     def set_members_mutate(self, set_name, ethertype, member_ips):
+        if self.ipset_apply_deferred:
+            self._defer_set_members(set_name, ethertype, member_ips)
+            return
         with lockutils.lock('neutron-ipset-%s' % self.namespace,
                             external=True):
             if not self.set_name_exists(set_name):
@@ -106,10 +120,65 @@ class IpsetManager(object):
                 else:
                     self._refresh_set(set_name, member_ips, ethertype)
 
+    def _defer_set_members(self, set_name, ethertype, member_ips):
+        commands = self._deferred_sets.setdefault(set_name, [])
+        if not self.set_name_exists(set_name):
+            # same as the creation of a set out of a deferred apply
+            commands.append('create %s hash:net family %s' % (
+                set_name, self._get_ipset_set_type(ethertype)))
+            commands += self._get_refresh_commands(set_name, member_ips,
+                                                   ethertype)
+        else:
+            add_ips = self._get_new_set_ips(set_name, member_ips)
+            del_ips = self._get_deleted_set_ips(set_name, member_ips)
+            if (len(add_ips) + len(del_ips) < IPSET_ADD_BULK_THRESHOLD):
+                commands += ['add %s %s' % (set_name, ip) for ip in add_ips]
+                commands += ['del %s %s' % (set_name, ip) for ip in del_ips]
+            else:
+                commands += self._get_refresh_commands(set_name, member_ips,
+                                                       ethertype)
+        self.ipset_sets[set_name] = copy.copy(member_ips)
+
+    def defer_apply_on(self):
+        self.ipset_apply_deferred = True
+
+    def defer_apply_off(self):
+        self.ipset_apply_deferred = False
+        deferred_sets, self._deferred_sets = self._deferred_sets, {}
+        if not deferred_sets:
+            return
+        with lockutils.lock('neutron-ipset-%s' % self.namespace,
+                            external=True):
+            try:
+                self._restore_sets(list(
+                    itertools.chain.from_iterable(deferred_sets.values())))
+                return
+            except RuntimeError:
+                if len(deferred_sets) == 1:
+                    # no need to restore the set again
+                    failed_sets = list(deferred_sets)
+                else:
+                    LOG.warning("Failed to update %d ipsets at once, "
+                                "updating them one by one",
+                                len(deferred_sets))
+                    failed_sets = []
+                    for set_name, commands in deferred_sets.items():
+                        try:
+                            self._restore_sets(commands)
+                        except RuntimeError:
+                            failed_sets.append(set_name)
+            for set_name in failed_sets:
+                LOG.error("Failed to update ipset %s, it will be created "
+                          "again on its next update", set_name)
+                # the members of the set are unknown, the rules don't
+                # reference it until it is created again
+                self.ipset_sets.pop(set_name, None)
+
     def destroy(self, id, ethertype, forced=False):
         with lockutils.lock('neutron-ipset-%s' % self.namespace,
                             external=True):
             set_name = self.get_name(id, ethertype)
+            self._deferred_sets.pop(set_name, None)
             self._destroy(set_name, forced)
 
     def _add_member_to_set(self, set_name, member_ip):
@@ -117,13 +186,26 @@ class IpsetManager(object):
         self._apply(cmd)
         self.ipset_sets[set_name].append(member_ip)
 
-    def _refresh_set(self, set_name, member_ips, ethertype):
-        new_set_name = set_name + SWAP_SUFFIX
+    def _get_new_set_commands(self, new_set_name, member_ips, ethertype):
         set_type = self._get_ipset_set_type(ethertype)
         process_input = ["create %s hash:net family %s" % (new_set_name,
                                                            set_type)]
         for ip in member_ips:
             process_input.append("add %s %s" % (new_set_name, ip))
+        return process_input
+
+    def _get_refresh_commands(self, set_name, member_ips, ethertype):
+        new_set_name = set_name + SWAP_SUFFIX
+        process_input = self._get_new_set_commands(new_set_name, member_ips,
+                                                   ethertype)
+        process_input.append("swap %s %s" % (new_set_name, set_name))
+        process_input.append("destroy %s" % new_set_name)
+        return process_input
+
+    def _refresh_set(self, set_name, member_ips, ethertype):
+        new_set_name = set_name + SWAP_SUFFIX
+        process_input = self._get_new_set_commands(new_set_name, member_ips,
+                                                   ethertype)
 
         self._restore_sets(process_input)
         self._swap_sets(new_set_name, set_name)
@@ -22,6 +22,7 @@ SNAT_OUT = 'Perform source NAT on outgoing traffic.'
 UNMATCH_DROP = 'Default drop rule for unmatched traffic.'
 VM_INT_SG = 'Direct traffic from the VM interface to the security group chain.'
 SG_TO_VM_SG = 'Jump to the VM specific chain.'
+DISPATCH = 'Jump to the chain holding the jump rules of a subset of VMs.'
 INPUT_TO_SG = 'Direct incoming traffic from VM to the security group chain.'
 PAIR_ALLOW = 'Allow traffic from defined IP/MAC pairs.'
 PAIR_DROP = 'Drop traffic without an IP/MAC allow rule.'
@@ -17,6 +17,7 @@ import collections
 import ctypes
 from ctypes import util
 import sys
+import zlib
 
 import netaddr
 from neutron_lib import constants
@@ -41,6 +42,11 @@ SPOOF_FILTER = 'spoof-filter'
 CHAIN_NAME_PREFIX = {constants.INGRESS_DIRECTION: 'i',
                      constants.EGRESS_DIRECTION: 'o',
                      SPOOF_FILTER: 's'}
+# prefixes of the chains holding the jump rules of a subset of the ports,
+# per chain holding the jumps to them
+DISPATCH_CHAIN_PREFIX = {SG_CHAIN: 'sg-chain-',
+                         'FORWARD': 'sg-fwd-',
+                         'INPUT': 'sg-in-'}
 IPSET_DIRECTION = {constants.INGRESS_DIRECTION: 'src',
                    constants.EGRESS_DIRECTION: 'dst'}
 comment_rule = iptables_manager.comment_rule
@@ -90,9 +96,12 @@ class IptablesFirewallDriver(firewall.FirewallDriver):
             lambda: collections.defaultdict(list))
         self.pre_sg_members = None
         self.enable_ipset = cfg.CONF.SECURITYGROUP.enable_ipset
+        self.dispatch_chains = cfg.CONF.SECURITYGROUP.iptables_dispatch_chains
         self.updated_rule_sg_ids = set()
         self.updated_sg_members = set()
         self.devices_with_updated_sg_members = collections.defaultdict(list)
+        # conntrack states to delete once the deferred ipsets are updated
+        self._deferred_conntrack_deletes = []
         self._iptables_protocol_name_map = {}
         self._check_netfilter_for_bridges()
 
@@ -181,6 +190,30 @@ class IptablesFirewallDriver(firewall.FirewallDriver):
         if self.enable_ipset:
             self._update_ipset_members(sg_id, sg_members)
 
+    def update_security_group_members_delta(self, sg_id, added, removed):
+        """Update the members and the ipsets of a remote group.
+
+        Only supported with ipset, the ports rules matching the ipsets are not
+        modified. The ports must be refreshed when an ipset not referenced
+        yet, because the group had no member, is needed.
+        """
+        if not self.enable_ipset:
+            return False
+        members = {ethertype: set(addresses) for ethertype, addresses in
+                   self.sg_members.get(sg_id, {}).items()}
+        for ethertype, addresses in removed.items():
+            members.get(ethertype, set()).difference_update(addresses)
+        for ethertype, addresses in added.items():
+            if not self.ipset.set_name_exists(
+                    self.ipset.get_name(sg_id, ethertype)):
+                return False
+            members.setdefault(ethertype, set()).update(addresses)
+        self._update_remote_security_group_members([sg_id])
+        self.update_security_group_members(
+            sg_id, {ethertype: list(addresses)
+                    for ethertype, addresses in members.items()})
+        return True
+
     def _update_ipset_members(self, sg_id, sg_members):
         devices = self.devices_with_updated_sg_members.pop(sg_id, None)
         for ip_version, current_ips in sg_members.items():
@@ -189,8 +222,12 @@ class IptablesFirewallDriver(firewall.FirewallDriver):
             if devices and del_ips:
                 # remove prefix from del_ips
                 ips = [str(netaddr.IPNetwork(del_ip).ip) for del_ip in del_ips]
-                self.ipconntrack.delete_conntrack_state_by_remote_ips(
-                    devices, ip_version, ips)
+                if self.ipset.ipset_apply_deferred:
+                    self._deferred_conntrack_deletes.append(
+                        (devices, ip_version, ips))
+                else:
+                    self.ipconntrack.delete_conntrack_state_by_remote_ips(
+                        devices, ip_version, ips)
 
     def _set_ports(self, port):
         if not firewall.port_sec_enabled(port):
@@ -263,6 +300,7 @@ class IptablesFirewallDriver(firewall.FirewallDriver):
 
     def _setup_chains_apply(self, ports, unfiltered_ports):
         self._add_chain_by_name_v4v6(SG_CHAIN)
+        self._add_dispatch_chains()
         # sort by port so we always do this deterministically between
         # agent restarts and don't cause unnecessary rule differences
         for pname in sorted(ports):
@@ -292,8 +330,40 @@ class IptablesFirewallDriver(firewall.FirewallDriver):
         for port in unfiltered_ports.values():
             self._remove_rule_port_sec(port, constants.INGRESS_DIRECTION)
             self._remove_rule_port_sec(port, constants.EGRESS_DIRECTION)
+        self._remove_dispatch_chains()
         self._remove_chain_by_name_v4v6(SG_CHAIN)
 
+    def _get_dispatch_chains(self, chain):
+        return ['%s%02d' % (DISPATCH_CHAIN_PREFIX[chain], index)
+                for index in range(self.dispatch_chains)]
+
+    def _get_port_dispatch_chain(self, port, chain):
+        """Return the chain holding the jump rules of the port from chain."""
+        if not self.dispatch_chains:
+            return chain
+        # the hash must not change between agent restarts
+        index = (zlib.crc32(self._get_device_name(port).encode()) %
+                 self.dispatch_chains)
+        return self._get_dispatch_chains(chain)[index]
+
+    def _add_dispatch_chains(self):
+        # all the dispatch chains are always present, the jumps to them are
+        # not changed when ports are added or removed
+        for chain in DISPATCH_CHAIN_PREFIX:
+            for dispatch_chain in self._get_dispatch_chains(chain):
+                self._add_chain_by_name_v4v6(dispatch_chain)
+                jump_rule = ['-j $%s' % dispatch_chain]
+                # like the jump rules of the ports, the jumps from FORWARD
+                # must be applied before unfiltered or trusted ports
+                self._add_rules_to_chain_v4v6(
+                    chain, jump_rule, jump_rule, top=chain == 'FORWARD',
+                    comment=ic.DISPATCH)
+
+    def _remove_dispatch_chains(self):
+        for chain in DISPATCH_CHAIN_PREFIX:
+            for dispatch_chain in self._get_dispatch_chains(chain):
+                self._remove_chain_by_name_v4v6(dispatch_chain)
+
     def _setup_chain(self, port, DIRECTION):
         self._add_chain(port, DIRECTION)
         self._add_rules_by_security_group(port, DIRECTION)
@@ -371,20 +441,23 @@ class IptablesFirewallDriver(firewall.FirewallDriver):
                                  SG_CHAIN)]
         # Security group chain has to be applied before unfiltered
         # or trusted ports
-        self._add_rules_to_chain_v4v6('FORWARD', jump_rule, jump_rule,
-                                      top=True, comment=ic.VM_INT_SG)
+        self._add_rules_to_chain_v4v6(
+            self._get_port_dispatch_chain(port, 'FORWARD'), jump_rule,
+            jump_rule, top=True, comment=ic.VM_INT_SG)
 
         # jump to the chain based on the device
         jump_rule = ['-m physdev --%s %s --physdev-is-bridged '
                      '-j $%s' % (self.IPTABLES_DIRECTION[direction],
                                  device,
                                  chain_name)]
-        self._add_rules_to_chain_v4v6(SG_CHAIN, jump_rule, jump_rule,
-                                      comment=ic.SG_TO_VM_SG)
+        self._add_rules_to_chain_v4v6(
+            self._get_port_dispatch_chain(port, SG_CHAIN), jump_rule,
+            jump_rule, comment=ic.SG_TO_VM_SG)
 
         if direction == constants.EGRESS_DIRECTION:
-            self._add_rules_to_chain_v4v6('INPUT', jump_rule, jump_rule,
-                                          comment=ic.INPUT_TO_SG)
+            self._add_rules_to_chain_v4v6(
+                self._get_port_dispatch_chain(port, 'INPUT'), jump_rule,
+                jump_rule, comment=ic.INPUT_TO_SG)
 
     def _get_br_device_name(self, port):
         return ('brq' + port['network_id'])[:constants.LINUX_DEV_LEN]
@@ -840,6 +913,7 @@ class IptablesFirewallDriver(firewall.FirewallDriver):
     def filter_defer_apply_on(self):
         if not self._defer_apply:
             self.iptables.defer_apply_on()
+            self.ipset.defer_apply_on()
             self._pre_defer_filtered_ports = dict(self.filtered_ports)
             self._pre_defer_unfiltered_ports = dict(self.unfiltered_ports)
             self.pre_sg_members = dict(self.sg_members)
@@ -1000,6 +1074,13 @@ class IptablesFirewallDriver(firewall.FirewallDriver):
     def filter_defer_apply_off(self):
         if self._defer_apply:
             self._defer_apply = False
+            # the ipsets are updated first, the rules must only match the
+            # ipsets which exist
+            self.ipset.defer_apply_off()
+            for devices, ip_version, ips in self._deferred_conntrack_deletes:
+                self.ipconntrack.delete_conntrack_state_by_remote_ips(
+                    devices, ip_version, ips)
+            self._deferred_conntrack_deletes = []
             self._remove_chains_apply(self._pre_defer_filtered_ports,
                                       self._pre_defer_unfiltered_ports)
             self._setup_chains_apply(self.filtered_ports,
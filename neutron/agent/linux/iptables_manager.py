@@ -18,12 +18,13 @@
 
 """Implements iptables rules using linux utilities."""
 
+import bisect
 import collections
 import contextlib
-import difflib
 import os
 import re
 import sys
+import time
 
 from neutron_lib import constants
 from neutron_lib import exceptions
@@ -68,6 +69,9 @@ XTABLES_RESOURCE_PROBLEM_CODE = 4
 # xlock wait interval, in microseconds
 XLOCK_WAIT_INTERVAL = 200000
 
+# iptables_backend value programming the rules through iptables-nft
+NFT_BACKEND = 'nft'
+
 
 def comment_rule(rule, comment):
     if not cfg.CONF.AGENT.comment_iptables_rules or not comment:
@@ -314,6 +318,11 @@ class IptablesManager(object):
         self.iptables_apply_deferred = False
         self.wrap_name = binary_name[:16]
         self.external_lock = external_lock
+        self.backend = cfg.CONF.AGENT.iptables_backend
+        # rules of each table as last applied, per command, and time of the
+        # last iptables-save they were computed from
+        self._rules_mirror = {}
+        self._rules_mirror_time = {}
 
         self.ipv4 = {'filter': IptablesTable(binary_name=self.wrap_name)}
         self.ipv6 = {'filter': IptablesTable(binary_name=self.wrap_name)}
@@ -473,9 +482,19 @@ class IptablesManager(object):
                 raise l3_exc.IpTablesApplyException(msg)
             return first
 
+    def _get_binary(self, cmd, action=None):
+        """Return the name of the binary of cmd for the configured backend.
+
+        :param cmd: 'iptables' or 'ip6tables'
+        :param action: None, 'save' or 'restore'
+        """
+        if self.backend == NFT_BACKEND:
+            cmd += '-nft'
+        return '%s-%s' % (cmd, action) if action else cmd
+
     def get_rules_for_table(self, table):
         """Runs iptables-save on a table and returns the results."""
-        args = ['iptables-save', '-t', table]
+        args = [self._get_binary('iptables', 'save'), '-t', table]
         if self.namespace:
             args = ['ip', 'netns', 'exec', self.namespace] + args
         return linux_utils.execute(args, run_as_root=True,
@@ -483,7 +502,7 @@ class IptablesManager(object):
 
     def _get_version(self):
         # Output example is "iptables v1.6.2"
-        args = ['iptables', '--version']
+        args = [self._get_binary('iptables'), '--version']
         version = str(linux_utils.execute(
             args, run_as_root=True, privsep_exec=True).split()[1][1:])
         LOG.debug("IPTables version installed: %s", version)
@@ -537,7 +556,7 @@ class IptablesManager(object):
     def _log_restore_err(self, err, commands):
         try:
             line_no = int(re.search(
-                'iptables-restore: line ([0-9]+?) failed',
+                'iptables(?:-nft)?-restore: line ([0-9]+?) failed',
                 str(err)).group(1))
             context = IPTABLES_ERROR_LINES_OF_CONTEXT
             log_start = max(0, line_no - context)
@@ -562,6 +581,11 @@ class IptablesManager(object):
         and replace them with the current set of rules.
         This happens atomically, thanks to iptables-restore.
 
+        The rules of the previous runs are read with iptables-save unless
+        iptables_resync_interval is set, in which case the rules last
+        applied are used until the interval elapses or iptables-restore
+        fails.
+
         Returns a list of the changes that were sent to iptables-save.
         """
         s = [('iptables', self.ipv4)]
@@ -569,63 +593,95 @@ class IptablesManager(object):
             s += [('ip6tables', self.ipv6)]
         all_commands = []  # variable to keep track all commands for return val
         for cmd, tables in s:
-            args = ['%s-save' % (cmd,)]
-            if self.namespace:
-                args = ['ip', 'netns', 'exec', self.namespace] + args
-            try:
-                save_output = linux_utils.execute(args, run_as_root=True,
-                                                  privsep_exec=True)
-            except RuntimeError:
-                # We could be racing with a cron job deleting namespaces.
-                # It is useless to try to apply iptables rules over and
-                # over again in a endless loop if the namespace does not
-                # exist.
-                with excutils.save_and_reraise_exception() as ctx:
-                    if (self.namespace and not
-                            ip_lib.network_namespace_exists(self.namespace)):
-                        ctx.reraise = False
-                        LOG.error("Namespace %s was deleted during IPTables "
-                                  "operations.", self.namespace)
-                        return []
-            all_lines = save_output.split('\n')
+            mirror = self._get_rules_mirror(cmd, tables)
+            if mirror is None:
+                args = [self._get_binary(cmd, 'save')]
+                if self.namespace:
+                    args = ['ip', 'netns', 'exec', self.namespace] + args
+                try:
+                    save_output = linux_utils.execute(args, run_as_root=True,
+                                                      privsep_exec=True)
+                except RuntimeError:
+                    with excutils.save_and_reraise_exception() as ctx:
+                        if self._namespace_deleted():
+                            ctx.reraise = False
+                            return []
+                self._rules_mirror_time[cmd] = time.monotonic()
+                all_lines = save_output.split('\n')
             commands = []
+            new_mirror = {}
             # Traverse tables in sorted order for predictable dump output
             for table_name in sorted(tables):
                 table = tables[table_name]
-                # isolate the lines of the table we are modifying
-                start, end = self._find_table(all_lines, table_name)
-                old_rules = all_lines[start:end]
+                if mirror is not None:
+                    old_rules = mirror[table_name]
+                else:
+                    # isolate the lines of the table we are modifying
+                    start, end = self._find_table(all_lines, table_name)
+                    old_rules = all_lines[start:end]
                 # generate the new table state we want
                 new_rules = self._modify_rules(old_rules, table, table_name)
+                new_mirror[table_name] = new_rules
                 # generate the iptables commands to get between the old state
                 # and the new state
-                changes = _generate_path_between_rules(old_rules, new_rules)
+                if self.backend == NFT_BACKEND:
+                    changes = _generate_chain_replace_commands(old_rules,
+                                                               new_rules)
+                else:
+                    changes = _generate_path_between_rules(old_rules,
+                                                           new_rules)
                 if changes:
                     # if there are changes to the table, we put on the header
                     # and footer that iptables-save needs
                     commands += (['# Generated by iptables_manager'] +
                                  ['*%s' % table_name] + changes +
                                  ['COMMIT', '# Completed by iptables_manager'])
-            if not commands:
-                continue
-            all_commands += commands
+            if commands:
+                all_commands += commands
 
-            # always end with a new line
-            commands.append('')
+                # always end with a new line
+                commands.append('')
 
-            args = ['%s-restore' % (cmd,), '-n']
-            if self.namespace:
-                args = ['ip', 'netns', 'exec', self.namespace] + args
+                args = [self._get_binary(cmd, 'restore'), '-n']
+                if self.namespace:
+                    args = ['ip', 'netns', 'exec', self.namespace] + args
 
-            err = self._run_restore(args, commands)
-            if err:
-                self._log_restore_err(err, commands)
-                raise err
+                err = self._run_restore(args, commands)
+                if err:
+                    # the rules will be read again from the kernel
+                    self._rules_mirror.pop(cmd, None)
+                    if mirror is not None and self._namespace_deleted():
+                        return []
+                    self._log_restore_err(err, commands)
+                    raise err
+            if cfg.CONF.AGENT.iptables_resync_interval:
+                self._rules_mirror[cmd] = new_mirror
 
         LOG.debug("IPTablesManager.apply completed with success. %d iptables "
                   "commands were issued", len(all_commands))
         return all_commands
 
+    def _get_rules_mirror(self, cmd, tables):
+        """Return the rules last applied with cmd if they can be trusted."""
+        interval = cfg.CONF.AGENT.iptables_resync_interval
+        mirror = self._rules_mirror.get(cmd)
+        if (not interval or mirror is None or set(tables) - set(mirror) or
+                time.monotonic() - self._rules_mirror_time[cmd] >= interval):
+            return None
+        return mirror
+
+    def _namespace_deleted(self):
+        # We could be racing with a cron job deleting namespaces.
+        # It is useless to try to apply iptables rules over and
+        # over again in a endless loop if the namespace does not
+        # exist.
+        if (self.namespace and not
+                ip_lib.network_namespace_exists(self.namespace)):
+            LOG.error("Namespace %s was deleted during IPTables "
+                      "operations.", self.namespace)
+            return True
+        return False
+
     def _find_table(self, lines, table_name):
         if len(lines) < 3:
             # length only <2 when fake iptables
@@ -769,8 +825,8 @@ class IptablesManager(object):
         acc = {'pkts': 0, 'bytes': 0}
 
         for cmd, table in cmd_tables:
-            args = [cmd, '-t', table, '-L', name, '-n', '-v', '-x',
-                    '-w', self.xlock_wait_time]
+            args = [self._get_binary(cmd), '-t', table, '-L', name,
+                    '-n', '-v', '-x', '-w', self.xlock_wait_time]
             if zero:
                 args.append('-Z')
             if self.namespace:
@@ -834,6 +890,55 @@ def _generate_path_between_rules(old_rules, new_rules):
     return statements
 
 
+def _generate_chain_replace_commands(old_rules, new_rules):
+    """Generates iptables commands replacing the chains that changed.
+
+    Inserting and deleting rules by position requires the nftables backend
+    of iptables to look the rules of the chain up for every statement, so
+    the rules appended to a chain are appended and the other chains whose
+    rules differ are flushed and filled again instead, which resets the
+    counters of their rules. The built-in chains only hold a few jumps and
+    keep their counters: they are still changed by position. The chains
+    left unchanged are not touched and all the statements are applied in a
+    single transaction by iptables-restore.
+    """
+    old_by_chain = _get_rules_by_chain(old_rules)
+    new_by_chain = _get_rules_by_chain(new_rules)
+    old_chains, new_chains = set(old_by_chain.keys()), set(new_by_chain.keys())
+    builtin_chains = _get_builtin_chains(old_rules)
+    # all referenced chains should be declared at the top before rules.
+    statements = [':%s - [0:0]' % c for c in sorted(new_chains - old_chains)]
+    for chain in sorted(new_chains):
+        old_chain_rules = old_by_chain.get(chain, [])
+        new_chain_rules = new_by_chain[chain]
+        kept = len(old_chain_rules)
+        if new_chain_rules[:kept] == old_chain_rules:
+            statements += new_chain_rules[kept:]
+        elif chain in builtin_chains:
+            statements += _generate_chain_diff_iptables_commands(
+                chain, old_chain_rules, new_chain_rules)
+        else:
+            statements.append('-F %s' % chain)
+            statements += new_chain_rules
+    # unreferenced chains get the axe, once no rule jumps to them anymore
+    removed_chains = sorted(old_chains - new_chains)
+    statements += ['-F %s' % chain for chain in removed_chains
+                   if old_by_chain[chain]]
+    statements += ['-X %s' % chain for chain in removed_chains]
+    return statements
+
+
+def _get_builtin_chains(rules):
+    """Return the chains declared with a policy, i.e. the built-in ones."""
+    builtin_chains = set()
+    for line in rules:
+        if line.startswith(':'):
+            chain_and_policy = line[1:].split(' ', 2)
+            if len(chain_and_policy) > 1 and chain_and_policy[1] != '-':
+                builtin_chains.add(chain_and_policy[0])
+    return builtin_chains
+
+
 def _get_rules_by_chain(rules):
     by_chain = collections.defaultdict(list)
     for line in rules:
@@ -850,24 +955,94 @@ def _get_rules_by_chain(rules):
     return by_chain
 
 
+def _match_unique_rules(old_rules, new_rules):
+    """Match the rules present once in both lists, keeping their order.
+
+    Returns the (old index, new index) pairs of the longest sequence of
+    such rules found in the same order in both lists, computed in
+    O(n log n).
+    """
+    old_counts = collections.Counter(old_rules)
+    new_counts = collections.Counter(new_rules)
+    new_index = {rule: index for index, rule in enumerate(new_rules)
+                 if new_counts[rule] == 1}
+    pairs = [(index, new_index[rule]) for index, rule in enumerate(old_rules)
+             if old_counts[rule] == 1 and rule in new_index]
+    # longest increasing subsequence of the new indexes: tails[k] is the
+    # position in pairs of the smallest last new index of a subsequence of
+    # length k + 1
+    tails = []
+    tail_indexes = []
+    previous = [None] * len(pairs)
+    for position, (_old, new) in enumerate(pairs):
+        k = bisect.bisect_left(tail_indexes, new)
+        if k:
+            previous[position] = tails[k - 1]
+        if k == len(tails):
+            tails.append(position)
+            tail_indexes.append(new)
+        else:
+            tails[k] = position
+            tail_indexes[k] = new
+    matches = []
+    position = tails[-1] if tails else None
+    while position is not None:
+        matches.append(pairs[position])
+        position = previous[position]
+    matches.reverse()
+    return matches
+
+
+def _get_rules_diff(old_rules, new_rules):
+    """Return the changes to apply to old_rules to get new_rules.
+
+    The changes are a list of (removed rules, added rules, kept rules
+    count) tuples, to apply in order. The rules are compared by their
+    hash: the common prefix and suffix of the lists are kept first, which
+    handles rules only appended, inserted or removed in one place in linear
+    time. The rules found once in each of the remaining lists are then kept
+    in the longest sequence in which they appear in the same order, the
+    rules between them are removed and added.
+    """
+    start = 0
+    old_end, new_end = len(old_rules), len(new_rules)
+    while (start < old_end and start < new_end and
+           old_rules[start] == new_rules[start]):
+        start += 1
+    while (old_end > start and new_end > start and
+           old_rules[old_end - 1] == new_rules[new_end - 1]):
+        old_end -= 1
+        new_end -= 1
+    old_middle = old_rules[start:old_end]
+    new_middle = new_rules[start:new_end]
+    if not old_middle or not new_middle:
+        return [([], [], start), (old_middle, new_middle,
+                                  len(old_rules) - old_end)]
+
+    changes = [([], [], start)]
+    old_index = new_index = 0
+    for old_match, new_match in _match_unique_rules(old_middle, new_middle):
+        changes.append((old_middle[old_index:old_match],
+                        new_middle[new_index:new_match], 1))
+        old_index, new_index = old_match + 1, new_match + 1
+    changes.append((old_middle[old_index:], new_middle[new_index:],
+                    len(old_rules) - old_end))
+    return changes
+
+
 def _generate_chain_diff_iptables_commands(chain, old_chain_rules,
                                            new_chain_rules):
     # keep track of the old index because we have to insert rules
     # in the right position
     old_index = 1
     statements = []
-    for line in difflib.ndiff(old_chain_rules, new_chain_rules):
-        if line.startswith('?'):
-            # skip ? because that's a guide string for intraline differences
-            continue
-        if line.startswith('-'):  # line deleted
-            statements.append('-D %s %d' % (chain, old_index))
-            # since we are removing a line from the old rules, we
-            # backup the index by 1
-            old_index -= 1
-        elif line.startswith('+'):  # line added
+    for removed, added, kept in _get_rules_diff(old_chain_rules,
+                                                new_chain_rules):
+        # removing a line from the old rules shifts the following ones
+        statements += ['-D %s %d' % (chain, old_index)] * len(removed)
+        for line in added:
             # strip the chain name since we have to add it before the index
-            rule = line[5:].split(' ', 1)[-1]
+            rule = line[3:].split(' ', 1)[-1]
             # IptablesRule does not add trailing spaces for rules, so we
             # have to detect that here by making sure this chain isn't
             # referencing itself
@@ -875,5 +1050,6 @@ def _generate_chain_diff_iptables_commands(chain, old_chain_rules,
                 rule = ''
             # rule inserted at this position
             statements.append('-I %s %d %s' % (chain, old_index, rule))
-        old_index += 1
+            old_index += 1
+        old_index += kept
     return statements
@@ -73,6 +73,17 @@ def create_reg_numbers(flow_params):
         flow_params, ovsfw_consts.REG_REMOTE_GROUP, 'reg_remote_group')
 
 
+def get_flow_fingerprint(flow_params):
+    """Return the fingerprint of the match of a flow
+
+    Two flows with the same fingerprint only differ in their actions, hence
+    adding one of them replaces the other one in the bridge.
+    """
+    return tuple(sorted((key, str(value))
+                        for key, value in flow_params.items()
+                        if key != 'actions'))
+
+
 def get_segmentation_id_from_other_config(bridge, port_name):
     """Return segmentation_id stored in OVSDB other_config metadata.
 
@@ -389,6 +400,12 @@ class ConjIPFlowManager(object):
         self.conj_ids = collections.defaultdict(dict)
         self.flow_state = collections.defaultdict(
             lambda: collections.defaultdict(dict))
+        # Number of address flows installed for each remote group, indexed
+        # like:
+        #     self.flow_counts[vlan_tag][(direction, ethertype)][remote_id]
+        self.flow_counts = collections.defaultdict(dict)
+        self.compact_flows = (
+            cfg.CONF.SECURITYGROUP.compact_remote_group_flows)
 
     def _build_addr_conj_id_map(self, ethertype, sg_ag_conj_id_map):
         """Build a map of addr -> list of conj_ids."""
@@ -404,6 +421,57 @@ class ConjIPFlowManager(object):
                 addr_to_conj[addr].extend(conj_id_set)
         return addr_to_conj
 
+    @staticmethod
+    def _compact_addr_conj_id_map(addr_to_conj):
+        """Aggregate the addresses with the same conj_ids in CIDR prefixes.
+
+        The addresses sharing the same set of conj_ids, for instance the
+        members of remote groups with identical members, are merged into the
+        minimal list of CIDR prefixes, so a single flow matches all of them.
+        The "any" addresses are kept as they are because their flows can
+        also match the MAC address.
+        """
+        compacted = {}
+        ip_to_conj = collections.defaultdict(set)
+        for addr, conj_ids in addr_to_conj.items():
+            ip_cidr = netaddr.IPNetwork(addr[0]).cidr
+            if ip_cidr.prefixlen == 0:
+                compacted[addr] = conj_ids
+                continue
+            ip_to_conj[ip_cidr].update(conj_ids)
+
+        conj_to_ips = collections.defaultdict(list)
+        for ip_cidr, conj_ids in ip_to_conj.items():
+            conj_to_ips[frozenset(conj_ids)].append(ip_cidr)
+        for conj_ids, ip_cidrs in conj_to_ips.items():
+            for ip_cidr in netaddr.cidr_merge(ip_cidrs):
+                compacted[(str(ip_cidr), None)] = sorted(conj_ids)
+        return compacted
+
+    @staticmethod
+    def _count_flows(sg_ag_conj_id_map, addr_to_conj):
+        """Count the address flows installed for each remote group."""
+        conj_to_remote = {}
+        for remote_id, conj_id_set in sg_ag_conj_id_map.items():
+            for conj_id in conj_id_set:
+                conj_to_remote[conj_id] = remote_id
+
+        flow_counts = collections.Counter()
+        for conj_ids in addr_to_conj.values():
+            flow_counts.update({conj_to_remote[conj_id] for conj_id in conj_ids
+                                if conj_id in conj_to_remote})
+        return flow_counts
+
+    def _is_removed_ip(self, ip_cidr, removed_ips, removed_nets):
+        if ip_cidr in removed_ips:
+            return True
+        if not self.compact_flows:
+            return False
+        # The non-strict deletion of an aggregated prefix also deletes the
+        # flows of the more specific prefixes it contains.
+        ip_net = netaddr.IPNetwork(ip_cidr)
+        return any(ip_net in removed_net for removed_net in removed_nets)
+
     def _update_flows_for_vlan_subr(self, direction, ethertype, vlan_tag,
                                     flow_state, addr_to_conj,
                                     conj_id_to_remove):
@@ -425,6 +493,8 @@ class ConjIPFlowManager(object):
         # remote security groups and remote address groups
         removed_ips = set([str(netaddr.IPNetwork(addr[0]).cidr) for addr in (
                 set(flow_state.keys()) - set(addr_to_conj.keys()))])
+        removed_nets = ([netaddr.IPNetwork(ip) for ip in removed_ips]
+                        if self.compact_flows else [])
         ip_to_conj = collections.defaultdict(set)
         for addr, conj_ids in addr_to_conj.items():
             # Addresses from remote security groups have mac addresses,
@@ -440,7 +510,9 @@ class ConjIPFlowManager(object):
             # creation sequence.
             conj_ids = list(ip_to_conj[ip_cidr])
             conj_ids.sort()
-            if flow_state.get(addr) == conj_ids and ip_cidr not in removed_ips:
+            if (flow_state.get(addr) == conj_ids and
+                    not self._is_removed_ip(ip_cidr, removed_ips,
+                                            removed_nets)):
                 # When there are IP overlaps among remote security groups
                 # and remote address groups, removal of the overlapped ips
                 # from one remote group will also delete the flows for the
@@ -463,11 +535,38 @@ class ConjIPFlowManager(object):
             # no address overlaps.
             addr_to_conj = self._build_addr_conj_id_map(
                 ethertype, sg_ag_conj_id_map)
+            if self.compact_flows:
+                addr_to_conj = self._compact_addr_conj_id_map(addr_to_conj)
             self._update_flows_for_vlan_subr(
                 direction, ethertype, vlan_tag,
                 self.flow_state[vlan_tag][(direction, ethertype)],
                 addr_to_conj, conj_id_to_remove)
             self.flow_state[vlan_tag][(direction, ethertype)] = addr_to_conj
+            self.flow_counts[vlan_tag][(direction, ethertype)] = (
+                self._count_flows(sg_ag_conj_id_map, addr_to_conj))
+        LOG.debug("Remote group address flows on VLAN %(vlan_tag)s: "
+                  "%(flow_counts)s",
+                  {'vlan_tag': vlan_tag,
+                   'flow_counts': self.get_flow_counts(vlan_tag)})
+
+    def update_flows_for_remote_group(self, remote_id):
+        """Update the address flows of the VLANs using the remote group."""
+        for vlan_tag, vlan_conj_id_map in list(self.conj_ids.items()):
+            if any(remote_id in sg_ag_conj_id_map
+                   for sg_ag_conj_id_map in vlan_conj_id_map.values()):
+                self.update_flows_for_vlan(vlan_tag)
+
+    def get_flow_counts(self, vlan_tag=None):
+        """Return the number of address flows per remote group.
+
+        The flows of all the VLANs are counted if no vlan_tag is given.
+        """
+        vlan_tags = [vlan_tag] if vlan_tag is not None else self.flow_counts
+        flow_counts = collections.Counter()
+        for tag in vlan_tags:
+            for counts in self.flow_counts.get(tag, {}).values():
+                flow_counts.update(counts)
+        return dict(flow_counts)
 
     def add(self, vlan_tag, sg_id, remote_id, direction, ethertype,
             priority_offset):
@@ -549,6 +648,9 @@ class OVSFirewallDriver(firewall.FirewallDriver):
         self._initialize_sg()
         self._update_cookie = None
         self._deferred = False
+        self._recorded_flows = None
+        self._install_recorded_flows = True
+        self._modified_flows = 0
         self.iptables_helper = iptables.Helper(self.int_br.br)
         self.iptables_helper.load_driver_if_needed()
         self.ipconntrack = ip_conntrack.OvsIpConntrackManager()
@@ -568,6 +670,8 @@ class OVSFirewallDriver(firewall.FirewallDriver):
         self.sg_port_map = SGPortMap()
         self.conj_ip_manager = ConjIPFlowManager(self)
         self.sg_to_delete = set()
+        # Flows installed for each port, indexed by their fingerprint
+        self._port_flows = {}
 
     def _initialize_firewall(self):
         self._drop_all_unmatched_flows()
@@ -595,11 +699,41 @@ class OVSFirewallDriver(firewall.FirewallDriver):
         for f in rules.create_accept_flows(flow):
             self._add_flow(**f)
 
+    @contextlib.contextmanager
+    def _record_port_flows(self, install=True):
+        """Record the flows added in the context, indexed by fingerprint
+
+        If install is False, the flows are only recorded and not added to the
+        bridge.
+        """
+        recorded_flows = {}
+        self._recorded_flows = recorded_flows
+        self._install_recorded_flows = install
+        try:
+            yield recorded_flows
+        finally:
+            self._recorded_flows = None
+            self._install_recorded_flows = True
+
+    @contextlib.contextmanager
+    def _port_flows_recording_paused(self):
+        recording = self._recorded_flows, self._install_recorded_flows
+        self._recorded_flows = None
+        self._install_recorded_flows = True
+        try:
+            yield
+        finally:
+            self._recorded_flows, self._install_recorded_flows = recording
+
     def _add_flow(self, **kwargs):
         dl_type = kwargs.get('dl_type')
         create_reg_numbers(kwargs)
         if isinstance(dl_type, int):
             kwargs['dl_type'] = "0x{:04x}".format(dl_type)
+        if self._recorded_flows is not None:
+            self._recorded_flows[get_flow_fingerprint(kwargs)] = kwargs.copy()
+            if not self._install_recorded_flows:
+                return
         if self._update_cookie:
             kwargs['cookie'] = self._update_cookie
         if self._deferred:
@@ -779,7 +913,8 @@ class OVSFirewallDriver(firewall.FirewallDriver):
             old_of_port = self.get_ofport(port)
             of_port = self.get_or_create_ofport(port)
             if old_of_port:
-                self._update_flows_for_port(of_port, old_of_port)
+                self._update_flows_for_port(of_port, old_of_port,
+                                            incremental=True)
             else:
                 self._set_port_filters(of_port)
 
@@ -798,10 +933,54 @@ class OVSFirewallDriver(firewall.FirewallDriver):
                       'err': tag_not_found})
 
     def _set_port_filters(self, of_port):
-        self.initialize_port_flows(of_port)
-        self.add_flows_from_rules(of_port)
+        with self._record_port_flows() as port_flows:
+            self.initialize_port_flows(of_port)
+            self.add_flows_from_rules(of_port)
+        self._port_flows[of_port.id] = port_flows
+
+    def _update_port_flows(self, of_port, old_port_flows):
+        """Apply the differences with the flows previously set for the port
+
+        Only the flows that are not generated anymore from the port and its
+        security group rules are deleted, and only the new or modified flows
+        are added.
+        """
+        with self._record_port_flows(install=False) as port_flows:
+            self.initialize_port_flows(of_port)
+            self.add_flows_from_rules(of_port)
+
+        removed_flows = [flow for fingerprint, flow in old_port_flows.items()
+                         if fingerprint not in port_flows]
+        added_flows = [flow for fingerprint, flow in port_flows.items()
+                       if old_port_flows.get(fingerprint) != flow]
+        # Make before break: the new and modified flows are installed before
+        # the flows not generated anymore are deleted. The strict deletes are
+        # applied right away, so the flows queued in the deferred bridge are
+        # flushed first, as in _update_flows_for_port(). A strict delete only
+        # matches a flow with the same fingerprint, so it never deletes one
+        # of the added flows.
+        for flow in added_flows:
+            self._add_flow(**flow)
+        self.int_br.apply_flows()
+        for flow in removed_flows:
+            flow = flow.copy()
+            del flow['actions']
+            self._strict_delete_flow(**flow)
+        self._port_flows[of_port.id] = port_flows
+
+        self._modified_flows += len(removed_flows) + len(added_flows)
+        LOG.debug("Updated flows of port %(port_id)s: %(added)d flows added "
+                  "or modified, %(removed)d flows deleted",
+                  {'port_id': of_port.id, 'added': len(added_flows),
+                   'removed': len(removed_flows)})
+
+    def _update_flows_for_port(self, of_port, old_of_port, incremental=False):
+        old_port_flows = self._port_flows.get(of_port.id)
+        if (incremental and of_port is old_of_port and
+                old_port_flows is not None):
+            self._update_port_flows(of_port, old_port_flows)
+            return
 
-    def _update_flows_for_port(self, of_port, old_of_port):
         with self.update_cookie_context():
             self._set_port_filters(of_port)
         # Flush the flows caused by changes made to deferred bridge. The reason
@@ -825,6 +1004,7 @@ class OVSFirewallDriver(firewall.FirewallDriver):
         if self.is_port_managed(port):
             of_port = self.get_ofport(port)
             self.delete_all_port_flows(of_port)
+            self._port_flows.pop(of_port.id, None)
             self.sg_port_map.remove_port(of_port)
             for sec_group in of_port.sec_groups:
                 self._schedule_sg_deletion_maybe(sec_group.id)
@@ -837,6 +1017,42 @@ class OVSFirewallDriver(firewall.FirewallDriver):
         if not member_ips:
             self._schedule_sg_deletion_maybe(sg_id)
 
+    def update_security_group_members_delta(self, sg_id, added, removed):
+        """Update the members and the address flows of a remote group.
+
+        The flows of the ports using the group are not modified, only the
+        conjunction flows matching the group addresses are. A group unknown
+        or without members may have been deleted with its conjunction ids,
+        so the ports using it are refreshed instead.
+        """
+        sec_group = self.sg_port_map.get_sg(sg_id)
+        if not sec_group or not any(sec_group.members.values()):
+            return False
+        old_members = {ethertype: set(addresses) for ethertype, addresses
+                       in sec_group.members.items()}
+        members = {ethertype: set(addresses)
+                   for ethertype, addresses in old_members.items()}
+        for ethertype, addresses in removed.items():
+            members.get(ethertype, set()).difference_update(addresses)
+        for ethertype, addresses in added.items():
+            members.setdefault(ethertype, set()).update(addresses)
+        if members == old_members:
+            return True
+        # the emptied ethertypes are kept, as update_security_group_members
+        # schedules the deletion of a group without any ethertype
+        members = {ethertype: list(addresses)
+                   for ethertype, addresses in members.items()}
+        deferred = self._deferred
+        if not deferred:
+            self.filter_defer_apply_on()
+        try:
+            self.update_security_group_members(sg_id, members)
+            self.conj_ip_manager.update_flows_for_remote_group(sg_id)
+        finally:
+            if not deferred:
+                self.filter_defer_apply_off()
+        return True
+
     def _schedule_sg_deletion_maybe(self, sg_id):
         """Schedule possible deletion of the given SG.
 
@@ -879,12 +1095,15 @@ class OVSFirewallDriver(firewall.FirewallDriver):
 
     def filter_defer_apply_on(self):
         self._deferred = True
+        self._modified_flows = 0
 
     def filter_defer_apply_off(self):
         if self._deferred:
             self._cleanup_stale_sg()
             self.int_br.apply_flows()
             self._deferred = False
+            LOG.debug("Firewall refresh modified %d port flows",
+                      self._modified_flows)
 
     @property
     def ports(self):
@@ -1569,7 +1788,10 @@ class OVSFirewallDriver(firewall.FirewallDriver):
 
         self._add_non_ip_conj_flows(port)
 
-        self.conj_ip_manager.update_flows_for_vlan(port.vlan_tag)
+        # The flows of the remote group addresses are shared by all the ports
+        # of the network, they are not part of the flows of the port.
+        with self._port_flows_recording_paused():
+            self.conj_ip_manager.update_flows_for_vlan(port.vlan_tag)
 
     def _create_rules_generator_for_port(self, port):
         for sec_group in port.sec_groups:
@@ -12,6 +12,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import sys
+
 from neutron_lib.callbacks import events
 from neutron_lib.callbacks import registry
 from neutron_lib import context as n_ctx
@@ -23,20 +26,142 @@ from neutron.api.rpc.callbacks.consumer import registry as registry_rpc
 from neutron.api.rpc.callbacks import events as events_rpc
 from neutron.api.rpc.handlers import resources_rpc
 from neutron import objects
+from neutron.objects import base as objects_base
 
 LOG = logging.getLogger(__name__)
 objects.register_objects()
 
+# Fields of the cached resources indexed to answer the get_resources queries
+# without checking every cached resource of the type.
+INDEXED_FIELDS = {
+    'Port': ('security_group_ids', 'network_id', 'device_owner'),
+    'SecurityGroupRule': ('security_group_id', 'remote_group_id',
+                          'remote_address_group_id'),
+}
+
+# Number of objects built from the compact records which are kept, per
+# resource type, so the resources read again are not built again.
+LOADED_CACHE_SIZE = 4096
+
+_OBJ_NAME = 'versioned_object.name'
+_OBJ_NAMESPACE = 'versioned_object.namespace'
+_OBJ_VERSION = 'versioned_object.version'
+_OBJ_DATA = 'versioned_object.data'
+
+
+class CompactResource(object):
+    """Read-only compact record of a versioned object.
+
+    The fields are stored in their primitive form, in a tuple ordered like
+    the field names of the record. The strings, like UUIDs, MAC addresses
+    and device owners, are interned and the object names, versions and field
+    names are shared by all the records with the same layout.
+
+    The fields can be read as attributes of the record, in their primitive
+    form. materialize() builds the versioned object again.
+    """
+
+    __slots__ = ('_layout', '_values')
+
+    # Shared (name, namespace, version, field names) tuples
+    _layouts = {}
+
+    def __init__(self, layout, values):
+        self._layout = self._layouts.setdefault(layout, layout)
+        self._values = values
+
+    @classmethod
+    def from_object(cls, obj):
+        return cls._compact(obj.obj_to_primitive())
+
+    @classmethod
+    def _compact(cls, primitive):
+        if isinstance(primitive, str):
+            return sys.intern(primitive)
+        if isinstance(primitive, (list, tuple)):
+            return tuple(cls._compact(value) for value in primitive)
+        if not isinstance(primitive, dict):
+            return primitive
+        if _OBJ_NAME not in primitive:
+            return {sys.intern(key): cls._compact(value)
+                    for key, value in primitive.items()}
+        data = primitive[_OBJ_DATA]
+        field_names = tuple(sys.intern(name) for name in sorted(data))
+        layout = (primitive[_OBJ_NAME], primitive[_OBJ_NAMESPACE],
+                  primitive[_OBJ_VERSION], field_names)
+        return cls(layout,
+                   tuple(cls._compact(data[name]) for name in field_names))
+
+    def __getattr__(self, name):
+        # NOTE: the private and special attributes are never fields, and
+        # looking them up in the layout would recurse while the record is
+        # copied or unpickled, before _layout is set.
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._values[self._layout[3].index(name)]
+        except ValueError:
+            raise AttributeError(name)
+
+    def to_primitive(self):
+        name, namespace, version, field_names = self._layout
+        return {_OBJ_NAME: name,
+                _OBJ_NAMESPACE: namespace,
+                _OBJ_VERSION: version,
+                _OBJ_DATA: {field_name: self._to_primitive(value)
+                            for field_name, value in zip(field_names,
+                                                         self._values)}}
+
+    @classmethod
+    def _to_primitive(cls, value):
+        if isinstance(value, CompactResource):
+            return value.to_primitive()
+        if isinstance(value, tuple):
+            return [cls._to_primitive(item) for item in value]
+        if isinstance(value, dict):
+            return {key: cls._to_primitive(item)
+                    for key, item in value.items()}
+        return value
+
+    def materialize(self):
+        """Returns a new versioned object with the fields of the record."""
+        return objects_base.NeutronObject.obj_from_primitive(
+            self.to_primitive())
+
 
 class RemoteResourceCache(object):
     """Retrieves and stashes logical resources in their OVO format.
 
     This is currently only compatible with OVO objects that have an ID.
+
+    The fields listed in indexes (INDEXED_FIELDS by default) for each resource
+    type are indexed, so get_resources queries filtering on them only check
+    the resources with matching values.
+
+    If compact is True, the resources are stored as CompactResource records,
+    the filters are matched against the records and an OVO is only built
+    when a resource is returned. The last loaded_cache_size OVOs built for
+    each resource type are kept until their resource is updated or deleted.
     """
-    def __init__(self, resource_types):
+    def __init__(self, resource_types, indexes=None, compact=False,
+                 loaded_cache_size=LOADED_CACHE_SIZE):
         self.resource_types = resource_types
+        self._compact = compact
+        self._loaded_cache_size = loaded_cache_size
         self._cache_by_type_and_id = {rt: {} for rt in self.resource_types}
+        # OVOs built from the compact records, least recently used first
+        self._loaded_by_type_and_id = {
+            rt: collections.OrderedDict() for rt in self.resource_types}
         self._deleted_ids_by_type = {rt: set() for rt in self.resource_types}
+        indexes = INDEXED_FIELDS if indexes is None else indexes
+        # self._indexes[rtype][field][value] is the set of IDs of the
+        # resources of type rtype with value in field
+        self._indexes = {
+            rt: {field: collections.defaultdict(set)
+                 for field in indexes.get(rt, ())}
+            for rt in self.resource_types}
+        self.index_hits = collections.Counter()
+        self.index_misses = collections.Counter()
         # track everything we've asked the server so we don't ask again
         self._satisfied_server_queries = set()
         self._puller = resources_rpc.ResourcesPullRpcApi()
@@ -46,6 +171,79 @@ class RemoteResourceCache(object):
             raise RuntimeError(_("Resource cache not tracking %s") % rtype)
         return self._cache_by_type_and_id[rtype]
 
+    def _store(self, resource):
+        if self._compact:
+            return CompactResource.from_object(resource)
+        return resource
+
+    def _load(self, rtype, cached_item):
+        if not isinstance(cached_item, CompactResource):
+            return cached_item
+        loaded = self._loaded_by_type_and_id[rtype]
+        resource = loaded.get(cached_item.id)
+        if resource is not None:
+            loaded.move_to_end(cached_item.id)
+            return resource
+        resource = cached_item.materialize()
+        if self._loaded_cache_size:
+            loaded[cached_item.id] = resource
+            if len(loaded) > self._loaded_cache_size:
+                loaded.popitem(last=False)
+        return resource
+
+    def _unload(self, rtype, obj_id):
+        self._loaded_by_type_and_id[rtype].pop(obj_id, None)
+
+    @staticmethod
+    def _get_index_values(resource, field):
+        value = getattr(resource, field, None)
+        if isinstance(value, (list, tuple, set, frozenset)):
+            return set(value)
+        return {value}
+
+    def _index_resource(self, rtype, resource):
+        for field, index in self._indexes[rtype].items():
+            for value in self._get_index_values(resource, field):
+                index[value].add(resource.id)
+
+    def _unindex_resource(self, rtype, resource):
+        for field, index in self._indexes[rtype].items():
+            for value in self._get_index_values(resource, field):
+                ids = index.get(value)
+                if ids is None:
+                    continue
+                ids.discard(resource.id)
+                if not ids:
+                    del index[value]
+
+    def _get_indexed_ids(self, rtype, filters):
+        """Returns the IDs of the resources that can match the filters.
+
+        None is returned if none of the filtered fields is indexed.
+        """
+        indexes = self._indexes.get(rtype, {})
+        candidates = None
+        for key, values in filters.items():
+            index = indexes.get(key)
+            if index is None:
+                continue
+            ids = set()
+            for value in values:
+                ids |= index.get(value, set())
+            if candidates is None or len(ids) < len(candidates):
+                candidates = ids
+        return candidates
+
+    def get_index_stats(self):
+        """Returns the index hits and misses of get_resources per type.
+
+        A query is a hit if it was answered using the indexes, and a miss if
+        all the cached resources of the type had to be checked.
+        """
+        return {rt: {'hits': self.index_hits[rt],
+                     'misses': self.index_misses[rt]}
+                for rt in self.resource_types}
+
     def start_watcher(self):
         self._watcher = RemoteResourceWatcher(self)
 
@@ -55,11 +253,11 @@ class RemoteResourceCache(object):
             return None
         cached_item = self._type_cache(rtype).get(obj_id)
         if cached_item:
-            return cached_item
+            return self._load(rtype, cached_item)
         # try server in case object existed before agent start
         self._flood_cache_for_query(rtype, id=(obj_id, ),
                                     agent_restarted=agent_restarted)
-        return self._type_cache(rtype).get(obj_id)
+        return self._load(rtype, self._type_cache(rtype).get(obj_id))
 
     def _flood_cache_for_query(self, rtype, agent_restarted=False,
                                **filter_kwargs):
@@ -112,7 +310,7 @@ class RemoteResourceCache(object):
             query_ids.add((rtype, ) + tuple(sorted(filters.items())))
         return query_ids
 
-    def get_resources(self, rtype, filters):
+    def get_resources(self, rtype, filters, load=True):
         """Find resources that match key:values in filters dict.
 
         If the attribute on the object is a list, each value is checked if it
@@ -120,6 +318,10 @@ class RemoteResourceCache(object):
 
         The values in the dicionary for a single key are matched in an OR
         fashion.
+
+        With load=False, the cached items are returned as stored, i.e. as
+        compact records when the cache is compact: their fields can only be
+        read, in their primitive form, but no object is built for them.
         """
         self._flood_cache_for_query(rtype, **filters)
 
@@ -138,13 +340,29 @@ class RemoteResourceCache(object):
                     # no match found for this key
                     return False
             return True
-        return self.match_resources_with_func(rtype, match)
+
+        type_cache = self._type_cache(rtype)
+        candidates = self._get_indexed_ids(rtype, filters)
+        if candidates is None:
+            self.index_misses[rtype] += 1
+            cached_items = type_cache.values()
+        else:
+            self.index_hits[rtype] += 1
+            cached_items = (type_cache[obj_id] for obj_id in candidates)
+        # NOTE: the filters are matched against the cached items, which can
+        # be compact records, and only the matching resources are loaded.
+        if not load:
+            return [cached_item for cached_item in cached_items
+                    if match(cached_item)]
+        return [self._load(rtype, cached_item) for cached_item in cached_items
+                if match(cached_item)]
 
     def match_resources_with_func(self, rtype, matcher):
         """Returns a list of all resources satisfying func matcher."""
         # TODO(kevinbenton): this is O(N), offer better lookup functions
-        return [r for r in self._type_cache(rtype).values()
-                if matcher(r)]
+        resources = (self._load(rtype, cached_item)
+                     for cached_item in self._type_cache(rtype).values())
+        return [r for r in resources if matcher(r)]
 
     def _is_stale(self, rtype, resource):
         """Determines if a given resource update is safe to ignore.
@@ -175,7 +393,13 @@ class RemoteResourceCache(object):
             LOG.debug("Ignoring stale update for %s: %s", rtype, resource)
             return
         existing = self._type_cache(rtype).get(resource.id)
-        self._type_cache(rtype)[resource.id] = resource
+        cached_item = self._store(resource)
+        self._type_cache(rtype)[resource.id] = cached_item
+        if existing:
+            self._unindex_resource(rtype, existing)
+            existing = self._load(rtype, existing)
+            self._unload(rtype, resource.id)
+        self._index_resource(rtype, cached_item)
         changed_fields = self._get_changed_fields(existing, resource)
         if not changed_fields:
             LOG.debug("Received resource %s update without any changes: %s",
@@ -210,6 +434,10 @@ class RemoteResourceCache(object):
             return
         self._deleted_ids_by_type[rtype].add(resource_id)
         existing = self._type_cache(rtype).pop(resource_id, None)
+        if existing:
+            self._unindex_resource(rtype, existing)
+            existing = self._load(rtype, existing)
+            self._unload(rtype, resource_id)
         # local notification for agent internals to subscribe to
         registry.publish(rtype, events.AFTER_DELETE, self,
                          payload=events.DBEventPayload(
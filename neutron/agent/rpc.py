@@ -126,6 +126,8 @@ class PluginApi(object):
               - update_device_up
               - update_device_list (indirectly, called from update_device_down
                 and update_device_up)
+        1.10 - tunnel_sync accepts a tunnels_version token and only returns
+               the tunnel endpoints if they changed since that version
     '''
 
     def __init__(self, topic):
@@ -201,10 +203,16 @@ class PluginApi(object):
                 'devices_down': ret_devices_down,
                 'failed_devices_down': failed_devices_down}
 
-    def tunnel_sync(self, context, tunnel_ip, tunnel_type=None, host=None):
-        cctxt = self.client.prepare(version='1.4')
+    def tunnel_sync(self, context, tunnel_ip, tunnel_type=None, host=None,
+                    tunnels_version=None):
+        if tunnels_version is None:
+            cctxt = self.client.prepare(version='1.4')
+            return cctxt.call(context, 'tunnel_sync', tunnel_ip=tunnel_ip,
+                              tunnel_type=tunnel_type, host=host)
+        cctxt = self.client.prepare(version='1.10')
         return cctxt.call(context, 'tunnel_sync', tunnel_ip=tunnel_ip,
-                          tunnel_type=tunnel_type, host=host)
+                          tunnel_type=tunnel_type, host=host,
+                          tunnels_version=tunnels_version)
 
     def get_ports_by_vnic_type_and_host(self, context, vnic_type, host):
         cctxt = self.client.prepare(version='1.7')
@@ -221,10 +229,10 @@ class CacheBackedPluginApi(PluginApi):
                       resources.SUBNET,
                       resources.ADDRESSGROUP]
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, compact_cache=False, **kwargs):
         super(CacheBackedPluginApi, self).__init__(*args, **kwargs)
         self.remote_resource_cache = None
-        self._create_cache_for_l2_agent()
+        self._create_cache_for_l2_agent(compact=compact_cache)
 
     def register_legacy_notification_callbacks(self, legacy_interface):
         """Emulates the server-side notifications from ml2 AgentNotifierApi.
@@ -391,10 +399,11 @@ class CacheBackedPluginApi(PluginApi):
         return [self.get_device_details(context, device, agent_id, host)
                 for device in devices]
 
-    def _create_cache_for_l2_agent(self):
+    def _create_cache_for_l2_agent(self, compact=False):
         """Create a push-notifications cache for L2 agent related resources."""
         objects.register_objects()
-        rcache = resource_cache.RemoteResourceCache(self.RESOURCE_TYPES)
+        rcache = resource_cache.RemoteResourceCache(self.RESOURCE_TYPES,
+                                                    compact=compact)
         rcache.start_watcher()
         self.remote_resource_cache = rcache
 
@@ -15,6 +15,7 @@
 #
 
 import functools
+import time
 
 from neutron_lib.api.definitions import rbac_address_groups as rbac_ag_apidef
 from neutron_lib.api.definitions import rbac_security_groups as rbac_sg_apidef
@@ -128,6 +129,16 @@ class SecurityGroupAgentRpc(object):
         # Stores devices for which firewall should be refreshed when
         # deferred refresh is enabled.
         self.devices_to_refilter = set()
+        # Time of the first update not yet refreshed, the updates received
+        # during refresh_debounce_interval are refreshed together.
+        self.refresh_debounce_interval = (
+            cfg.CONF.SECURITYGROUP.refresh_debounce_interval)
+        self._refilter_pending_since = None
+        # Addresses added to and removed from the remote security groups,
+        # applied to the firewall with the deferred refresh.
+        self._pending_member_deltas = {}
+        self.updates_received = 0
+        self.refreshes_performed = 0
 
     def skip_if_noopfirewall_or_firewall_disabled(func):
         @functools.wraps(func)
@@ -208,8 +219,63 @@ class SecurityGroupAgentRpc(object):
             'security_group_source_groups',
             'sg_member')
 
+    def security_groups_member_delta(self, member_deltas):
+        """Apply the addresses added to and removed from security groups.
+
+        :param member_deltas: dict of (added, removed) tuples keyed by
+            security group ID, added and removed being dicts of sets of
+            (ip, mac) tuples keyed by ethertype
+        """
+        LOG.info("Security group member delta %r", list(member_deltas))
+        self._security_group_member_delta(member_deltas)
+
+    @_port_filter_wait
+    def _security_group_member_delta(self, member_deltas):
+        self.updates_received += 1
+        remote_sg_ids = set()
+        for device in self.firewall.ports.values():
+            remote_sg_ids.update(
+                device.get('security_group_source_groups', []))
+        member_deltas = {sg_id: delta
+                         for sg_id, delta in member_deltas.items()
+                         if sg_id in remote_sg_ids}
+        if not member_deltas:
+            return
+        if not self.defer_refresh_firewall:
+            self._apply_member_deltas(member_deltas)
+            return
+        LOG.debug("Adding member changes of security groups %s to the list "
+                  "of changes to apply to the firewall", list(member_deltas))
+        for sg_id, (added, removed) in member_deltas.items():
+            pending_added, pending_removed = (
+                self._pending_member_deltas.setdefault(sg_id, ({}, {})))
+            for ethertype, addresses in removed.items():
+                pending_added.get(ethertype, set()).difference_update(
+                    addresses)
+                pending_removed.setdefault(ethertype, set()).update(addresses)
+            for ethertype, addresses in added.items():
+                pending_removed.get(ethertype, set()).difference_update(
+                    addresses)
+                pending_added.setdefault(ethertype, set()).update(addresses)
+        if self._refilter_pending_since is None:
+            self._refilter_pending_since = time.monotonic()
+
+    def _apply_member_deltas(self, member_deltas):
+        """Apply the member changes, refresh the ports if not supported"""
+        refresh_sg_ids = [
+            sg_id for sg_id, (added, removed) in member_deltas.items()
+            if not self.firewall.update_security_group_members_delta(
+                sg_id, added, removed)]
+        if refresh_sg_ids:
+            LOG.debug("Firewall can't apply the member changes of security "
+                      "groups %s, refreshing their ports", refresh_sg_ids)
+            self._security_group_updated(refresh_sg_ids,
+                                         'security_group_source_groups',
+                                         'sg_member')
+
     @_port_filter_wait
     def _security_group_updated(self, security_groups, attribute, action_type):
+        self.updates_received += 1
         devices = []
         sec_grp_set = set(security_groups)
         for device in self.firewall.ports.values():
@@ -222,6 +288,8 @@ class SecurityGroupAgentRpc(object):
                           "for which firewall needs to be refreshed",
                           devices)
                 self.devices_to_refilter |= set(devices)
+                if self._refilter_pending_since is None:
+                    self._refilter_pending_since = time.monotonic()
             else:
                 self.refresh_firewall(devices)
 
@@ -261,8 +329,24 @@ class SecurityGroupAgentRpc(object):
                 return
         self._apply_port_filter(device_ids, update_filter=True)
 
+    def _refresh_window_elapsed(self):
+        if (not self.refresh_debounce_interval or
+                self._refilter_pending_since is None):
+            return True
+        return (time.monotonic() - self._refilter_pending_since >=
+                self.refresh_debounce_interval)
+
     def firewall_refresh_needed(self):
-        return bool(self.devices_to_refilter)
+        return ((bool(self.devices_to_refilter) or
+                 bool(self._pending_member_deltas)) and
+                self._refresh_window_elapsed())
+
+    def get_refresh_stats(self):
+        """Return the number of updates received and refreshes performed"""
+        return {'updates_received': self.updates_received,
+                'refreshes_performed': self.refreshes_performed,
+                'devices_pending': len(self.devices_to_refilter),
+                'member_deltas_pending': len(self._pending_member_deltas)}
 
     def setup_port_filters(self, new_devices, updated_devices):
         """Configure port filters for devices.
@@ -275,10 +359,28 @@ class SecurityGroupAgentRpc(object):
         :param updated_devices: set containing identifiers for
         updated devices
         """
+        if self._pending_member_deltas and self._refresh_window_elapsed():
+            member_deltas = self._pending_member_deltas
+            self._pending_member_deltas = {}
+            LOG.debug("Applying member changes of %d security groups",
+                      len(member_deltas))
+            # The devices using the groups whose changes can't be applied
+            # are added to self.devices_to_refilter
+            self._apply_member_deltas(member_deltas)
         # These data structures are cleared here in order to avoid
         # losing updates occurring during firewall refresh
-        devices_to_refilter = self.devices_to_refilter
-        self.devices_to_refilter = set()
+        if self._refresh_window_elapsed():
+            devices_to_refilter = self.devices_to_refilter
+            self.devices_to_refilter = set()
+            self._refilter_pending_since = None
+        else:
+            # The pending updates are kept until the end of the debounce
+            # window, except for the devices processed now anyway
+            devices_to_refilter = set()
+            self.devices_to_refilter -= new_devices | updated_devices
+            if not (self.devices_to_refilter or
+                    self._pending_member_deltas):
+                self._refilter_pending_since = None
         # We must call prepare_devices_filter() after we've grabbed
         # self.devices_to_refilter since an update for a new port
         # could arrive while we're processing, and we need to make
@@ -298,3 +400,8 @@ class SecurityGroupAgentRpc(object):
             LOG.debug("Refreshing firewall for %d devices",
                       len(updated_devices))
             self.refresh_firewall(updated_devices)
+            self.refreshes_performed += 1
+            LOG.debug("Security group updates received: %(updates)d, "
+                      "firewall refreshes performed: %(refreshes)d",
+                      {'updates': self.updates_received,
+                       'refreshes': self.refreshes_performed})
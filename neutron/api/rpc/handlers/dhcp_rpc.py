@@ -74,10 +74,11 @@ class DhcpRpcCallback(object):
     #     1.7 - Add get_networks
     #     1.8 - Add get_dhcp_port
     #     1.9 - get_network_info returns info with only DHCP enabled subnets
+    #     1.10 - Add get_changed_networks_info
 
     target = oslo_messaging.Target(
         namespace=constants.RPC_NAMESPACE_DHCP_PLUGIN,
-        version='1.9')
+        version='1.10')
 
     def _get_active_networks(self, context, **kwargs):
         """Retrieve and return a list of the active networks."""
@@ -207,6 +208,28 @@ class DhcpRpcCallback(object):
 
         return networks
 
+    def get_changed_networks_info(self, context, **kwargs):
+        """Returns the networks/subnets/ports that changed in the system.
+
+        The network_revisions argument maps the id of each network cached by
+        the agent to its revision, as computed by
+        utils.get_dhcp_network_revision. Only the active networks whose
+        revision differs from the one cached, or that are not cached, are
+        returned in full, along with the ids of all the active networks.
+        """
+        network_revisions = kwargs.pop('network_revisions', None) or {}
+        networks = self.get_active_networks_info(context, **kwargs)
+        changed_networks = [
+            network for network in networks
+            if (network_revisions.get(network['id']) !=
+                utils.get_dhcp_network_revision(network))]
+        LOG.debug('%(changed)d of the %(total)d networks of %(host)s '
+                  'changed', {'changed': len(changed_networks),
+                              'total': len(networks),
+                              'host': kwargs.get('host')})
+        return {'networks': changed_networks,
+                'network_ids': [network['id'] for network in networks]}
+
     def get_network_info(self, context, **kwargs):
         """Retrieve and return information about a network.
 
@@ -14,6 +14,7 @@
 
 import collections
 
+import netaddr
 from neutron_lib.agent import topics
 from neutron_lib.callbacks import events
 from neutron_lib.callbacks import registry
@@ -319,23 +320,67 @@ class SecurityGroupServerAPIShim(sg_rpc_base.SecurityGroupInfoAPIMixin):
     def _handle_sg_member_delete(self, rtype, event, trigger, payload):
         # received on port delete
         existing = payload.states[0]
-        sgs = set(existing.security_group_ids) if existing else set()
-        if sgs:
-            self._sg_agent.security_groups_member_updated(sgs)
+        if not existing:
+            return
+        member_deltas = self._get_member_deltas(existing, None)
+        if member_deltas:
+            self._sg_agent.security_groups_member_delta(member_deltas)
 
     def _handle_sg_member_update(self, rtype, event, trigger, payload):
         # received on port update
         existing = payload.states[0]
         updated = payload.latest_state
         changed_fields = payload.metadata['changed_fields']
-        sgs = set(existing.security_group_ids) if existing else set()
         if not changed_fields.intersection({'security_group_ids', 'fixed_ips',
                                             'allowed_address_pairs'}):
             # none of the relevant fields to SG calculations changed
             return
-        sgs.update(set(updated.security_group_ids))
-        if sgs:
-            self._sg_agent.security_groups_member_updated(sgs)
+        member_deltas = self._get_member_deltas(existing, updated)
+        if member_deltas:
+            self._sg_agent.security_groups_member_delta(member_deltas)
+
+    @staticmethod
+    def _get_port_member_ips(port):
+        # NOTE: port can be a cached record of the port, whose fields are in
+        # their primitive form, so the addresses are always read as strings.
+        allowed_ips = [(str(addr.ip_address), str(addr.mac_address))
+                       for addr in port.allowed_address_pairs]
+        return set([(str(addr.ip_address), str(port.mac_address))
+                    for addr in port.fixed_ips] + allowed_ips)
+
+    def _get_member_deltas(self, existing, updated):
+        """Return the addresses added to and removed from the port groups.
+
+        The result is a dict of (added, removed) tuples keyed by security
+        group ID, added and removed being dicts of sets of (ip, mac) tuples
+        keyed by ethertype. The addresses removed from a port but still used
+        by other ports of a group are not removed from the group.
+        """
+        port = existing or updated
+        old_ips = self._get_port_member_ips(existing) if existing else set()
+        new_ips = self._get_port_member_ips(updated) if updated else set()
+        old_sgs = set(existing.security_group_ids) if existing else set()
+        new_sgs = set(updated.security_group_ids) if updated else set()
+        member_deltas = {}
+        for sg_id in old_sgs | new_sgs:
+            sg_old_ips = old_ips if sg_id in old_sgs else set()
+            sg_new_ips = new_ips if sg_id in new_sgs else set()
+            removed_ips = sg_old_ips - sg_new_ips
+            if removed_ips:
+                filters = {'security_group_ids': (sg_id, )}
+                for other_port in self.rcache.get_resources(
+                        'Port', filters, load=False):
+                    if other_port.id != port.id:
+                        removed_ips -= self._get_port_member_ips(other_port)
+            added, removed = {}, {}
+            for ips, by_ethertype in ((sg_new_ips - sg_old_ips, added),
+                                      (removed_ips, removed)):
+                for ip in ips:
+                    ethertype = 'IPv%d' % netaddr.IPNetwork(ip[0]).version
+                    by_ethertype.setdefault(ethertype, set()).add(ip)
+            if added or removed:
+                member_deltas[sg_id] = (added, removed)
+        return member_deltas
 
     def _handle_address_group_event(self, rtype, event, trigger, payload):
         resource_id = payload.resource_id
@@ -379,14 +424,11 @@ class SecurityGroupServerAPIShim(sg_rpc_base.SecurityGroupInfoAPIMixin):
         ips_by_group = {rg: set() for rg in remote_group_ids}
 
         filters = {'security_group_ids': tuple(remote_group_ids)}
-        for p in self.rcache.get_resources('Port', filters):
-            allowed_ips = [(str(addr.ip_address), str(addr.mac_address))
-                           for addr in p.allowed_address_pairs]
-            port_ips = [(str(addr.ip_address), str(p.mac_address))
-                        for addr in p.fixed_ips] + allowed_ips
+        for p in self.rcache.get_resources('Port', filters, load=False):
+            port_ips = self._get_port_member_ips(p)
             for sg_id in p.security_group_ids:
                 if sg_id in ips_by_group:
-                    ips_by_group[sg_id].update(set(port_ips))
+                    ips_by_group[sg_id].update(port_ips)
         return ips_by_group
 
     def _select_ips_for_remote_address_group(self, context,
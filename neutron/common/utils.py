@@ -19,6 +19,7 @@
 """Utilities and helper functions."""
 
 import functools
+import hashlib
 import importlib
 import os
 import os.path
@@ -145,6 +146,26 @@ def get_dhcp_agent_device_id(network_id, host):
     return 'dhcp%s-%s' % (host_uuid, network_id)
 
 
+def get_dhcp_network_revision(network):
+    """Returns the revision of a network as seen by the DHCP agents.
+
+    The revision is a digest of the revision numbers of the network, of its
+    DHCP enabled subnets and of its ports. The server and the DHCP agents
+    compute it from the network info they hold, either a dict or a
+    DictModel, to tell whether the network cached by an agent is up to date.
+    """
+    def get_revisions(resources):
+        return sorted((resource['id'], resource.get('revision_number'))
+                      for resource in resources
+                      if resource.get('enable_dhcp', True))
+
+    revisions = (network['id'], network.get('revision_number'),
+                 get_revisions(network.get('subnets', [])),
+                 get_revisions(network.get('non_local_subnets', [])),
+                 get_revisions(network.get('ports', [])))
+    return hashlib.sha256(repr(revisions).encode()).hexdigest()
+
+
 class exception_logger(object):
     """Wrap a function and log raised exception
 
@@ -135,6 +135,32 @@ IPTABLES_OPTS = [
                        "of iptables-save. This option should not be turned "
                        "on for production systems because it imposes a "
                        "performance penalty.")),
+    cfg.StrOpt('iptables_backend', default='iptables',
+               choices=['iptables', 'nft'],
+               help=_("Backend used to apply iptables rules. 'iptables' "
+                      "runs the iptables, iptables-save and iptables-restore "
+                      "commands installed on the system and inserts or "
+                      "deletes rules by position. 'nft' runs the iptables-nft "
+                      "commands, i.e. iptables-nft with chain replace: the "
+                      "rules are still read with iptables-nft-save and "
+                      "diffed, but every non built-in chain that changed "
+                      "is flushed and filled again in a single "
+                      "transaction, which avoids the rule lookups that "
+                      "positional changes require with nftables. This is "
+                      "not a native nftables backend. Note that replacing "
+                      "a chain resets the counters of its rules, the "
+                      "built-in chains are still changed by position and "
+                      "keep their counters.")),
+    cfg.IntOpt('iptables_resync_interval', default=0, min=0,
+               help=_("Seconds during which the rules last applied are "
+                      "trusted to match the rules in the kernel. Within "
+                      "that interval, the changes to apply are computed "
+                      "from them instead of reading the rules back with "
+                      "iptables-save, which is run again once the interval "
+                      "elapses or after an apply failure. Only enable it "
+                      "when no other program changes the iptables rules of "
+                      "the namespaces managed by the agent. 0 reads the "
+                      "rules on every apply.")),
 ]
 
 PROCESS_MONITOR_OPTS = [
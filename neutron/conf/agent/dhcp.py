@@ -36,6 +36,16 @@ DHCP_AGENT_OPTS = [
                       "events. Otherwise the resync may end up in a "
                       "busy-loop. The value must be less than "
                       "resync_interval.")),
+    cfg.BoolOpt('resync_by_revision', default=False,
+                help=_("Only fetch and reconfigure the networks that changed "
+                       "when the DHCP agent resyncs its state with Neutron. "
+                       "The agent sends the revision of each network it has "
+                       "cached and the server only returns the networks "
+                       "whose revision, a digest of the revision numbers of "
+                       "the network, its subnets and its ports, differs. "
+                       "The networks whose resync was requested are always "
+                       "reconfigured. Requires a Neutron server supporting "
+                       "version 1.10 of the DHCP RPC API.")),
     cfg.StrOpt('dhcp_driver',
                default='neutron.agent.linux.dhcp.Dnsmasq',
                help=_("The driver used to manage the DHCP server.")),
@@ -76,6 +86,24 @@ DHCP_AGENT_OPTS = [
                       'If a network has N updates in X seconds then '
                       'we will reload once with the port changes in the X '
                       'seconds and not N times.')),
+    cfg.BoolOpt('adaptive_process_pool', default=False,
+                help=_("Size the pool of green threads processing the "
+                       "network updates from the backlog of the update queue "
+                       "and from the latency of the updates, instead of from "
+                       "the number of networks. Every few seconds the pool "
+                       "is doubled when updates are waiting and the 95th "
+                       "percentile of the latency of the updates, or the age "
+                       "of the oldest pending update, exceeds "
+                       "process_pool_target_latency, and halved when the "
+                       "queue is empty and the updates take less than half "
+                       "of it. The pool never has more threads than the "
+                       "agent has networks, as the updates of a network are "
+                       "processed one at a time.")),
+    cfg.FloatOpt('process_pool_target_latency', default=1.0, min=0.1,
+                 help=_("Seconds between the reception of a network update "
+                        "and the end of its processing that the 95th "
+                        "percentile of the updates should not exceed when "
+                        "adaptive_process_pool is enabled.")),
 ]
 
 DHCP_OPTS = [
@@ -113,7 +141,45 @@ DNSMASQ_OPTS = [
                 help=_("Use broadcast in DHCP replies.")),
     cfg.BoolOpt('dnsmasq_enable_addr6_list', default=False,
                 help=_("Enable dhcp-host entry with list of addresses when "
-                       "port has multiple IPv6 addresses in the same subnet."))
+                       "port has multiple IPv6 addresses in the same "
+                       "subnet.")),
+    cfg.BoolOpt('dnsmasq_incremental_reload', default=False,
+                help=_("Write the DHCP and DNS host entries of each port to "
+                       "a file of its own, read by dnsmasq from the "
+                       "directories given to its --dhcp-hostsdir and "
+                       "--hostsdir options, instead of writing them to "
+                       "single hosts files. When the allocations of a "
+                       "network are reloaded, only the files of the ports "
+                       "that changed are written, and dnsmasq is not sent "
+                       "SIGHUP when host entries were only added, as dnsmasq "
+                       "reads the new and changed files on its own. "
+                       "Requires dnsmasq 2.73 or later built with inotify "
+                       "support.")),
+    cfg.IntOpt('dnsmasq_hosts_shards', default=0, min=0, max=256,
+               help=_("Number of files the DHCP and DNS host entries of a "
+                      "network are split into, by hash of the port ID, when "
+                      "dnsmasq_incremental_reload is enabled. 0 writes the "
+                      "entries of each port to a file of its own. dnsmasq "
+                      "reads all these files when it is reloaded, so on "
+                      "networks with thousands of ports, a few dozen shards "
+                      "keep both the reloads and the files written on port "
+                      "changes small.")),
+    cfg.BoolOpt('dnsmasq_render_in_native_thread', default=False,
+                help=_("Render the DHCP and DNS host entries of a network in "
+                       "a native thread instead of in the green thread "
+                       "processing the network update. Rendering the entries "
+                       "of a network with thousands of ports takes long "
+                       "enough to delay the updates of the other networks "
+                       "when it runs in a green thread, as it never yields. "
+                       "The size of the native thread pool is set by the "
+                       "EVENTLET_THREADPOOL_SIZE environment variable.")),
+    cfg.BoolOpt('dnsmasq_direct_release', default=False,
+                help=_("Release the stale IPv4 leases of a network by "
+                       "sending the DHCPRELEASE packets to dnsmasq from the "
+                       "privileged daemon, in a single call per reload, "
+                       "instead of running the dhcp_release utility once "
+                       "per lease. The IPv6 leases are still released with "
+                       "dhcp_release6.")),
 ]
 
 
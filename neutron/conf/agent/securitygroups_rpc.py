@@ -42,7 +42,53 @@ security_group_opts = [
         default=[],
         help=_('Comma-separated list of ethertypes to be permitted, in '
                'hexadecimal (starting with "0x"). For example, "0x4008" '
-               'to permit InfiniBand.'))
+               'to permit InfiniBand.')),
+    cfg.BoolOpt(
+        'compact_remote_group_flows',
+        default=False,
+        help=_('Aggregate the IP addresses of the remote security groups and '
+               'remote address groups into the minimal list of CIDR '
+               'prefixes before installing the conjunction flows. This '
+               'reduces the number of flows of security groups with large '
+               'remote groups. Only used by the openvswitch firewall '
+               'driver.')),
+    cfg.FloatOpt(
+        'refresh_debounce_interval',
+        default=0,
+        min=0,
+        help=_('Time in seconds during which the security group rule, '
+               'member and address group updates received by the L2 agent '
+               'are coalesced before refreshing the firewall of the '
+               'affected ports. Every port is refreshed once per interval, '
+               'regardless of the number of updates received. Only used by '
+               'the agents deferring the firewall refresh to their main '
+               'loop. The default value of 0 refreshes the firewall in the '
+               'next iteration of the agent loop.')),
+    cfg.IntOpt(
+        'info_cache_expiration_time',
+        default=0,
+        min=0,
+        help=_('Time in seconds during which the neutron server caches the '
+               'rules, the member IP addresses and the address group '
+               'addresses of the security groups used to answer the L2 '
+               'agent security group RPC requests. Each entry is only used '
+               'while the revision number of its security group or address '
+               'group, or the member ports of its security group, did not '
+               'change, which is checked in the database on every request. '
+               'The default value of 0 disables the cache.')),
+    cfg.IntOpt(
+        'iptables_dispatch_chains',
+        default=0,
+        min=0,
+        max=100,
+        help=_('Number of chains the jump rules of the ports are spread '
+               'over, by hash of the port device name, instead of being '
+               'added to the shared chains of the firewall. Adding or '
+               'removing a port then changes a single small chain, which '
+               'makes the iptables updates cheaper on hosts with many '
+               'ports, especially with the nft iptables backend. The default '
+               'value of 0 adds the jump rules to the shared chains. Only '
+               'used by the iptables based firewall drivers.')),
 ]
 
 
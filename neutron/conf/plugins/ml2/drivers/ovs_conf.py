@@ -178,6 +178,36 @@ agent_opts = [
                 default=True,
                 help=_("Minimize polling by monitoring ovsdb for interface "
                        "changes.")),
+    cfg.BoolOpt('incremental_port_sync',
+                default=False,
+                help=_("Process the integration bridge ports only from the "
+                       "ovsdb monitor events. When an iteration of the agent "
+                       "loop fails, the ports added and removed in that "
+                       "iteration are retried in the next one instead of "
+                       "rescanning every port of the bridges. A full scan is "
+                       "only done on an explicit resync, for example after "
+                       "an OVS restart or a bridge recreation. Requires "
+                       "minimize_polling.")),
+    cfg.IntOpt('rpc_devices_details_chunk_size',
+               default=0, min=0,
+               help=_("Maximum number of devices whose details are retrieved "
+                      "in a single request when ports are added or updated. "
+                      "The details of the next chunk are retrieved while the "
+                      "ports of the current chunk are being wired. A value "
+                      "of 0 retrieves the details of all the devices in a "
+                      "single request.")),
+    cfg.IntOpt('network_update_ports_per_iteration',
+               default=0, min=0,
+               help=_("Maximum number of ports updated because of a "
+                      "network_update notification processed in an agent "
+                      "loop iteration. When set, port and network update "
+                      "notifications are queued by priority: the ports of "
+                      "port_update notifications are always processed in "
+                      "the next iteration, while the ports of bulk "
+                      "network updates are spread over the following "
+                      "iterations so they don't delay the wiring of new "
+                      "ports. A value of 0 processes all the updated ports "
+                      "in the next iteration.")),
     cfg.IntOpt('ovsdb_monitor_respawn_interval',
                default=constants.DEFAULT_OVSDBMON_RESPAWN,
                help=_("The number of seconds to wait before respawning the "
@@ -210,6 +240,43 @@ agent_opts = [
     cfg.BoolOpt('drop_flows_on_start', default=False,
                 help=_("Reset flow table on start. Setting this to True will "
                        "cause brief traffic interruption.")),
+    cfg.BoolOpt('restart_flow_diff', default=False,
+                help=_("On start, compare the flows already installed on the "
+                       "bridges with the flows the agent installs, and only "
+                       "send the added, modified and deleted flows, instead "
+                       "of reinstalling every flow with a new cookie and "
+                       "deleting the flows with the previous one. The "
+                       "default cookie of the agent is stored in the "
+                       "external_ids of the bridges to be reused on the next "
+                       "start. Ignored if drop_flows_on_start is True.")),
+    cfg.BoolOpt('flow_transactions', default=False,
+                help=_("Send the flows installed and deleted while processing "
+                       "the ports of one iteration of the agent loop in "
+                       "atomic OpenFlow bundles, one per bridge unless more "
+                       "flows are modified, so that the other ports never "
+                       "see flows partially applied.")),
+    cfg.BoolOpt('parallel_bridge_setup', default=False,
+                help=_("Set up the physical bridges and the tunnel bridge "
+                       "concurrently when the agent starts or when physical "
+                       "bridges are recreated, instead of one after the "
+                       "other. This reduces the startup time of agents with "
+                       "many bridge mappings.")),
+    cfg.BoolOpt('bulk_tunnel_sync', default=False,
+                help=_("When l2_population is disabled, create the missing "
+                       "tunnel ports to the other agents in a single OVSDB "
+                       "transaction and update the flooding flows once per "
+                       "batch instead of once per tunnel. The tunnel_update "
+                       "notifications are then processed in batches by the "
+                       "agent loop, and the tunnel endpoints are only "
+                       "resent by the server when they changed since the "
+                       "last synchronization.")),
+    cfg.BoolOpt('compact_resource_cache', default=False,
+                help=_("Store the ports, networks and security groups "
+                       "cached by the agent in a compact read-only form, "
+                       "which reduces the memory used by the agent. The "
+                       "cached resources are converted back to objects when "
+                       "the agent reads them, which uses more CPU; only the "
+                       "objects read recently are kept.")),
     cfg.BoolOpt('tunnel_csum', default=False,
                 help=_("Set or un-set the tunnel header checksum on "
                        "outgoing IP packet carrying GRE/VXLAN tunnel.")),
@@ -13,23 +13,35 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import functools
+
 import netaddr
 from neutron_lib.callbacks import events
 from neutron_lib.callbacks import registry
 from neutron_lib.callbacks import resources
 from neutron_lib import constants as const
 from neutron_lib.db import api as db_api
+from neutron_lib.db import standard_attr
 from neutron_lib.utils import helpers
+from oslo_cache import core as cache
+from oslo_config import cfg
+from oslo_log import log as logging
+from sqlalchemy import func
 
 from neutron._i18n import _
+from neutron.common import cache_utils
+from neutron.conf.agent import securitygroups_rpc as sc_cfg
 from neutron.db.models import address_group as ag_models
 from neutron.db.models import allowed_address_pair as aap_models
 from neutron.db.models import securitygroup as sg_models
 from neutron.db import models_v2
 from neutron.db import securitygroups_db as sg_db
 from neutron.extensions import securitygroup as ext_sg
-from neutron.objects import securitygroup as sg_obj
 
+LOG = logging.getLogger(__name__)
+
+sc_cfg.register_securitygroups_opts()
 
 DIRECTION_IP_PREFIX = {'ingress': 'source_ip_prefix',
                        'egress': 'dest_ip_prefix'}
@@ -171,6 +183,9 @@ class SecurityGroupInfoAPIMixin(object):
                    'security_groups': {},
                    'sg_member_ips': {}}
         rules_in_db = self._select_rules_for_ports(context, ports)
+        stateful_by_sg = self._select_sgs_stateful(
+            context, {rule_in_db.get('security_group_id')
+                      for _port_id, rule_in_db in rules_in_db})
         remote_security_group_info = {}
         remote_address_group_info = {}
         for (port_id, rule_in_db) in rules_in_db:
@@ -211,8 +226,7 @@ class SecurityGroupInfoAPIMixin(object):
                     # this set will be serialized into a list by rpc code
                     remote_address_group_info[remote_ag_id][ethertype] = set()
             direction = rule_in_db['direction']
-            stateful = self._is_security_group_stateful(context,
-                                                        security_group_id)
+            stateful = stateful_by_sg[security_group_id]
             rule_dict = {
                 'direction': direction,
                 'ethertype': ethertype,
@@ -435,10 +449,190 @@ class SecurityGroupInfoAPIMixin(object):
         """
         return True
 
+    def _select_sgs_stateful(self, context, sg_ids):
+        """Return whether each of the security groups is stateful or not.
+
+        Return a dict of booleans keyed by security group ID.
+        """
+        return {sg_id: self._is_security_group_stateful(context, sg_id)
+                for sg_id in sg_ids}
+
 
+@registry.has_registry_receivers
 class SecurityGroupServerRpcMixin(SecurityGroupInfoAPIMixin,
                                   SecurityGroupServerNotifierRpcMixin):
-    """Server-side RPC mixin using DB for SG notifications and responses."""
+    """Server-side RPC mixin using DB for SG notifications and responses.
+
+    When [SECURITYGROUP] info_cache_expiration_time is set, the rules, the
+    statefulness and the member IP addresses of the security groups and the
+    addresses of the address groups are cached, so that the agents
+    requesting the same security groups are served without querying the
+    database again. The changes are mostly made by other workers, so each
+    entry is stored with the version of its security group or address group
+    and only used while the version in the database is the same.
+    """
+
+    _SG_RULE_FIELDS = ('security_group_id', 'remote_group_id',
+                       'remote_address_group_id', 'direction', 'ethertype',
+                       'protocol', 'port_range_min', 'port_range_max',
+                       'remote_ip_prefix')
+
+    def _get_sg_info_cache(self):
+        try:
+            return self._sg_info_cache
+        except AttributeError:
+            pass
+        expiration_time = cfg.CONF.SECURITYGROUP.info_cache_expiration_time
+        self._sg_info_cache = (
+            cache_utils._get_memory_cache_region(
+                expiration_time=expiration_time)
+            if expiration_time else None)
+        self.sg_info_cache_hits = collections.Counter()
+        self.sg_info_cache_misses = collections.Counter()
+        return self._sg_info_cache
+
+    def _get_cached_sg_info(self, kind, ids, select_func, version_func):
+        """Return a dict of the values of kind keyed by the given IDs.
+
+        The values not cached are selected with select_func, which is given
+        the missing IDs and returns a dict keyed by ID. version_func is given
+        the IDs and returns their current version keyed by ID; a cached value
+        is only used if it was selected with the same version. The versions
+        are read before selecting the values, so a value selected during a
+        change is stored with the old version and selected again next time.
+        """
+        sg_info_cache = self._get_sg_info_cache()
+        ids = list(set(ids))
+        if not sg_info_cache or not ids:
+            return select_func(ids)
+        versions = version_func(ids)
+        values = sg_info_cache.get_multi(
+            ['%s:%s' % (kind, id_) for id_ in ids])
+        result = {}
+        missing = []
+        for id_, value in zip(ids, values):
+            if (value is cache.NO_VALUE or
+                    value[0] != versions.get(id_)):
+                missing.append(id_)
+            else:
+                result[id_] = value[1]
+        self.sg_info_cache_hits[kind] += len(result)
+        self.sg_info_cache_misses[kind] += len(missing)
+        if missing:
+            selected = select_func(missing)
+            sg_info_cache.set_multi(
+                {'%s:%s' % (kind, id_): (versions.get(id_), value)
+                 for id_, value in selected.items()})
+            result.update(selected)
+        return result
+
+    def _invalidate_sg_info_cache(self, kind, ids):
+        sg_info_cache = self._get_sg_info_cache()
+        ids = [id_ for id_ in ids if id_]
+        if not sg_info_cache or not ids:
+            return
+        sg_info_cache.delete_multi(['%s:%s' % (kind, id_) for id_ in ids])
+
+    @db_api.retry_if_session_inactive()
+    def _query_revision_numbers(self, context, model, ids):
+        """Return the revision numbers of the model rows keyed by ID"""
+        query = context.session.query(
+            model.id, standard_attr.StandardAttribute.revision_number)
+        query = query.join(
+            standard_attr.StandardAttribute,
+            model.standard_attr_id == standard_attr.StandardAttribute.id)
+        query = query.filter(model.id.in_(ids))
+        return dict(query)
+
+    @db_api.retry_if_session_inactive()
+    def _query_remote_group_versions(self, context, remote_group_ids):
+        """Return the version of the member ports of each security group.
+
+        The version of a group is the number of its ports, the sum of their
+        standard attribute IDs and the sum of their revision numbers. The
+        IDs of new ports are higher than the ones of the ports deleted, so
+        the number of ports or the sum of the IDs changes when the members
+        change, and the sum of the revision numbers changes when a member
+        port is updated.
+
+        This still aggregates over every member port, but returns one row
+        per group instead of one row per address of the members.
+        """
+        sg_binding_port = sg_models.SecurityGroupPortBinding.port_id
+        sg_binding_sgid = sg_models.SecurityGroupPortBinding.security_group_id
+        std_attr = standard_attr.StandardAttribute
+        query = context.session.query(
+            sg_binding_sgid, func.count(std_attr.id), func.sum(std_attr.id),
+            func.sum(std_attr.revision_number))
+        query = query.join(models_v2.Port,
+                           models_v2.Port.id == sg_binding_port)
+        query = query.join(std_attr,
+                           models_v2.Port.standard_attr_id == std_attr.id)
+        query = query.filter(sg_binding_sgid.in_(remote_group_ids))
+        query = query.group_by(sg_binding_sgid)
+        return {sg_id: (int(count), int(id_sum), int(revision_sum))
+                for sg_id, count, id_sum, revision_sum in query}
+
+    def get_sg_info_cache_stats(self):
+        """Return the cache hits, misses and hit ratio of each kind"""
+        self._get_sg_info_cache()
+        stats = {}
+        for kind in set(self.sg_info_cache_hits) | set(
+                self.sg_info_cache_misses):
+            hits = self.sg_info_cache_hits[kind]
+            misses = self.sg_info_cache_misses[kind]
+            stats[kind] = {'hits': hits, 'misses': misses,
+                           'hit_ratio': hits / float(hits + misses)}
+        return stats
+
+    def security_group_info_for_ports(self, context, ports):
+        sg_info = super(SecurityGroupServerRpcMixin,
+                        self).security_group_info_for_ports(context, ports)
+        if self._get_sg_info_cache():
+            LOG.debug("Security group info cache statistics: %s",
+                      self.get_sg_info_cache_stats())
+        return sg_info
+
+    @registry.receives(resources.PORT, [events.AFTER_CREATE,
+                                        events.AFTER_UPDATE,
+                                        events.AFTER_DELETE])
+    def _invalidate_sg_info_on_port_change(self, resource, event, trigger,
+                                           payload):
+        if event == events.AFTER_UPDATE:
+            original_port, port = payload.states[0], payload.latest_state
+            if not (self.is_security_group_member_updated(
+                        payload.context, original_port, port) or
+                    original_port.get('allowed_address_pairs') !=
+                    port.get('allowed_address_pairs')):
+                return
+        sg_ids = set()
+        for port in payload.states:
+            sg_ids |= set(port.get(ext_sg.SECURITYGROUPS) or [])
+        self._invalidate_sg_info_cache('member_ips', sg_ids)
+
+    @registry.receives(resources.SECURITY_GROUP, [events.AFTER_UPDATE,
+                                                  events.AFTER_DELETE])
+    def _invalidate_sg_info_on_sg_change(self, resource, event, trigger,
+                                         payload):
+        for kind in ('rules', 'stateful', 'member_ips'):
+            self._invalidate_sg_info_cache(kind, [payload.resource_id])
+
+    @registry.receives(resources.SECURITY_GROUP_RULE, [events.AFTER_CREATE,
+                                                       events.AFTER_DELETE])
+    def _invalidate_sg_info_on_sg_rule_change(self, resource, event, trigger,
+                                              payload):
+        if event == events.AFTER_CREATE:
+            sg_id = payload.latest_state['security_group_id']
+        else:
+            sg_id = payload.metadata.get('security_group_id')
+        self._invalidate_sg_info_cache('rules', [sg_id])
+
+    @registry.receives(resources.ADDRESS_GROUP, [events.AFTER_UPDATE,
+                                                 events.AFTER_DELETE])
+    def _invalidate_sg_info_on_address_group_change(self, resource, event,
+                                                    trigger, payload):
+        self._invalidate_sg_info_cache('address_group_ips',
+                                       [payload.resource_id])
 
     @db_api.retry_if_session_inactive()
     def _select_sg_ids_for_ports(self, context, ports):
@@ -451,7 +645,7 @@ class SecurityGroupServerRpcMixin(SecurityGroupInfoAPIMixin,
         return query.all()
 
     @db_api.retry_if_session_inactive()
-    def _select_rules_for_ports(self, context, ports):
+    def _query_rules_for_ports(self, context, ports):
         if not ports:
             return []
         sg_binding_port = sg_models.SecurityGroupPortBinding.port_id
@@ -467,7 +661,44 @@ class SecurityGroupServerRpcMixin(SecurityGroupInfoAPIMixin,
         return query.all()
 
     @db_api.retry_if_session_inactive()
+    def _select_rules_for_ports(self, context, ports):
+        if not ports or not self._get_sg_info_cache():
+            return self._query_rules_for_ports(context, ports)
+        sg_binding_port = sg_models.SecurityGroupPortBinding.port_id
+        sg_binding_sgid = sg_models.SecurityGroupPortBinding.security_group_id
+        query = context.session.query(sg_binding_port, sg_binding_sgid)
+        query = query.filter(sg_binding_port.in_(ports.keys()))
+        bindings = query.all()
+        rules_by_sg = self._get_cached_sg_info(
+            'rules', [sg_id for _port_id, sg_id in bindings],
+            functools.partial(self._select_rules_for_sgs, context),
+            functools.partial(self._query_revision_numbers, context,
+                              sg_models.SecurityGroup))
+        return [(port_id, rule)
+                for port_id, sg_id in bindings
+                for rule in rules_by_sg[sg_id]]
+
+    @db_api.retry_if_session_inactive()
+    def _select_rules_for_sgs(self, context, sg_ids):
+        rules_by_sg = {sg_id: [] for sg_id in sg_ids}
+        if not sg_ids:
+            return rules_by_sg
+        sgr_sgid = sg_models.SecurityGroupRule.security_group_id
+        query = context.session.query(sg_models.SecurityGroupRule)
+        query = query.filter(sgr_sgid.in_(sg_ids))
+        for rule in query:
+            rules_by_sg[rule.security_group_id].append(
+                {field: rule[field] for field in self._SG_RULE_FIELDS})
+        return rules_by_sg
+
     def _select_ips_for_remote_group(self, context, remote_group_ids):
+        return self._get_cached_sg_info(
+            'member_ips', remote_group_ids,
+            functools.partial(self._query_ips_for_remote_group, context),
+            functools.partial(self._query_remote_group_versions, context))
+
+    @db_api.retry_if_session_inactive()
+    def _query_ips_for_remote_group(self, context, remote_group_ids):
         ips_by_group = {}
         if not remote_group_ids:
             return ips_by_group
@@ -506,9 +737,18 @@ class SecurityGroupServerRpcMixin(SecurityGroupInfoAPIMixin,
                     (allowed_addr_ip, mac))
         return ips_by_group
 
-    @db_api.retry_if_session_inactive()
     def _select_ips_for_remote_address_group(self, context,
                                              remote_address_group_ids):
+        return self._get_cached_sg_info(
+            'address_group_ips', remote_address_group_ids,
+            functools.partial(self._query_ips_for_remote_address_group,
+                              context),
+            functools.partial(self._query_revision_numbers, context,
+                              ag_models.AddressGroup))
+
+    @db_api.retry_if_session_inactive()
+    def _query_ips_for_remote_address_group(self, context,
+                                            remote_address_group_ids):
         ips_by_group = {}
         if not remote_address_group_ids:
             return ips_by_group
@@ -525,6 +765,21 @@ class SecurityGroupServerRpcMixin(SecurityGroupInfoAPIMixin,
             ips_by_group[ag_id].add((addr, None))
         return ips_by_group
 
-    @db_api.retry_if_session_inactive()
     def _is_security_group_stateful(self, context, sg_id):
-        return sg_obj.SecurityGroup.get_sg_by_id(context, sg_id).stateful
+        return self._select_sgs_stateful(context, [sg_id])[sg_id]
+
+    def _select_sgs_stateful(self, context, sg_ids):
+        return self._get_cached_sg_info(
+            'stateful', sg_ids,
+            functools.partial(self._query_sgs_stateful, context),
+            functools.partial(self._query_revision_numbers, context,
+                              sg_models.SecurityGroup))
+
+    @db_api.retry_if_session_inactive()
+    def _query_sgs_stateful(self, context, sg_ids):
+        if not sg_ids:
+            return {}
+        query = context.session.query(sg_models.SecurityGroup.id,
+                                      sg_models.SecurityGroup.stateful)
+        query = query.filter(sg_models.SecurityGroup.id.in_(sg_ids))
+        return dict(query)
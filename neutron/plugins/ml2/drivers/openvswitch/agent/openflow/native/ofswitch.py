@@ -14,8 +14,11 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import contextlib
 import functools
 import random
+import time
 
 import debtcollector
 import eventlet
@@ -39,6 +42,11 @@ LOG = logging.getLogger(__name__)
 
 BUNDLE_ID_WIDTH = 1 << 32
 COOKIE_DEFAULT = object()
+# Bridge external_ids key storing the default cookie of the agent, so that
+# it can be reused by the flow diff on the next agent start.
+FLOW_DIFF_COOKIE_KEY = 'neutron-agent-cookie'
+# Maximum number of flow mods added to a bundle of a flow transaction
+FLOW_TRANSACTION_MAX_FLOW_MODS = 1000
 
 
 class ActiveBundleRunning(exceptions.NeutronException):
@@ -62,6 +70,10 @@ class OpenFlowSwitchMixin(object):
     def __init__(self, *args, **kwargs):
         self._app = kwargs.pop('os_ken_app')
         self.active_bundles = set()
+        # NOTE: the flow diff and the transaction are mutated in place, so
+        # that they are shared with the bridges cloned for the extensions
+        self._flow_diff = {}
+        self._flow_transaction = []
         super(OpenFlowSwitchMixin, self).__init__(*args, **kwargs)
 
     def _get_dp_by_dpid(self, dpid_int):
@@ -93,6 +105,8 @@ class OpenFlowSwitchMixin(object):
     def _send_msg(self, msg, reply_cls=None, reply_multi=False,
                   active_bundle=None):
         timeout_sec = cfg.CONF.OVS.of_request_timeout
+        if active_bundle is None and self._flow_transaction:
+            active_bundle = self._get_flow_transaction_bundle(msg)
         timeout = eventlet.Timeout(seconds=timeout_sec)
         if active_bundle is not None:
             (dp, ofp, ofpp) = self._get_dp()
@@ -125,6 +139,69 @@ class OpenFlowSwitchMixin(object):
                   {"request": msg, "result": result})
         return result
 
+    @contextlib.contextmanager
+    def flow_transaction(self):
+        """Send the flow mods of the bridge in atomic bundles.
+
+        The flows installed or uninstalled in this context, out of an
+        explicit bundle, are added to an atomic and ordered bundle which is
+        committed when the context exits, or when it contains
+        FLOW_TRANSACTION_MAX_FLOW_MODS flow mods. Nested transactions are
+        part of the outermost one.
+        """
+        if self._flow_transaction:
+            yield
+            return
+        transaction = {'bundle': None, 'flow_mods': 0, 'bundles': 0}
+        self._flow_transaction.append(transaction)
+        try:
+            yield
+        finally:
+            self._flow_transaction.remove(transaction)
+            # NOTE: the bundle is committed even if an exception was raised
+            # in the context, as the flows would have been sent without it.
+            self._commit_flow_transaction_bundle(transaction)
+            if transaction['flow_mods']:
+                LOG.debug("Bridge %(br_name)s: flow transaction committed "
+                          "%(flow_mods)d flow mods in %(bundles)d bundles",
+                          {'br_name': self.br_name,
+                           'flow_mods': transaction['flow_mods'],
+                           'bundles': transaction['bundles']})
+
+    def commit_flow_transaction(self):
+        """Commit the flow mods sent so far in the current flow transaction.
+
+        The next flow mods of the transaction are added to a new bundle. This
+        orders the flows sent so far before the flows sent out of the
+        transaction, for instance with ovs-ofctl.
+        """
+        if self._flow_transaction:
+            self._commit_flow_transaction_bundle(self._flow_transaction[0])
+
+    def _get_flow_transaction_bundle(self, msg):
+        (_dp, ofp, _ofpp) = self._get_dp()
+        if getattr(msg, 'cls_msg_type', None) != ofp.OFPT_FLOW_MOD:
+            return None
+        transaction = self._flow_transaction[0]
+        if (transaction['flow_mods'] and not transaction['flow_mods'] %
+                FLOW_TRANSACTION_MAX_FLOW_MODS):
+            self._commit_flow_transaction_bundle(transaction)
+        if transaction['bundle'] is None:
+            transaction['bundle'] = BundledOpenFlowBridge(
+                self, atomic=True, ordered=True).__enter__()
+            transaction['bundles'] += 1
+        transaction['flow_mods'] += 1
+        bundle = transaction['bundle']
+        return dict(id=bundle.active_bundle,
+                    bundle_flags=bundle.bundle_flags)
+
+    @staticmethod
+    def _commit_flow_transaction_bundle(transaction):
+        bundle = transaction['bundle']
+        if bundle is not None:
+            transaction['bundle'] = None
+            bundle.__exit__(None, None, None)
+
     @staticmethod
     def _match(_ofp, ofpp, match, **match_kwargs):
         if match is not None:
@@ -149,6 +226,9 @@ class OpenFlowSwitchMixin(object):
             cookie_mask = ovs_lib.UINT64_BITMASK
 
         match = self._match(ofp, ofpp, match, **match_kwargs)
+        if self._flow_diff:
+            self._flow_diff_invalidate(ofp, table_id, strict, priority,
+                                       match)
         if strict:
             cmd = ofp.OFPFC_DELETE_STRICT
         else:
@@ -189,9 +269,144 @@ class OpenFlowSwitchMixin(object):
         LOG.info("Reserved cookies for %s: %s", self.br_name,
                  self.reserved_cookies)
 
+        if self._flow_diff:
+            self._finish_flow_diff()
         for table_id in self.of_tables:
             self._dump_and_clean(table_id)
 
+    @staticmethod
+    def _flow_match_fields(ofp, match):
+        fields = []
+        for field, value in match.items():
+            (num, value, mask) = ofp.oxm_from_user(field, value)
+            if mask is not None and mask == b'\xff' * len(mask):
+                mask = None
+            fields.append((num, value, mask))
+        return frozenset(fields)
+
+    @staticmethod
+    def _flow_instructions_key(instructions):
+        buf = bytearray()
+        try:
+            for instruction in instructions:
+                instruction.serialize(buf, len(buf))
+        except Exception:
+            # An instruction that can't be compared is always reinstalled
+            return None
+        return bytes(buf)
+
+    def start_flow_diff(self):
+        """Only install the flows which differ from the installed ones.
+
+        The bridge takes back the default cookie stored by the previous
+        agent run and its flows are dumped once. Until cleanup_flows() is
+        called, the flows identical to an installed flow are not sent to
+        the switch again, and cleanup_flows() deletes, in one bundle, the
+        installed flows which were not installed again, instead of
+        reinstalling every flow with a new cookie.
+        """
+        (_dp, ofp, _ofpp) = self._get_dp()
+        external_ids = self.db_get_val('Bridge', self.br_name,
+                                       'external_ids', log_errors=False)
+        cookie = (external_ids or {}).get(FLOW_DIFF_COOKIE_KEY)
+        if cookie:
+            self.set_agent_uuid_stamp(int(cookie, 16))
+        else:
+            self.ovsdb.br_set_external_id(
+                self.br_name, FLOW_DIFF_COOKIE_KEY,
+                '%x' % self.default_cookie).execute(check_error=True)
+        start = time.time()
+        flows = {}
+        index = collections.defaultdict(set)
+        for flow in self.dump_flows():
+            if flow.cookie != self.default_cookie:
+                continue
+            fields = self._flow_match_fields(ofp, flow.match)
+            key = (flow.table_id, flow.priority, fields)
+            flows[key] = self._flow_instructions_key(flow.instructions)
+            index[flow.table_id].add(key)
+            for field in fields:
+                index[(flow.table_id, field)].add(key)
+        self._flow_diff.clear()
+        self._flow_diff.update({'start': start, 'flows': flows,
+                                'index': index, 'unchanged': set(),
+                                'invalidated': set(), 'installed': 0})
+        LOG.info("Bridge %(br_name)s: flow diff started with %(flows)d "
+                 "installed flows", {'br_name': self.br_name,
+                                     'flows': len(flows)})
+
+    def _flow_diff_unchanged(self, ofp, table_id, priority, match,
+                             instructions):
+        diff = self._flow_diff
+        key = (table_id, priority, self._flow_match_fields(ofp, match))
+        if key in diff['flows'] and key not in diff['invalidated']:
+            installed = diff['flows'][key]
+            if (installed is not None and
+                    installed == self._flow_instructions_key(instructions)):
+                diff['unchanged'].add(key)
+                return True
+            # The installed flow is replaced, it must not be skipped anymore
+            diff['invalidated'].add(key)
+        diff['installed'] += 1
+        return False
+
+    def _flow_diff_invalidate(self, ofp, table_id, strict, priority, match):
+        diff = self._flow_diff
+        fields = self._flow_match_fields(ofp, match)
+        if table_id == ofp.OFPTT_ALL:
+            table_ids = {key[0] for key in diff['flows']}
+        else:
+            table_ids = {table_id}
+        exact_fields = [field for field in fields if field[2] is None]
+        masked_nums = {field[0] for field in fields if field[2] is not None}
+        for table in table_ids:
+            if strict:
+                keys = {(table, priority, fields)}
+            elif exact_fields:
+                keys = diff['index'].get((table, exact_fields[0]), set())
+            else:
+                keys = diff['index'].get(table, set())
+            for key in keys:
+                if key not in diff['flows']:
+                    continue
+                # NOTE: the masked fields of a non strict deletion are
+                # assumed to match, reinstalling a flow is always safe.
+                key_nums = {field[0] for field in key[2]}
+                if (set(exact_fields) <= key[2] and
+                        masked_nums <= key_nums):
+                    diff['invalidated'].add(key)
+
+    def _finish_flow_diff(self):
+        (_dp, ofp, _ofpp) = self._get_dp()
+        diff = dict(self._flow_diff)
+        self._flow_diff.clear()
+        flows = self.dump_flows()
+        # Flows installed after the diff was started are younger than this
+        elapsed = time.time() - diff['start']
+        stale_flows = []
+        for flow in flows:
+            if flow.cookie != self.default_cookie:
+                continue
+            if flow.duration_sec + flow.duration_nsec / 1e9 < elapsed:
+                continue
+            key = (flow.table_id, flow.priority,
+                   self._flow_match_fields(ofp, flow.match))
+            if key not in diff['unchanged']:
+                stale_flows.append(flow)
+        if stale_flows:
+            with self.bundled(atomic=True) as br:
+                for flow in stale_flows:
+                    br.uninstall_flows(table_id=flow.table_id, strict=True,
+                                       priority=flow.priority,
+                                       match=flow.match)
+        LOG.info("Bridge %(br_name)s: flow diff completed, %(unchanged)d "
+                 "flows unchanged, %(installed)d flows installed and "
+                 "%(deleted)d stale flows deleted",
+                 {'br_name': self.br_name,
+                  'unchanged': len(diff['unchanged'] - diff['invalidated']),
+                  'installed': diff['installed'],
+                  'deleted': len(stale_flows)})
+
     def install_goto_next(self, table_id, active_bundle=None):
         self.install_goto(table_id=table_id, dest_table_id=table_id + 1,
                           active_bundle=active_bundle)
@@ -237,6 +452,9 @@ class OpenFlowSwitchMixin(object):
                 ofp, instructions)
             instructions = ofproto_parser.ofp_instruction_from_jsondict(
                 dp, jsonlist)
+        if self._flow_diff and self._flow_diff_unchanged(
+                ofp, table_id, priority, match, instructions):
+            return
         msg = ofpp.OFPFlowMod(dp,
                               table_id=table_id,
                               cookie=self.default_cookie,
@@ -15,12 +15,14 @@
 
 import base64
 import collections
+import contextlib
 import functools
 import hashlib
 import signal
 import sys
 import time
 
+import eventlet
 import netaddr
 from neutron_lib.agent import constants as agent_consts
 from neutron_lib.agent import topics
@@ -51,6 +53,7 @@ from neutron._i18n import _
 from neutron.agent.common import ip_lib
 from neutron.agent.common import ovs_lib
 from neutron.agent.common import polling
+from neutron.agent.common import resource_processing_queue as queue
 from neutron.agent.common import utils
 from neutron.agent.l2 import l2_agent_extensions_manager as ext_manager
 from neutron.agent import rpc as agent_rpc
@@ -83,6 +86,11 @@ cfg.CONF.import_group('OVS', 'neutron.plugins.ml2.drivers.openvswitch.agent.'
 
 INIT_MAX_TRIES = 3
 
+# Priorities of the port updates queued when network_update_ports_per_iteration
+# is set, lower values are processed first.
+PRIORITY_PORT_UPDATE = 0
+PRIORITY_NETWORK_UPDATE = 1
+
 
 class _mac_mydialect(netaddr.mac_unix):
     word_fmt = '%.2x'
@@ -161,6 +169,10 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
         self.enable_openflow_dhcp = 'dhcp' in self.ext_manager.names()
 
         self.fullsync = False
+        # Compare the installed flows with the flows to install until the
+        # first cleanup of the stale flows
+        self.restart_flow_diff = (agent_conf.restart_flow_diff and
+                                  not agent_conf.drop_flows_on_start)
         # init bridge classes with configured datapath type.
         self.br_int_cls, self.br_phys_cls, self.br_tun_cls = (
             functools.partial(bridge_classes[b],
@@ -192,10 +204,19 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
         # Keep track of int_br's device count for use by _report_state()
         self.int_br_device_count = 0
 
+        self.parallel_bridge_setup = agent_conf.parallel_bridge_setup
+        # Time spent in each bridge setup phase of the agent startup
+        self.startup_times = {}
         self.int_br = self.br_int_cls(ovs_conf.integration_bridge)
-        self.setup_integration_br()
+        self._timed_startup_phase('integration_bridge',
+                                  self.setup_integration_br)
         # Stores port update notifications for processing in main rpc loop
         self.updated_ports = set()
+        # Stores port and network update notifications by priority when
+        # the ports of network updates are rate limited
+        self.network_update_ports_per_iteration = (
+            agent_conf.network_update_ports_per_iteration)
+        self.port_update_queue = queue.ResourceProcessingQueue()
         # Stores port delete notifications
         self.deleted_ports = set()
         # Stores the port IDs whose binding has been deactivated
@@ -249,18 +270,25 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
         self.phys_brs = {}
         self.int_ofports = {}
         self.phys_ofports = {}
-        self.setup_physical_bridges(self.bridge_mappings)
         self.vlan_manager = vlanmanager.LocalVlanManager()
 
         self._reset_tunnel_ofports()
 
         self.polling_interval = agent_conf.polling_interval
         self.minimize_polling = agent_conf.minimize_polling
+        self.incremental_port_sync = agent_conf.incremental_port_sync
+        # Number of rpc_loop iterations whose port information was built from
+        # a full scan of the bridges or from the ovsdb monitor events only
+        self.port_sync_stats = {'full': 0, 'incremental': 0}
         self.ovsdb_monitor_respawn_interval = (
             agent_conf.ovsdb_monitor_respawn_interval or
             constants.DEFAULT_OVSDBMON_RESPAWN)
         self.local_ip = ovs_conf.local_ip
         self.tunnel_count = 0
+        self.bulk_tunnel_sync = agent_conf.bulk_tunnel_sync
+        # Remote IPs of the tunnel_update notifications to process in the
+        # next rpc_loop iteration, by tunnel type
+        self.pending_tunnels = collections.defaultdict(set)
         self.vxlan_udp_port = agent_conf.vxlan_udp_port
         self.dont_fragment = agent_conf.dont_fragment
         self.tunnel_csum = agent_conf.tunnel_csum
@@ -272,11 +300,9 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
         self.tun_br = None
         self.patch_int_ofport = constants.OFPORT_INVALID
         self.patch_tun_ofport = constants.OFPORT_INVALID
-        if self.enable_tunneling:
-            # The patch_int_ofport and patch_tun_ofport are updated
-            # here inside the call to setup_tunnel_br()
-            self.setup_tunnel_br(ovs_conf.tunnel_bridge)
-            self.setup_tunnel_br_flows()
+        # The patch_int_ofport and patch_tun_ofport are updated inside the
+        # call to setup_tunnel_br()
+        self._setup_bridges(ovs_conf.tunnel_bridge)
 
         self.setup_rpc()
 
@@ -299,8 +325,14 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
             self.dvr_agent.setup_dvr_flows()
 
         # Collect additional bridges to monitor
-        self.ancillary_brs = self.setup_ancillary_bridges(
+        self.ancillary_brs = self._timed_startup_phase(
+            'ancillary_bridges', self.setup_ancillary_bridges,
             ovs_conf.integration_bridge, ovs_conf.tunnel_bridge)
+        LOG.info("Bridges set up in %(total).3f seconds: %(times)s",
+                 {'total': sum(self.startup_times[phase] for phase in
+                               ('integration_bridge', 'bridges',
+                                'ancillary_bridges')),
+                  'times': self.startup_times})
 
         agent_api = ovs_ext_api.OVSAgentExtensionAPI(self.int_br,
                                                      self.tun_br,
@@ -370,7 +402,8 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
                                ovs_conf.vhostuser_socket_dir,
                                portbindings.OVS_HYBRID_PLUG: hybrid_plug,
                                'baremetal_smartnic':
-                               self.conf.AGENT.baremetal_smartnic},
+                               self.conf.AGENT.baremetal_smartnic,
+                               'startup_times': self.startup_times},
             'resource_versions': resources.LOCAL_RESOURCE_VERSIONS,
             'agent_type': n_const.AGENT_TYPE_OVS,
             'start_flag': True}
@@ -477,6 +510,9 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
         self.tun_br_ofports = {n_const.TYPE_GENEVE: {},
                                n_const.TYPE_GRE: {},
                                n_const.TYPE_VXLAN: {}}
+        # Version of the tunnel endpoints of the last successful tunnel_sync,
+        # only valid as long as the tunnel ports are known
+        self.tunnels_version = {}
 
     def _update_network_segmentation_id(self, network):
         if network.get(provider_net.NETWORK_TYPE) != n_const.TYPE_VLAN:
@@ -510,7 +546,9 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
             segmentation_id=network[provider_net.SEGMENTATION_ID])
 
     def setup_rpc(self):
-        self.plugin_rpc = OVSPluginApi(topics.PLUGIN)
+        self.plugin_rpc = OVSPluginApi(
+            topics.PLUGIN,
+            compact_cache=self.conf.AGENT.compact_resource_cache)
         # allow us to receive port_update/delete callbacks from the cache
         self.plugin_rpc.register_legacy_notification_callbacks(self)
         self.sg_plugin_rpc = sg_rpc.SecurityGroupServerAPIShim(
@@ -558,7 +596,7 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
             # will cause all these ports to be processed again in next RPC
             # loop as 'updated'. So here we just ignore such local update
             # notification.
-            self.updated_ports.add(port['id'])
+            self._queue_port_update(port['id'], PRIORITY_PORT_UPDATE)
 
         if not self.conf.AGENT.baremetal_smartnic:
             return
@@ -670,12 +708,40 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
             # notifications could arrive out of order, if the port is deleted
             # we don't want to update it anymore
             if port_id not in self.deleted_ports:
-                self.updated_ports.add(port_id)
+                self._queue_port_update(port_id, PRIORITY_NETWORK_UPDATE)
         LOG.debug("network_update message processed for network "
                   "%(network_id)s, with ports: %(ports)s",
                   {'network_id': network_id,
                    'ports': self.network_ports[network_id]})
 
+    def _queue_port_update(self, port_id, priority):
+        if not self.network_update_ports_per_iteration:
+            self.updated_ports.add(port_id)
+            return
+        self.port_update_queue.add(queue.ResourceUpdate(port_id, priority))
+
+    def _get_queued_port_updates(self):
+        """Return the queued updated ports to process in this iteration
+
+        The ports of port_update notifications are all returned, while at
+        most network_update_ports_per_iteration ports of network updates are.
+        """
+        updated_ports = set()
+        network_update_ports = 0
+        while (not self.port_update_queue.empty() and
+               network_update_ports < self.network_update_ports_per_iteration):
+            for _rp, update in (
+                    self.port_update_queue.each_update_to_next_resource()):
+                if update.priority != PRIORITY_PORT_UPDATE:
+                    network_update_ports += 1
+                # the port could have been deleted since the update was queued
+                if update.id not in self.deleted_ports:
+                    updated_ports.add(update.id)
+        if not self.port_update_queue.empty():
+            LOG.debug("%d port updates postponed to the next iterations",
+                      self.port_update_queue.qsize())
+        return updated_ports
+
     @profiler.trace("rpc")
     def binding_deactivate(self, context, **kwargs):
         if kwargs.get('host') != self.conf.host:
@@ -834,6 +900,10 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
         if tun_name is None:
             return
         if not self.l2_pop:
+            if self.bulk_tunnel_sync:
+                # The tunnel ports are created in batches by the rpc_loop
+                self.pending_tunnels[tunnel_type].add(tunnel_ip)
+                return
             self._setup_tunnel_port(self.tun_br, tun_name, tunnel_ip,
                                     tunnel_type)
             self._setup_tunnel_flood_flow(self.tun_br, tunnel_type)
@@ -855,6 +925,7 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
             LOG.error("tunnel_type %s not supported by agent",
                       tunnel_type)
             return
+        self.pending_tunnels[tunnel_type].discard(tunnel_ip)
         ofport = self.tun_br_ofports[tunnel_type].get(tunnel_ip)
         self.cleanup_tunnel_port(self.tun_br, ofport, tunnel_type)
 
@@ -1362,6 +1433,49 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
                                          log_errors=log_errors)
             self.int_br.drop_port(in_port=port.ofport)
 
+    def _timed_startup_phase(self, phase, func, *args):
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.startup_times[phase] = round(time.time() - start, 3)
+
+    def _run_bridge_setups(self, setups):
+        """Run the bridge setup functions, concurrently if configured
+
+        :param setups: list of (function, args) tuples.
+        """
+        if not self.parallel_bridge_setup or len(setups) < 2:
+            for func, args in setups:
+                func(*args)
+            return
+        threads = [eventlet.spawn(func, *args) for func, args in setups]
+        # Wait for all the bridges to be ready, an error in one setup is
+        # raised once every bridge setup has completed
+        errors = []
+        for thread in threads:
+            try:
+                thread.wait()
+            except BaseException as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+    def _setup_tunnel_br_and_flows(self, tun_br_name):
+        self.setup_tunnel_br(tun_br_name)
+        self.setup_tunnel_br_flows()
+
+    def _setup_bridges(self, tun_br_name):
+        """Setup the physical and tunnel bridges at the agent startup"""
+        setups = [(self._timed_startup_phase,
+                   ('physical_bridges', self.setup_physical_bridges,
+                    self.bridge_mappings))]
+        if self.enable_tunneling:
+            setups.append((self._timed_startup_phase,
+                           ('tunnel_bridge', self._setup_tunnel_br_and_flows,
+                            tun_br_name)))
+        self._timed_startup_phase('bridges', self._run_bridge_setups, setups)
+
     def setup_integration_br(self):
         '''Setup the integration bridge.
 
@@ -1374,6 +1488,8 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
         self.int_br.set_secure_mode()
         self.int_br.setup_controllers(self.conf)
         self.int_br.set_igmp_snooping_state(self.conf.OVS.igmp_snooping_enable)
+        if self.restart_flow_diff:
+            self.int_br.start_flow_diff()
 
         if self.conf.AGENT.drop_flows_on_start:
             # Delete the patch port between br-int and br-tun if we're deleting
@@ -1428,6 +1544,8 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
         # cases where something like datapath_type has changed
         self.tun_br.create(secure_mode=True)
         self.tun_br.setup_controllers(self.conf)
+        if self.restart_flow_diff:
+            self.tun_br.start_flow_diff()
         if (not self.int_br.port_exists(self.conf.OVS.int_peer_patch_port) or
                 self.patch_tun_ofport == ovs_lib.INVALID_OFPORT):
             self.patch_tun_ofport = self.int_br.add_patch_port(
@@ -1520,6 +1638,7 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
         :param bridge_mappings: map physical network names to bridge names.
         '''
         datapath_ids_set = set()
+        setups = []
         ovs = ovs_lib.BaseOVS()
         ovs_bridges = ovs.get_bridges()
         for physical_network, bridge in bridge_mappings.items():
@@ -1537,71 +1656,77 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
                 sys.exit(1)
             br = self.br_phys_cls(bridge)
             self._check_bridge_datapath_id(br, datapath_ids_set)
+            setups.append((self._setup_physical_bridge,
+                           (physical_network, bridge, br)))
+        self._run_bridge_setups(setups)
+
+    def _setup_physical_bridge(self, physical_network, bridge, br):
+        # The bridge already exists, so create won't recreate it, but will
+        # handle things like changing the datapath_type
+        br.create()
+        br.set_secure_mode()
+        br.setup_controllers(self.conf)
+        if cfg.CONF.AGENT.drop_flows_on_start:
+            br.uninstall_flows(cookie=ovs_lib.COOKIE_ANY)
+        elif self.restart_flow_diff:
+            br.start_flow_diff()
+        br.setup_default_table()
+        self.phys_brs[physical_network] = br
+
+        # interconnect physical and integration bridges using veth/patches
+        int_if_name = plugin_utils.get_interface_name(
+            bridge, prefix=constants.PEER_INTEGRATION_PREFIX)
+        phys_if_name = plugin_utils.get_interface_name(
+            bridge, prefix=constants.PEER_PHYSICAL_PREFIX)
+        # Interface type of port for physical and integration bridges must
+        # be same, so check only one of them.
+        # Not logging error here, as the interface may not exist yet.
+        # Type check is done to cleanup wrong interface if any.
+
+        # TODO(slaweq) In X release we can remove code which is here just
+        # to move from old "veth" interconnection between bridges to the
+        # patch ports (L1527 - L1547)
+        int_type = self.int_br.db_get_val("Interface", int_if_name, "type",
+                                          log_errors=False)
+        # Drop ports if the interface type doesn't match the
+        # configuration value
+        if int_type == 'veth':
+            self.int_br.delete_port(int_if_name)
+            br.delete_port(phys_if_name)
+
+        # Setup int_br to physical bridge patches.  If they already
+        # exist we leave them alone, otherwise we create them but don't
+        # connect them until after the drop rules are in place.
+        if self.int_br.port_exists(int_if_name):
+            int_ofport = self.int_br.get_port_ofport(int_if_name)
+        else:
+            int_ofport = self.int_br.add_patch_port(
+                int_if_name, constants.NONEXISTENT_PEER)
+        self.int_br.set_igmp_snooping_flood(
+            int_if_name, self.conf.OVS.igmp_snooping_enable)
+        if br.port_exists(phys_if_name):
+            phys_ofport = br.get_port_ofport(phys_if_name)
+        else:
+            phys_ofport = br.add_patch_port(
+                phys_if_name, constants.NONEXISTENT_PEER)
 
-            # The bridge already exists, so create won't recreate it, but will
-            # handle things like changing the datapath_type
-            br.create()
-            br.set_secure_mode()
-            br.setup_controllers(self.conf)
-            if cfg.CONF.AGENT.drop_flows_on_start:
-                br.uninstall_flows(cookie=ovs_lib.COOKIE_ANY)
-            br.setup_default_table()
-            self.phys_brs[physical_network] = br
-
-            # interconnect physical and integration bridges using veth/patches
-            int_if_name = plugin_utils.get_interface_name(
-                bridge, prefix=constants.PEER_INTEGRATION_PREFIX)
-            phys_if_name = plugin_utils.get_interface_name(
-                bridge, prefix=constants.PEER_PHYSICAL_PREFIX)
-            # Interface type of port for physical and integration bridges must
-            # be same, so check only one of them.
-            # Not logging error here, as the interface may not exist yet.
-            # Type check is done to cleanup wrong interface if any.
-
-            # TODO(slaweq) In X release we can remove code which is here just
-            # to move from old "veth" interconnection between bridges to the
-            # patch ports (L1527 - L1547)
-            int_type = self.int_br.db_get_val("Interface", int_if_name, "type",
-                                              log_errors=False)
-            # Drop ports if the interface type doesn't match the
-            # configuration value
-            if int_type == 'veth':
-                self.int_br.delete_port(int_if_name)
-                br.delete_port(phys_if_name)
-
-            # Setup int_br to physical bridge patches.  If they already
-            # exist we leave them alone, otherwise we create them but don't
-            # connect them until after the drop rules are in place.
-            if self.int_br.port_exists(int_if_name):
-                int_ofport = self.int_br.get_port_ofport(int_if_name)
-            else:
-                int_ofport = self.int_br.add_patch_port(
-                    int_if_name, constants.NONEXISTENT_PEER)
-            self.int_br.set_igmp_snooping_flood(
-                int_if_name, self.conf.OVS.igmp_snooping_enable)
-            if br.port_exists(phys_if_name):
-                phys_ofport = br.get_port_ofport(phys_if_name)
-            else:
-                phys_ofport = br.add_patch_port(
-                    phys_if_name, constants.NONEXISTENT_PEER)
-
-            self.int_ofports[physical_network] = int_ofport
-            self.phys_ofports[physical_network] = phys_ofport
+        self.int_ofports[physical_network] = int_ofport
+        self.phys_ofports[physical_network] = phys_ofport
 
-            # Drop packets from physical bridges that have not matched a higher
-            # priority flow to set a local vlan. This prevents these stray
-            # packets from being forwarded to other physical bridges which
-            # could cause a network loop in the physical network.
-            self.int_br.drop_port(in_port=int_ofport)
+        # Drop packets from physical bridges that have not matched a higher
+        # priority flow to set a local vlan. This prevents these stray
+        # packets from being forwarded to other physical bridges which
+        # could cause a network loop in the physical network.
+        self.int_br.drop_port(in_port=int_ofport)
 
-            if not self.enable_distributed_routing:
-                br.drop_port(in_port=phys_ofport)
+        if not self.enable_distributed_routing:
+            br.drop_port(in_port=phys_ofport)
 
-            # associate patch ports to pass traffic
-            self.int_br.set_db_attribute('Interface', int_if_name,
-                                         'options', {'peer': phys_if_name})
-            br.set_db_attribute('Interface', phys_if_name,
-                                'options', {'peer': int_if_name})
+        # associate patch ports to pass traffic
+        self.int_br.set_db_attribute('Interface', int_if_name,
+                                     'options', {'peer': phys_if_name})
+        br.set_db_attribute('Interface', phys_if_name,
+                            'options', {'peer': int_if_name})
 
     def update_stale_ofport_rules(self):
         # ARP spoofing rules and drop-flow upon port-delete
@@ -1852,18 +1977,23 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
             LOG.debug("No VIF port for port %s defined on agent.", port_id)
         return port_needs_binding
 
-    def _setup_tunnel_port(self, br, port_name, remote_ip, tunnel_type):
+    def _is_valid_tunnel_remote_ip(self, remote_ip):
         try:
             if (netaddr.IPAddress(self.local_ip).version !=
                     netaddr.IPAddress(remote_ip).version):
                 LOG.error("IP version mismatch, cannot create tunnel: "
                           "local_ip=%(lip)s remote_ip=%(rip)s",
                           {'lip': self.local_ip, 'rip': remote_ip})
-                return 0
+                return False
         except Exception:
             LOG.error("Invalid local or remote IP, cannot create tunnel: "
                       "local_ip=%(lip)s remote_ip=%(rip)s",
                       {'lip': self.local_ip, 'rip': remote_ip})
+            return False
+        return True
+
+    def _setup_tunnel_port(self, br, port_name, remote_ip, tunnel_type):
+        if not self._is_valid_tunnel_remote_ip(remote_ip):
             return 0
         ofport = br.add_tunnel_port(port_name,
                                     remote_ip,
@@ -1884,6 +2014,65 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
         br.setup_tunnel_port(tunnel_type, ofport)
         return ofport
 
+    def _setup_tunnel_ports(self, br, remote_ips, tunnel_type):
+        """Create the missing tunnel ports to the given remote IPs
+
+        The tunnel ports are created in a single OVSDB transaction and the
+        flooding flows are updated once.
+
+        :returns: the remote IPs whose tunnel port could not be created.
+        """
+        tunnels = {}
+        for remote_ip in remote_ips:
+            if (remote_ip == self.local_ip or
+                    remote_ip in self.tun_br_ofports[tunnel_type] or
+                    not self._is_valid_tunnel_remote_ip(remote_ip)):
+                continue
+            port_name = self.get_tunnel_name(
+                tunnel_type, self.local_ip, remote_ip)
+            if port_name is not None:
+                tunnels[port_name] = remote_ip
+        if not tunnels:
+            return set()
+
+        ofports = br.add_tunnel_ports(tunnels,
+                                      self.local_ip,
+                                      tunnel_type,
+                                      self.vxlan_udp_port,
+                                      self.dont_fragment,
+                                      self.tunnel_csum,
+                                      self.tos)
+        failed_remote_ips = set()
+        for port_name, remote_ip in tunnels.items():
+            ofport = ofports.get(port_name, ovs_lib.INVALID_OFPORT)
+            if ofport == ovs_lib.INVALID_OFPORT:
+                LOG.error("Failed to set-up %(type)s tunnel port to %(ip)s",
+                          {'type': tunnel_type, 'ip': remote_ip})
+                failed_remote_ips.add(remote_ip)
+                continue
+            self.tun_br_ofports[tunnel_type][remote_ip] = ofport
+            br.setup_tunnel_port(tunnel_type, ofport)
+        LOG.info("Created %(count)d %(type)s tunnel ports",
+                 {'count': len(tunnels) - len(failed_remote_ips),
+                  'type': tunnel_type})
+        self._setup_tunnel_flood_flow(br, tunnel_type)
+        return failed_remote_ips
+
+    def process_pending_tunnels(self):
+        pending_tunnels = self.pending_tunnels
+        self.pending_tunnels = collections.defaultdict(set)
+        try:
+            for tunnel_type, remote_ips in pending_tunnels.items():
+                failed_remote_ips = self._setup_tunnel_ports(
+                    self.tun_br, remote_ips, tunnel_type)
+                if failed_remote_ips:
+                    # Retry in the next iteration
+                    self.pending_tunnels[tunnel_type] |= failed_remote_ips
+        except Exception:
+            LOG.exception("Error while configuring tunnel endpoints")
+            for tunnel_type, remote_ips in pending_tunnels.items():
+                self.pending_tunnels[tunnel_type] |= remote_ips
+
     def _setup_tunnel_flood_flow(self, br, tunnel_type):
         ofports = self.tun_br_ofports[tunnel_type].values()
         if ofports and not self.l2_pop:
@@ -1922,83 +2111,134 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
                     br.cleanup_tunnel_port(ofport)
                     self.tun_br_ofports[tunnel_type].pop(remote_ip, None)
 
+    def _get_devices_details_chunks(self, devices, agent_restarted):
+        """Yield the details of the given devices, one chunk at a time.
+
+        If rpc_devices_details_chunk_size is set, the details of the next
+        chunk are retrieved in a greenthread while the caller is processing
+        the current one.
+        """
+        chunk_size = self.conf.AGENT.rpc_devices_details_chunk_size
+        if not chunk_size or len(devices) <= chunk_size:
+            yield self.plugin_rpc.get_devices_details_list_and_failed_devices(
+                self.context, devices, self.agent_id, self.conf.host,
+                agent_restarted)
+            return
+
+        devices = list(devices)
+        chunks = [devices[i:i + chunk_size]
+                  for i in range(0, len(devices), chunk_size)]
+
+        def _get_chunk_details(index):
+            start = time.time()
+            details = (
+                self.plugin_rpc.get_devices_details_list_and_failed_devices(
+                    self.context, chunks[index], self.agent_id,
+                    self.conf.host, agent_restarted))
+            LOG.info("treat_devices_added_or_updated - iteration:"
+                     "%(iter_num)d - details of chunk %(chunk)d/%(chunks)d "
+                     "(%(num_devices)d devices) retrieved in "
+                     "%(elapsed).3f",
+                     {'iter_num': self.iter_num, 'chunk': index + 1,
+                      'chunks': len(chunks),
+                      'num_devices': len(chunks[index]),
+                      'elapsed': time.time() - start})
+            return details
+
+        next_chunk = eventlet.spawn(_get_chunk_details, 0)
+        try:
+            for index in range(len(chunks)):
+                chunk_details = next_chunk.wait()
+                next_chunk = None
+                if index + 1 < len(chunks):
+                    next_chunk = eventlet.spawn(_get_chunk_details,
+                                                index + 1)
+                start = time.time()
+                yield chunk_details
+                LOG.info("treat_devices_added_or_updated - iteration:"
+                         "%(iter_num)d - chunk %(chunk)d/%(chunks)d "
+                         "processed in %(elapsed).3f",
+                         {'iter_num': self.iter_num, 'chunk': index + 1,
+                          'chunks': len(chunks),
+                          'elapsed': time.time() - start})
+        finally:
+            # NOTE: if the caller stopped before the last chunk, on an error
+            # or when the generator is closed, the details being retrieved
+            # are not needed anymore.
+            if next_chunk is not None:
+                next_chunk.kill()
+
     def treat_devices_added_or_updated(self, devices, provisioning_needed,
                                        re_added):
         skipped_devices = []
         need_binding_devices = []
         binding_no_activated_devices = set()
         migrating_devices = set()
-        agent_restarted = self.iter_num == 0
-        devices_details_list = (
-            self.plugin_rpc.get_devices_details_list_and_failed_devices(
-                self.context,
-                devices,
-                self.agent_id,
-                self.conf.host,
-                agent_restarted))
-        failed_devices = set(devices_details_list.get('failed_devices'))
-
-        devices = devices_details_list.get('devices')
-        vif_by_id = self.int_br.get_vifs_by_ids(
-            [vif['device'] for vif in devices])
+        failed_devices = set()
         devices_not_in_datapath = set()
-        for details in devices:
-            device = details['device']
-            LOG.debug("Processing port: %s", device)
-            port = vif_by_id.get(device)
-            if not port:
-                # The port disappeared and cannot be processed
-                LOG.info("Port %s was not found on the integration bridge "
-                         "and will therefore not be processed", device)
-                self.ext_manager.delete_port(self.context, {'port_id': device})
-                skipped_devices.append(device)
-                continue
-
-            if not port.ofport or port.ofport == ovs_lib.INVALID_OFPORT:
-                devices_not_in_datapath.add(device)
-
-            migrating_to = details.get('migrating_to')
-            if migrating_to and migrating_to != self.host:
-                LOG.info('Port %(device)s is being migrated to host %(host)s.',
-                         {'device': device, 'host': migrating_to})
-                migrating_devices.add(device)
-
-            if 'port_id' in details:
-                LOG.info("Port %(device)s updated. Details: %(details)s",
-                         {'device': device, 'details': details})
-                details['vif_port'] = port
-                need_binding = self.treat_vif_port(port, details['port_id'],
-                                                   details['network_id'],
-                                                   details['network_type'],
-                                                   details['physical_network'],
-                                                   details['segmentation_id'],
-                                                   details['admin_state_up'],
-                                                   details['fixed_ips'],
-                                                   details['device_owner'],
-                                                   provisioning_needed)
-                if need_binding:
-                    need_binding_devices.append(details)
-                self._update_port_network(details['port_id'],
-                                          details['network_id'])
-                if details['device'] in re_added:
-                    self.ext_manager.delete_port(self.context, details)
-                if device not in devices_not_in_datapath:
-                    self.ext_manager.handle_port(self.context, details)
+        agent_restarted = self.iter_num == 0
+        for devices_details_list in self._get_devices_details_chunks(
+                devices, agent_restarted):
+            failed_devices |= set(devices_details_list.get('failed_devices'))
+            devices = devices_details_list.get('devices')
+            vif_by_id = self.int_br.get_vifs_by_ids(
+                [vif['device'] for vif in devices])
+            for details in devices:
+                device = details['device']
+                LOG.debug("Processing port: %s", device)
+                port = vif_by_id.get(device)
+                if not port:
+                    # The port disappeared and cannot be processed
+                    LOG.info("Port %s was not found on the integration "
+                             "bridge and will therefore not be processed",
+                             device)
+                    self.ext_manager.delete_port(self.context,
+                                                 {'port_id': device})
+                    skipped_devices.append(device)
+                    continue
+
+                if not port.ofport or port.ofport == ovs_lib.INVALID_OFPORT:
+                    devices_not_in_datapath.add(device)
+
+                migrating_to = details.get('migrating_to')
+                if migrating_to and migrating_to != self.host:
+                    LOG.info('Port %(device)s is being migrated to host '
+                             '%(host)s.',
+                             {'device': device, 'host': migrating_to})
+                    migrating_devices.add(device)
+
+                if 'port_id' in details:
+                    LOG.info("Port %(device)s updated. Details: %(details)s",
+                             {'device': device, 'details': details})
+                    details['vif_port'] = port
+                    need_binding = self.treat_vif_port(
+                        port, details['port_id'], details['network_id'],
+                        details['network_type'], details['physical_network'],
+                        details['segmentation_id'], details['admin_state_up'],
+                        details['fixed_ips'], details['device_owner'],
+                        provisioning_needed)
+                    if need_binding:
+                        need_binding_devices.append(details)
+                    self._update_port_network(details['port_id'],
+                                              details['network_id'])
+                    if details['device'] in re_added:
+                        self.ext_manager.delete_port(self.context, details)
+                    if device not in devices_not_in_datapath:
+                        self.ext_manager.handle_port(self.context, details)
 
-            else:
-                if n_const.NO_ACTIVE_BINDING in details:
-                    # Port was added to the bridge, but its binding in this
-                    # agent hasn't been activated yet. It will be treated as
-                    # added when binding is activated
-                    binding_no_activated_devices.add(device)
-                    LOG.debug("Device %s has no active binding in host",
-                              device)
                 else:
-                    LOG.warning(
-                        "Device %s not defined on plugin or binding failed",
-                        device)
-                if (port and port.ofport != -1):
-                    self.port_dead(port)
+                    if n_const.NO_ACTIVE_BINDING in details:
+                        # Port was added to the bridge, but its binding in
+                        # this agent hasn't been activated yet. It will be
+                        # treated as added when binding is activated
+                        binding_no_activated_devices.add(device)
+                        LOG.debug("Device %s has no active binding in host",
+                                  device)
+                    else:
+                        LOG.warning("Device %s not defined on plugin or "
+                                    "binding failed", device)
+                    if (port and port.ofport != -1):
+                        self.port_dead(port)
         return (skipped_devices, binding_no_activated_devices,
                 need_binding_devices, failed_devices, devices_not_in_datapath,
                 migrating_devices)
@@ -2076,7 +2316,36 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
         if failed_devices:
             LOG.debug("Port down failed for %s", failed_devices)
 
+    def _get_flow_transaction_bridges(self):
+        bridges = [self.int_br] + list(self.phys_brs.values())
+        if self.enable_tunneling:
+            bridges.append(self.tun_br)
+        return bridges
+
+    @contextlib.contextmanager
+    def _flow_transaction(self):
+        if not self.conf.AGENT.flow_transactions:
+            yield
+            return
+        with contextlib.ExitStack() as stack:
+            for bridge in self._get_flow_transaction_bridges():
+                stack.enter_context(bridge.flow_transaction())
+            yield
+
+    def _commit_flow_transaction(self):
+        # NOTE: the firewall drivers send their flows with ovs-ofctl, out of
+        # the flow transaction, and the ports are reported up once bound, so
+        # the flows of every bridge must be committed before.
+        if self.conf.AGENT.flow_transactions:
+            for bridge in self._get_flow_transaction_bridges():
+                bridge.commit_flow_transaction()
+
     def process_network_ports(self, port_info, provisioning_needed):
+        with self._flow_transaction():
+            return self._process_network_ports(port_info,
+                                               provisioning_needed)
+
+    def _process_network_ports(self, port_info, provisioning_needed):
         failed_devices = {'added': set(), 'removed': set()}
         # TODO(salv-orlando): consider a solution for ensuring notifications
         # are processed exactly in the same order in which they were
@@ -2128,6 +2397,7 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
         self._add_port_tag_info(need_binding_devices)
         self.process_install_ports_egress_flows(need_binding_devices)
         added_to_datapath = added_ports - devices_not_in_datapath
+        self._commit_flow_transaction()
         self.sg_agent.setup_port_filters(added_to_datapath,
                                          port_info.get('updated', set()))
 
@@ -2135,10 +2405,12 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
                  "agent port security group processed in %(elapsed).3f",
                  {'iter_num': self.iter_num,
                   'elapsed': time.time() - start})
+        self._commit_flow_transaction()
         failed_devices['added'] |= self._bind_devices(need_binding_devices)
 
         if 'removed' in port_info and port_info['removed']:
             start = time.time()
+            self._commit_flow_transaction()
             failed_devices['removed'] |= self.treat_devices_removed(
                 port_info['removed'])
             LOG.info("process_network_ports - iteration:%(iter_num)d - "
@@ -2313,11 +2585,27 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
             LOG.warning("Invalid remote IP: %s", ip_address)
             return
 
+    def _bulk_tunnel_sync(self, tunnel_type):
+        details = self.plugin_rpc.tunnel_sync(
+            self.context, self.local_ip, tunnel_type, self.conf.host,
+            tunnels_version=self.tunnels_version.get(tunnel_type))
+        if self.l2_pop:
+            return False
+        remote_ips = {tunnel['ip_address'] for tunnel in details['tunnels']}
+        if self._setup_tunnel_ports(self.tun_br, remote_ips, tunnel_type):
+            return True
+        self.tunnels_version[tunnel_type] = details.get('tunnels_version')
+        return False
+
     def tunnel_sync(self):
         LOG.debug("Configuring tunnel endpoints to other OVS agents")
 
+        resync = False
         try:
             for tunnel_type in self.tunnel_types:
+                if self.bulk_tunnel_sync:
+                    resync |= self._bulk_tunnel_sync(tunnel_type)
+                    continue
                 details = self.plugin_rpc.tunnel_sync(self.context,
                                                       self.local_ip,
                                                       tunnel_type,
@@ -2340,7 +2628,7 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
             LOG.debug("Unable to sync tunnel IP %(local_ip)s: %(e)s",
                       {'local_ip': self.local_ip, 'e': e})
             return True
-        return False
+        return resync
 
     @classmethod
     def get_tunnel_name(cls, network_type, local_ip, remote_ip):
@@ -2360,6 +2648,7 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
     def _agent_has_updates(self, polling_manager):
         return (polling_manager.is_polling_required or
                 self.updated_ports or
+                not self.port_update_queue.empty() or
                 self.deleted_ports or
                 self.deactivated_bindings or
                 self.activated_bindings or
@@ -2391,9 +2680,11 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
         elapsed = time.time() - start_time
         LOG.info("Agent rpc_loop - iteration:%(iter_num)d "
                  "completed. Processed ports statistics: "
-                 "%(port_stats)s. Elapsed:%(elapsed).3f",
+                 "%(port_stats)s. Port sync iterations: %(sync_stats)s. "
+                 "Elapsed:%(elapsed).3f",
                  {'iter_num': self.iter_num,
                   'port_stats': port_stats,
+                  'sync_stats': self.port_sync_stats,
                   'elapsed': elapsed})
         if elapsed < self.polling_interval:
             time.sleep(self.polling_interval - elapsed)
@@ -2427,6 +2718,8 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
         if self.enable_tunneling:
             LOG.info("Cleaning stale %s flows", self.tun_br.br_name)
             self.tun_br.cleanup_flows()
+        # The flows of the bridges recreated later are not compared
+        self.restart_flow_diff = False
 
     def process_port_info(self, start, polling_manager, sync, ovs_restarted,
                           ports, ancillary_ports, updated_ports_copy,
@@ -2460,6 +2753,7 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
             # calling polling_manager.get_events() since
             # the agent might miss some event (for example a port
             # deletion)
+            self.port_sync_stats['full'] += 1
             reg_ports = (set() if ovs_restarted else ports)
             port_info = self.scan_ports(reg_ports, sync,
                                         updated_ports_copy)
@@ -2477,6 +2771,7 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
 
         else:
             consecutive_resyncs = 0
+            self.port_sync_stats['incremental'] += 1
             events = polling_manager.get_events()
             port_info, ancillary_port_info, ports_not_ready_yet = (
                 self.process_ports_events(events, ports, ancillary_ports,
@@ -2494,6 +2789,53 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
         return (port_info, ancillary_port_info, consecutive_resyncs,
                 ports_not_ready_yet)
 
+    def _requeue_port_info_changes(self, polling_manager, port_info,
+                                   ancillary_port_info, failed_devices,
+                                   failed_ancillary_devices,
+                                   failed_devices_retries_map):
+        """Keep the port changes of a failed iteration for the next one.
+
+        When incremental port sync is enabled, the ports added and removed
+        in the failed iteration are retried as failed devices, the events
+        they came from being already consumed from the polling manager.
+        The retries are counted in failed_devices_retries_map. Returns False
+        if a full resync is needed instead, including when a device was
+        already retried MAX_DEVICE_RETRIES times.
+        """
+        if (not self.incremental_port_sync or
+                not hasattr(polling_manager, 'get_events') or
+                'current' not in port_info):
+            return False
+        devices = set()
+        for event in ('added', 'removed'):
+            devices |= (failed_devices[event] |
+                        failed_ancillary_devices[event] |
+                        port_info.get(event, set()) |
+                        ancillary_port_info.get(event, set()))
+        exhausted = [dev for dev in devices
+                     if failed_devices_retries_map.get(dev, 0) >=
+                     constants.MAX_DEVICE_RETRIES]
+        if exhausted:
+            LOG.warning("Devices %(devs)s failed for %(times)s times, doing "
+                        "a full resync", {
+                            'devs': exhausted,
+                            'times': constants.MAX_DEVICE_RETRIES})
+            return False
+        for dev in devices:
+            failed_devices_retries_map[dev] = (
+                failed_devices_retries_map.get(dev, 0) + 1)
+        for event in ('added', 'removed'):
+            failed_devices[event] |= port_info.get(event, set())
+            failed_ancillary_devices[event] |= ancillary_port_info.get(
+                event, set())
+        LOG.info("Agent rpc_loop - iteration:%(iter_num)d - retrying "
+                 "%(added)d added and %(removed)d removed ports in the next "
+                 "iteration without a full resync",
+                 {'iter_num': self.iter_num,
+                  'added': len(failed_devices['added']),
+                  'removed': len(failed_devices['removed'])})
+        return True
+
     def _remove_devices_not_to_retry(self, failed_devices,
                                      failed_ancillary_devices,
                                      devices_not_to_retry,
@@ -2637,6 +2979,8 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
                 except Exception:
                     LOG.exception("Error while configuring tunnel endpoints")
                     tunnel_sync = True
+            if self.enable_tunneling and any(self.pending_tunnels.values()):
+                self.process_pending_tunnels()
             ovs_restarted |= (self.ovs_status == constants.OVS_RESTARTED)
             devices_need_retry = (any(failed_devices.values()) or
                                   any(failed_ancillary_devices.values()) or
@@ -2662,6 +3006,7 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
                     # case resync would be needed, and then clear
                     # self.updated_ports. As the greenthread should not yield
                     # between these two statements, this will be thread-safe
+                    self.updated_ports |= self._get_queued_port_updates()
                     updated_ports_copy = self.updated_ports
                     self.updated_ports = set()
                     activated_bindings_copy = self.activated_bindings
@@ -2737,7 +3082,10 @@ class OVSNeutronAgent(l2population_rpc.L2populationRpcCallBackTunnelMixin,
                     # Put the ports back in self.updated_port
                     self.updated_ports |= updated_ports_copy
                     self.activated_bindings |= activated_bindings_copy
-                    sync = True
+                    sync = not self._requeue_port_info_changes(
+                        polling_manager, port_info, ancillary_port_info,
+                        failed_devices, failed_ancillary_devices,
+                        failed_devices_retries_map)
             port_stats = self.get_port_stats(port_info, ancillary_port_info)
             self.loop_count_and_wait(start, port_stats)
 
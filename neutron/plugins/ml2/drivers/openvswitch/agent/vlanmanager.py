@@ -31,17 +31,102 @@ class MappingNotFound(exceptions.NeutronException):
     message = _('Mapping for network %(net_id)s not found.')
 
 
+class _VifPortsDict(dict):
+    """Dictionary of VIF ports that keeps the VLAN manager port index updated.
+
+    The OVS agent adds and removes ports directly on ``lvm.vif_ports``; every
+    mutation is reported to the mapping owning the dictionary so that the
+    port lookups of the LocalVlanManager stay consistent.
+    """
+
+    def __init__(self, mapping, *args, **kwargs):
+        self._mapping = mapping
+        super(_VifPortsDict, self).__init__()
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, vif_id, port):
+        super(_VifPortsDict, self).__setitem__(vif_id, port)
+        self._mapping._port_added(vif_id)
+
+    def __delitem__(self, vif_id):
+        super(_VifPortsDict, self).__delitem__(vif_id)
+        self._mapping._port_removed(vif_id)
+
+    _marker = object()
+
+    def pop(self, vif_id, default=_marker):
+        if vif_id in self:
+            port = self[vif_id]
+            del self[vif_id]
+            return port
+        if default is self._marker:
+            raise KeyError(vif_id)
+        return default
+
+    def popitem(self):
+        vif_id, port = super(_VifPortsDict, self).popitem()
+        self._mapping._port_removed(vif_id)
+        return vif_id, port
+
+    def setdefault(self, vif_id, default=None):
+        if vif_id not in self:
+            self[vif_id] = default
+        return self[vif_id]
+
+    def update(self, *args, **kwargs):
+        for vif_id, port in dict(*args, **kwargs).items():
+            self[vif_id] = port
+
+    def clear(self):
+        for vif_id in list(self):
+            del self[vif_id]
+
+
 class LocalVLANMapping(object):
     def __init__(self, vlan, network_type, physical_network, segmentation_id,
                  vif_ports=None):
+        # the manager and the network id are only set while the mapping is
+        # registered in a LocalVlanManager
+        self._manager = None
+        self._net_id = None
         self.vlan = vlan
         self.network_type = network_type
         self.physical_network = physical_network
         self.segmentation_id = segmentation_id
-        self.vif_ports = vif_ports or {}
+        self._vif_ports = _VifPortsDict(self)
+        self.vif_ports = vif_ports
         # set of tunnel ports on which packets should be flooded
         self.tun_ofports = set()
 
+    @property
+    def vif_ports(self):
+        return self._vif_ports
+
+    @vif_ports.setter
+    def vif_ports(self, vif_ports):
+        if isinstance(self._vif_ports, _VifPortsDict):
+            self._vif_ports.clear()
+        if vif_ports and not isinstance(vif_ports, dict):
+            # NOTE: not a dictionary of ports, stored as is and not indexed
+            self._vif_ports = vif_ports
+            return
+        if not isinstance(self._vif_ports, _VifPortsDict):
+            self._vif_ports = _VifPortsDict(self)
+        self._vif_ports.update(vif_ports or {})
+
+    def _indexed_vif_ids(self):
+        if isinstance(self._vif_ports, _VifPortsDict):
+            return list(self._vif_ports)
+        return []
+
+    def _port_added(self, vif_id):
+        if self._manager:
+            self._manager._index_port(self, vif_id)
+
+    def _port_removed(self, vif_id):
+        if self._manager:
+            self._manager._unindex_port(self, vif_id)
+
     def __str__(self):
         return ("lv-id = %s type = %s phys-net = %s phys-id = %s" %
                 (self.vlan, self.network_type, self.physical_network,
@@ -62,6 +147,10 @@ class LocalVLANMapping(object):
 class LocalVlanManager(object):
     """Singleton manager that maps internal VLAN mapping to external network
     segmentation ids.
+
+    Besides the network id keyed mapping, the manager keeps a port id ->
+    network id index so the agent does not have to walk every mapping to
+    find where a port belongs.
     """
 
     def __new__(cls):
@@ -72,6 +161,7 @@ class LocalVlanManager(object):
     def __init__(self):
         if not hasattr(self, 'mapping'):
             self.mapping = {}
+            self._port_index = {}
 
     def __contains__(self, key):
         return key in self.mapping
@@ -84,18 +174,30 @@ class LocalVlanManager(object):
         for item in self.mapping.items():
             yield item
 
+    def _index_port(self, lvm, vif_id):
+        self._port_index[vif_id] = lvm._net_id
+
+    def _unindex_port(self, lvm, vif_id):
+        if self._port_index.get(vif_id) == lvm._net_id:
+            del self._port_index[vif_id]
+
     def add(self, net_id, vlan, network_type, physical_network,
             segmentation_id, vif_ports=None):
         if net_id in self.mapping:
             raise MappingAlreadyExists(net_id=net_id)
-        self.mapping[net_id] = LocalVLANMapping(
+        lvm = LocalVLANMapping(
             vlan, network_type, physical_network, segmentation_id, vif_ports)
+        lvm._manager = self
+        lvm._net_id = net_id
+        self.mapping[net_id] = lvm
+        for vif_id in lvm._indexed_vif_ids():
+            self._index_port(lvm, vif_id)
 
     def get_net_uuid(self, vif_id):
-        for network_id, vlan_mapping in self.mapping.items():
-            if vif_id in vlan_mapping.vif_ports:
-                return network_id
-        raise VifIdNotFound(vif_id=vif_id)
+        try:
+            return self._port_index[vif_id]
+        except (KeyError, TypeError):
+            raise VifIdNotFound(vif_id=vif_id)
 
     def get(self, net_id):
         try:
@@ -105,9 +207,15 @@ class LocalVlanManager(object):
 
     def pop(self, net_id):
         try:
-            return self.mapping.pop(net_id)
+            lvm = self.mapping.pop(net_id)
         except KeyError:
             raise MappingNotFound(net_id=net_id)
+        if getattr(lvm, '_manager', None) is self:
+            for vif_id in lvm._indexed_vif_ids():
+                self._unindex_port(lvm, vif_id)
+            lvm._manager = None
+            lvm._net_id = None
+        return lvm
 
     def update_segmentation_id(self, net_id, segmentation_id):
         try:
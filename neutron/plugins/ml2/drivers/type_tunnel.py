@@ -13,6 +13,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 import abc
+import hashlib
 import itertools
 import operator
 
@@ -392,6 +393,13 @@ class TunnelRpcCallbackMixin(object):
         self._notifier = notifier
         self._type_manager = type_manager
 
+    @staticmethod
+    def _get_tunnels_version(tunnels):
+        endpoints = sorted((tunnel['ip_address'], tunnel.get('host') or '',
+                            str(tunnel.get('udp_port') or ''))
+                           for tunnel in tunnels)
+        return hashlib.sha256(str(endpoints).encode()).hexdigest()
+
     def tunnel_sync(self, rpc_context, **kwargs):
         """Update new tunnel.
 
@@ -464,7 +472,11 @@ class TunnelRpcCallbackMixin(object):
 
             tunnel = driver.obj.add_endpoint(tunnel_ip, host)
             tunnels = driver.obj.get_endpoints()
-            entry = {'tunnels': tunnels}
+            tunnels_version = self._get_tunnels_version(tunnels)
+            if kwargs.get('tunnels_version') == tunnels_version:
+                # The agent already knows every endpoint
+                tunnels = []
+            entry = {'tunnels': tunnels, 'tunnels_version': tunnels_version}
             # Notify all other listening agents
             self._notifier.tunnel_update(rpc_context, tunnel.ip_address,
                                          tunnel_type)
@@ -64,7 +64,9 @@ class RpcCallbacks(type_tunnel.TunnelRpcCallbackMixin):
     #       - update_device_up
     #       - update_device_list (indirectly, called from update_device_down
     #         and update_device_up)
-    target = oslo_messaging.Target(version='1.9')
+    #   1.10 tunnel_sync accepts a tunnels_version token and only returns the
+    #        tunnel endpoints if they changed since that version
+    target = oslo_messaging.Target(version='1.10')
 
     def __init__(self, notifier, type_manager):
         self.setup_tunnel_callback_mixin(notifier, type_manager)
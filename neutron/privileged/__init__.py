@@ -35,7 +35,8 @@ dhcp_release_cmd = priv_context.PrivContext(
     cfg_section='privsep_dhcp_release',
     pypath=__name__ + '.dhcp_release_cmd',
     capabilities=[caps.CAP_SYS_ADMIN,
-                  caps.CAP_NET_ADMIN]
+                  caps.CAP_NET_ADMIN,
+                  caps.CAP_NET_RAW]
 )
 
 
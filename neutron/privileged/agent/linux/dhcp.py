@@ -10,10 +10,29 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import os
+import socket
+import struct
+
 from oslo_concurrency import processutils
+from pyroute2 import netns
 
 from neutron import privileged
 
+# dhcp_release builds the DHCPRELEASE packets with the layout of the dnsmasq
+# struct dhcp_packet: the BOOTP header, the magic cookie and 308 bytes of
+# options.
+DHCP_SERVER_PORT = 67
+DHCP_COOKIE = 0x63825363
+DHCP_PACKET_SIZE = 548
+BOOTREQUEST = 1
+ARPHRD_ETHER = 1
+DHCPRELEASE = 7
+OPTION_MESSAGE_TYPE = 53
+OPTION_SERVER_IDENTIFIER = 54
+OPTION_CLIENT_ID = 61
+OPTION_END = 255
+
 
 @privileged.dhcp_release_cmd.entrypoint
 def dhcp_release(interface_name, ip_address, mac_address, client_id,
@@ -46,3 +65,69 @@ def dhcp_release6_supported():
     result = processutils.execute(*cmd, check_exit_code=False,
                                   env_variables={'LC_ALL': 'C'})
     return not bool(result[1])
+
+
+def _parse_hex(value):
+    """Parses colon separated hex bytes, or returns the bytes of value."""
+    try:
+        return bytes(int(byte, 16) for byte in value.split(':'))
+    except ValueError:
+        return value.encode()
+
+
+def _build_dhcp_release_packet(ip_address, mac_address, client_id,
+                               server_address):
+    chaddr = _parse_hex(mac_address)[:16]
+    options = struct.pack('!BBB', OPTION_MESSAGE_TYPE, 1, DHCPRELEASE)
+    options += struct.pack('!BB4s', OPTION_SERVER_IDENTIFIER, 4,
+                           socket.inet_aton(server_address))
+    if client_id and client_id != '*':
+        client_id = _parse_hex(client_id)[:255]
+        options += struct.pack('!BB', OPTION_CLIENT_ID, len(client_id))
+        options += client_id
+    options += struct.pack('!B', OPTION_END)
+    header = struct.pack('!BBBBIHH4s4s4s4s16s64s128sI', BOOTREQUEST,
+                         ARPHRD_ETHER, len(chaddr), 0, 0, 0, 0,
+                         socket.inet_aton(ip_address), b'', b'', b'',
+                         chaddr, b'', b'', DHCP_COOKIE)
+    return (header + options).ljust(DHCP_PACKET_SIZE, b'\0')
+
+
+def _create_socket(namespace):
+    if not namespace:
+        return socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                             socket.IPPROTO_UDP)
+    # setns() only moves the calling thread, which is moved back once the
+    # socket is created in the namespace
+    saved_ns = os.open('/proc/thread-self/ns/net', os.O_RDONLY)
+    try:
+        netns.setns(namespace, flags=0)
+        try:
+            return socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                 socket.IPPROTO_UDP)
+        finally:
+            netns.setns(saved_ns, flags=0)
+    finally:
+        os.close(saved_ns)
+
+
+@privileged.dhcp_release_cmd.entrypoint
+def send_dhcp_release(interface_name, leases, namespace=None):
+    """Sends a DHCPRELEASE packet to the DHCP server for each lease.
+
+    The packets are the ones the dhcp_release utility sends, without running
+    it for each lease.
+
+    :param interface_name: interface the DHCP server listens on
+    :param leases: list of (ip_address, mac_address, client_id,
+                   server_address) tuples, server_address being the address
+                   of the interface in the subnet of ip_address
+    :param namespace: network namespace of the interface
+    """
+    with _create_socket(namespace) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BINDTODEVICE,
+                        interface_name.encode())
+        for ip_address, mac_address, client_id, server_address in leases:
+            packet = _build_dhcp_release_packet(
+                ip_address, mac_address, client_id, server_address)
+            sock.sendto(packet, (server_address, DHCP_SERVER_PORT))
@@ -13,6 +13,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 import os.path
+import time
 
 from neutron_lib import constants
 import testtools
@@ -186,3 +187,57 @@ class IptablesManagerNonRootTestCase(base.BaseTestCase):
 
     def test_binary_name_eventlet_spawn(self):
         self._test_binary_name(ipt_binname, 'spawn')
+
+
+class IptablesChainDiffTestCase(base.BaseTestCase):
+    """Time of the diff of chains of 1k, 10k and 100k rules."""
+
+    @staticmethod
+    def _get_rules(first, last):
+        return ['-A sg-chain -m physdev --physdev-in tap%08x '
+                '--physdev-is-bridged -j ACCEPT' % index
+                for index in range(first, last)]
+
+    def _time_chain_diff(self, old_rules, new_rules, expected_commands):
+        durations = []
+        for _ in range(3):
+            start = time.time()
+            commands = (
+                iptables_manager._generate_chain_diff_iptables_commands(
+                    'sg-chain', old_rules, new_rules))
+            durations.append(time.time() - start)
+            self.assertEqual(expected_commands, len(commands))
+        return min(durations)
+
+    def _test_chain_diff_complexity(self, get_new_rules, expected_commands):
+        durations = {}
+        for num_rules in (1000, 10000, 100000):
+            old_rules = self._get_rules(0, num_rules)
+            durations[num_rules] = self._time_chain_diff(
+                old_rules, get_new_rules(old_rules),
+                expected_commands(num_rules))
+        # a quadratic diff takes 10000 times longer with 100 times more
+        # rules, leave room for the O(n log n) cases and timing noise
+        self.assertLess(durations[100000], durations[1000] * 1000 + 0.1,
+                        durations)
+
+    def test_chain_diff_append(self):
+        self._test_chain_diff_complexity(
+            lambda rules: rules + self._get_rules(-2, 0), lambda n: 2)
+
+    def test_chain_diff_insert_and_remove(self):
+        def get_new_rules(rules):
+            middle = len(rules) // 2
+            return (rules[:middle] + self._get_rules(-1, 0) +
+                    rules[middle + 1:])
+        self._test_chain_diff_complexity(get_new_rules, lambda n: 2)
+
+    def test_chain_diff_scattered_changes(self):
+        def get_new_rules(rules):
+            rules = rules[10:] + rules[:10]
+            for index in range(0, len(rules), 100):
+                rules[index] = rules[index].replace('-j ACCEPT', '-j DROP')
+            return rules
+        # 10 rules moved and 1% of the rules replaced
+        self._test_chain_diff_complexity(
+            get_new_rules, lambda n: 20 + n // 100 * 2)
@@ -529,6 +529,42 @@ class OVS_Lib_Test(base.BaseTestCase):
             self.assertRaises(tenacity.RetryError,
                               self.br._get_port_val, '1', 'ofport')
 
+    def test_add_tunnel_ports(self):
+        tunnels = {'vxlan-1': '10.0.0.1', 'vxlan-2': '10.0.0.2'}
+        with mock.patch.object(self.br, 'ovsdb') as ovsdb,\
+                mock.patch.object(self.br, 'get_ports_ofport',
+                                  return_value={'vxlan-1': 1,
+                                                'vxlan-2': 2}) as get_ofport:
+            ofports = self.br.add_tunnel_ports(
+                tunnels, '10.0.0.10', 'vxlan')
+        self.assertEqual({'vxlan-1': 1, 'vxlan-2': 2}, ofports)
+        ovsdb.transaction.assert_called_once_with()
+        txn = ovsdb.transaction.return_value.__enter__.return_value
+        self.assertEqual(4, txn.add.call_count)
+        ovsdb.add_port.assert_has_calls(
+            [mock.call(self.BR_NAME, 'vxlan-1'),
+             mock.call(self.BR_NAME, 'vxlan-2')])
+        get_ofport.assert_called_once_with(['vxlan-1', 'vxlan-2'])
+
+    def test_get_ports_ofport_retry(self):
+        with mock.patch.object(self.br, 'ovsdb') as ovsdb:
+            # Increase this value to avoid a timeout during the test execution
+            ovsdb.ovsdb_connection.timeout = 10
+            ovsdb.db_list.return_value.execute.side_effect = [
+                [{'name': 'p1', 'ofport': 1}, {'name': 'p2', 'ofport': []}],
+                [{'name': 'p1', 'ofport': 1}, {'name': 'p2', 'ofport': 2}]]
+            self.assertEqual({'p1': 1, 'p2': 2},
+                             self.br.get_ports_ofport(['p1', 'p2']))
+
+    def test_get_ports_ofport_retry_fails(self):
+        with mock.patch.object(self.br, '_get_ports_ofport',
+                               side_effect=tenacity.RetryError(None)),\
+                mock.patch.object(self.br, 'ovsdb') as ovsdb:
+            ovsdb.db_list.return_value.execute.return_value = [
+                {'name': 'p1', 'ofport': 1}, {'name': 'p2', 'ofport': []}]
+            self.assertEqual({'p1': 1, 'p2': ovs_lib.INVALID_OFPORT},
+                             self.br.get_ports_ofport(['p1', 'p2']))
+
     def test_set_controller_rate_limit(self):
         with mock.patch.object(
                 self.br, "set_controller_field"
@@ -110,3 +110,19 @@ class TestExclusiveResourceProcessor(base.BaseTestCase):
         self.assertFalse(update.hit_retry_limit())
         rpqueue.add(update)
         self.assertTrue(update.hit_retry_limit())
+
+    def test_empty_and_qsize(self):
+        rpqueue = queue.ResourceProcessingQueue()
+        self.assertTrue(rpqueue.empty())
+        rpqueue.add(queue.ResourceUpdate(FAKE_ID, PRIORITY_RPC))
+        self.assertFalse(rpqueue.empty())
+        self.assertEqual(1, rpqueue.qsize())
+
+    def test_oldest_update_age(self):
+        rpqueue = queue.ResourceProcessingQueue()
+        self.assertEqual(0, rpqueue.oldest_update_age())
+        old_update = queue.ResourceUpdate(FAKE_ID, PRIORITY_RPC + 1)
+        old_update.create_time -= 10
+        rpqueue.add(old_update)
+        rpqueue.add(queue.ResourceUpdate(FAKE_ID_2, PRIORITY_RPC))
+        self.assertGreaterEqual(rpqueue.oldest_update_age(), 10)
@@ -316,6 +316,103 @@ class TestDhcpAgent(base.BaseTestCase):
                     mocks['start_ready_ports_loop'].assert_called_once_with()
                     spawn_n.assert_called_once_with(mocks['_process_loop'])
 
+    def test_run_adaptive_process_pool(self):
+        cfg.CONF.set_override('adaptive_process_pool', True)
+        with mock.patch(DEVICE_MANAGER):
+            dhcp = dhcp_agent.DhcpAgent(HOSTNAME)
+            attrs_to_mock = dict(
+                (a, mock.DEFAULT) for a in
+                ['periodic_resync', 'start_ready_ports_loop',
+                 '_process_loop', '_adapt_process_pool'])
+            with mock.patch.multiple(dhcp, **attrs_to_mock) as mocks:
+                with mock.patch.object(dhcp_agent.eventlet,
+                                       'spawn_n') as spawn_n:
+                    dhcp.run()
+                    spawn_n.assert_has_calls(
+                        [mock.call(mocks['_process_loop']),
+                         mock.call(mocks['_adapt_process_pool'])])
+
+    def _test_resize_process_pool(self, num_nets, pool_size, backlog,
+                                  latencies, adapt=True, oldest=0):
+        cfg.CONF.set_override('adaptive_process_pool', True)
+        with mock.patch(DEVICE_MANAGER):
+            dhcp = dhcp_agent.DhcpAgent(HOSTNAME)
+        dhcp._pool_size = pool_size
+        dhcp._update_latencies.extend(latencies)
+        with mock.patch.object(dhcp.cache, 'get_network_ids',
+                               return_value=list(range(num_nets))), \
+                mock.patch.object(dhcp._queue, 'qsize',
+                                  return_value=backlog), \
+                mock.patch.object(dhcp._queue, 'oldest_update_age',
+                                  return_value=oldest), \
+                mock.patch.object(dhcp._pool, 'resize') as resize:
+            dhcp._resize_process_pool(adapt=adapt)
+        if adapt:
+            self.assertEqual(0, len(dhcp._update_latencies))
+        if dhcp._pool_size != pool_size:
+            resize.assert_called_once_with(dhcp._pool_size)
+        return dhcp._pool_size
+
+    def test_resize_process_pool_adaptive_grow(self):
+        # the 95th percentile exceeds the target latency of 1 second
+        latencies = [0.1] * 90 + [5] * 10
+        self.assertEqual(
+            32, self._test_resize_process_pool(100, 16, 10, latencies))
+
+    def test_resize_process_pool_adaptive_grow_networks_limit(self):
+        self.assertEqual(
+            20, self._test_resize_process_pool(20, 16, 10, [5]))
+
+    def test_resize_process_pool_adaptive_no_backlog(self):
+        self.assertEqual(
+            16, self._test_resize_process_pool(100, 16, 0, [0.8]))
+
+    def test_resize_process_pool_adaptive_low_latency_backlog(self):
+        # updates are waiting but processed within the target latency
+        latencies = [0.1] * 96 + [5] * 4
+        self.assertEqual(
+            16, self._test_resize_process_pool(100, 16, 10, latencies))
+
+    def test_resize_process_pool_adaptive_grow_oldest_queued(self):
+        # no update completed, but the oldest waiting update is 5 seconds old
+        self.assertEqual(
+            32, self._test_resize_process_pool(100, 16, 10, [], oldest=5))
+
+    def test_resize_process_pool_adaptive_grow_oldest_in_progress(self):
+        cfg.CONF.set_override('adaptive_process_pool', True)
+        with mock.patch(DEVICE_MANAGER):
+            dhcp = dhcp_agent.DhcpAgent(HOSTNAME)
+        dhcp._pool_size = 16
+        dhcp._updates_in_progress.add(
+            mock.Mock(time_elapsed_since_create=5))
+        with mock.patch.object(dhcp._queue, 'qsize', return_value=10):
+            self.assertEqual(32, dhcp._get_adaptive_pool_size())
+
+    def test_resize_process_pool_adaptive_shrink(self):
+        self.assertEqual(
+            8, self._test_resize_process_pool(100, 16, 0, [0.1, 0.2]))
+        self.assertEqual(
+            8, self._test_resize_process_pool(100, 8, 0, []))
+
+    def test_resize_process_pool_adaptive_network_removed(self):
+        self.assertEqual(
+            10, self._test_resize_process_pool(10, 16, 10, [5], adapt=False))
+
+    def test_process_resource_update_records_latency(self):
+        cfg.CONF.set_override('adaptive_process_pool', True)
+        with mock.patch(DEVICE_MANAGER):
+            dhcp = dhcp_agent.DhcpAgent(HOSTNAME)
+        update = dhcp_agent.DHCPResourceUpdate(
+            'net-id', 1, action='refresh_dhcp_helper', resource='net-id')
+        dhcp._queue.add(update)
+        with mock.patch.object(dhcp, 'refresh_dhcp_helper') as refresh:
+            refresh.side_effect = lambda resource: self.assertEqual(
+                {update}, dhcp._updates_in_progress)
+            dhcp._process_resource_update()
+        refresh.assert_called_once_with('net-id')
+        self.assertEqual(1, len(dhcp._update_latencies))
+        self.assertEqual(set(), dhcp._updates_in_progress)
+
     def test_call_driver(self):
         network = mock.Mock()
         network.id = '1'
@@ -416,6 +513,54 @@ class TestDhcpAgent(base.BaseTestCase):
             self._test_sync_state_helper(known_net_ids, active_net_ids)
             w.assert_called_once_with()
 
+    def _test_sync_state_by_revision(self, networks=None):
+        cfg.CONF.set_override('resync_by_revision', True)
+        # the cached networks stand for their own revision
+        known_networks = {'a': 'rev-a', 'b': 'rev-b', 'c': 'rev-c'}
+        changed_networks = [mock.Mock(id='a'), mock.Mock(id='d')]
+        with mock.patch(DHCP_PLUGIN) as plug:
+            mock_plugin = mock.Mock()
+            mock_plugin.get_changed_networks_info.return_value = (
+                changed_networks, {'a', 'b', 'd'})
+            plug.return_value = mock_plugin
+
+            dhcp = dhcp_agent.DhcpAgent(HOSTNAME)
+
+            attrs_to_mock = dict((a, mock.DEFAULT)
+                                 for a in ['disable_dhcp_helper', 'cache',
+                                           'safe_configure_dhcp_for_network'])
+
+            with mock.patch.multiple(dhcp, **attrs_to_mock) as mocks, \
+                    mock.patch.object(utils, 'get_dhcp_network_revision',
+                                      side_effect=lambda net: net):
+                mocks['cache'].get_network_ids.return_value = list(
+                    known_networks)
+                mocks['cache'].get_network_by_id.side_effect = (
+                    known_networks.get)
+                mocks['cache'].get_port_ids.return_value = range(4)
+                dhcp.sync_state(networks)
+
+                mocks['disable_dhcp_helper'].assert_called_once_with('c')
+                configured = mocks['safe_configure_dhcp_for_network']
+                configured.assert_has_calls(
+                    [mock.call(network) for network in changed_networks],
+                    any_order=True)
+                self.assertEqual(2, configured.call_count)
+        self.assertFalse(mock_plugin.get_active_networks_info.called)
+        return mock_plugin.get_changed_networks_info.call_args
+
+    def test_sync_state_by_revision(self):
+        call_args = self._test_sync_state_by_revision()
+        network_revisions = {'a': 'rev-a', 'b': 'rev-b', 'c': 'rev-c'}
+        self.assertEqual(mock.call(network_revisions,
+                                   enable_dhcp_filter=False), call_args)
+
+    def test_sync_state_by_revision_one_network(self):
+        call_args = self._test_sync_state_by_revision(['b'])
+        network_revisions = {'a': 'rev-a', 'c': 'rev-c'}
+        self.assertEqual(mock.call(network_revisions,
+                                   enable_dhcp_filter=False), call_args)
+
     def test_sync_state_for_all_networks_plugin_error(self):
         with mock.patch(DHCP_PLUGIN) as plug:
             mock_plugin = mock.Mock()
@@ -1505,6 +1650,22 @@ class TestDhcpPluginApiProxy(base.BaseTestCase):
         self._test_dhcp_api('get_network_info', network_id='fake_id',
                             return_value=None)
 
+    def test_get_changed_networks_info(self):
+        proxy = dhcp_agent.DhcpPluginApi('foo', host='foo')
+        with mock.patch.object(proxy.client, 'call') as rpc_mock, \
+                mock.patch.object(proxy.client, 'prepare') as prepare_mock:
+            prepare_mock.return_value = proxy.client
+            rpc_mock.return_value = {'networks': [{'id': 'a'}],
+                                     'network_ids': ['a', 'b']}
+            networks, network_ids = proxy.get_changed_networks_info(
+                {'b': 'rev-b'}, enable_dhcp_filter=False)
+        prepare_mock.assert_called_once_with(version='1.10')
+        rpc_mock.assert_called_once_with(
+            mock.ANY, 'get_changed_networks_info', host='foo',
+            network_revisions={'b': 'rev-b'}, enable_dhcp_filter=False)
+        self.assertEqual(['a'], [network.id for network in networks])
+        self.assertEqual({'a', 'b'}, network_ids)
+
     def test_create_dhcp_port(self):
         self._test_dhcp_api('create_dhcp_port', port='fake_port',
                             return_value=None, version='1.1')
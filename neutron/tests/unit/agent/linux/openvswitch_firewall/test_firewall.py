@@ -409,6 +409,7 @@ class TestConjIdMap(base.BaseTestCase):
 class TestConjIPFlowManager(base.BaseTestCase):
     def setUp(self):
         super(TestConjIPFlowManager, self).setUp()
+        securitygroups_rpc.register_securitygroups_opts()
         self.driver = mock.Mock()
         self.driver.int_br.br.dump_flows.return_value = INIT_OF_RULES
         self.manager = ovsfw.ConjIPFlowManager(self.driver)
@@ -469,6 +470,19 @@ class TestConjIPFlowManager(base.BaseTestCase):
                        dl_type=2048, nw_src='10.22.3.4/32', priority=73,
                        reg_net=self.vlan_tag, table=82)])
 
+    def test_update_flows_for_remote_group(self):
+        with mock.patch.object(self.manager.conj_id_map,
+                               'get_conj_id') as get_conj_id_mock, \
+                mock.patch.object(self.manager,
+                                  'update_flows_for_vlan') as update_mock:
+            get_conj_id_mock.return_value = self.conj_id
+            self.manager.add(self.vlan_tag, 'sg', 'remote_id',
+                             constants.INGRESS_DIRECTION, constants.IPv4, 0)
+            self.manager.add(self.vlan_tag + 1, 'sg', 'other_remote_id',
+                             constants.INGRESS_DIRECTION, constants.IPv4, 0)
+            self.manager.update_flows_for_remote_group('remote_id')
+        update_mock.assert_called_once_with(self.vlan_tag)
+
     def _sg_removed(self, sg_name):
         with mock.patch.object(self.manager.conj_id_map,
                                'get_conj_id') as get_id_mock, \
@@ -503,6 +517,102 @@ class TestConjIPFlowManager(base.BaseTestCase):
         self.driver.delete_flow_for_ip.assert_called_once_with(
             '10.22.3.4', 'ingress', 'IPv4', 100, {self.conj_id})
 
+    def _enable_compact_flows(self):
+        cfg.CONF.set_override('compact_remote_group_flows', True,
+                              group='SECURITYGROUP')
+        self.manager = ovsfw.ConjIPFlowManager(self.driver)
+
+    def test_update_flows_for_vlan_compact_flows(self):
+        self._enable_compact_flows()
+        members = {
+            'remote_id_1': [('10.0.0.%d' % i, 'fa:16:3e:aa:bb:cc')
+                            for i in range(4)] + [('10.0.0.8', None)],
+            'remote_id_2': [('10.0.0.%d' % i, 'fa:16:3e:aa:bb:cc')
+                            for i in range(4)],
+        }
+
+        def get_sg(remote_id):
+            remote_group = mock.Mock()
+            remote_group.get_ethertype_filtered_addresses.return_value = (
+                members[remote_id])
+            return remote_group
+
+        self.driver.sg_port_map.get_sg.side_effect = get_sg
+        with mock.patch.object(self.manager.conj_id_map,
+                               'get_conj_id') as get_conj_id_mock:
+            get_conj_id_mock.side_effect = [16, 24]
+            self.manager.add(self.vlan_tag, 'sg', 'remote_id_1',
+                             constants.INGRESS_DIRECTION, constants.IPv4, 0)
+            self.manager.add(self.vlan_tag, 'sg', 'remote_id_2',
+                             constants.INGRESS_DIRECTION, constants.IPv4, 0)
+            self.manager.update_flows_for_vlan(self.vlan_tag)
+
+        self.assertCountEqual(
+            [mock.call(actions='conjunction(16,1/2),conjunction(24,1/2)',
+                       ct_state='+est-rel-rpl', dl_type=2048,
+                       nw_src='10.0.0.0/30', priority=70,
+                       reg_net=self.vlan_tag, table=82),
+             mock.call(actions='conjunction(17,1/2),conjunction(25,1/2)',
+                       ct_state='+new-est', dl_type=2048,
+                       nw_src='10.0.0.0/30', priority=70,
+                       reg_net=self.vlan_tag, table=82),
+             mock.call(actions='conjunction(16,1/2)',
+                       ct_state='+est-rel-rpl', dl_type=2048,
+                       nw_src='10.0.0.8/32', priority=70,
+                       reg_net=self.vlan_tag, table=82),
+             mock.call(actions='conjunction(17,1/2)',
+                       ct_state='+new-est', dl_type=2048,
+                       nw_src='10.0.0.8/32', priority=70,
+                       reg_net=self.vlan_tag, table=82)],
+            self.driver._add_flow.call_args_list)
+        self.assertEqual({'remote_id_1': 2, 'remote_id_2': 1},
+                         self.manager.get_flow_counts())
+        self.assertEqual({'remote_id_1': 2, 'remote_id_2': 1},
+                         self.manager.get_flow_counts(self.vlan_tag))
+        self.assertEqual({}, self.manager.get_flow_counts(self.vlan_tag + 1))
+
+    def test_update_flows_for_vlan_compact_flows_removed_prefix(self):
+        self._enable_compact_flows()
+        remote_group = self.driver.sg_port_map.get_sg.return_value
+        remote_group.get_ethertype_filtered_addresses.return_value = [
+            ('10.0.0.1', 'fa:16:3e:aa:bb:cc'), ]
+        with mock.patch.object(self.manager.conj_id_map,
+                               'get_conj_id') as get_conj_id_mock:
+            get_conj_id_mock.return_value = self.conj_id
+            self.manager.add(self.vlan_tag, 'sg', 'remote_id',
+                             constants.INGRESS_DIRECTION, constants.IPv4, 0)
+            # The deletion of the flows of 10.0.0.0/24 also deletes the flows
+            # of 10.0.0.1/32, which need to be installed again.
+            self.manager.flow_state[self.vlan_tag][(
+                constants.INGRESS_DIRECTION, constants.IPv4)] = {
+                    ('10.0.0.0/24', None): [self.conj_id + 2],
+                    ('10.0.0.1/32', None): [self.conj_id]}
+            self.manager.update_flows_for_vlan(self.vlan_tag)
+        self.driver.delete_flows_for_flow_state.assert_called_once_with(
+            {('10.0.0.0/24', None): [self.conj_id + 2],
+             ('10.0.0.1/32', None): [self.conj_id]},
+            {('10.0.0.1/32', None): [self.conj_id]},
+            constants.INGRESS_DIRECTION, constants.IPv4, self.vlan_tag)
+        self.assertEqual(2, self.driver._add_flow.call_count)
+        for call in self.driver._add_flow.call_args_list:
+            self.assertEqual('10.0.0.1/32', call[1]['nw_src'])
+
+    def test_compact_addr_conj_id_map(self):
+        addr_to_conj = {
+            ('10.0.0.2', 'fa:16:3e:aa:bb:cc'): [16],
+            ('10.0.0.3', None): [16],
+            ('10.0.0.3', 'fa:16:3e:aa:bb:cd'): [16],
+            ('10.0.0.4', None): [18, 16],
+            ('0.0.0.0/0', 'fa:16:3e:aa:bb:cc'): [16],
+            ('0.0.0.0/0', None): [18],
+        }
+        self.assertEqual(
+            {('10.0.0.2/31', None): [16],
+             ('10.0.0.4/32', None): [16, 18],
+             ('0.0.0.0/0', 'fa:16:3e:aa:bb:cc'): [16],
+             ('0.0.0.0/0', None): [18]},
+            ovsfw.ConjIPFlowManager._compact_addr_conj_id_map(addr_to_conj))
+
 
 class FakeOVSPort(object):
     def __init__(self, name, port, mac):
@@ -985,6 +1095,73 @@ class TestOVSFirewallDriver(base.BaseTestCase):
             self.firewall.update_port_filter(port_dict)
         self.assertEqual(2, self.mock_bridge.apply_flows.call_count)
 
+    def test_prepare_port_filter_initialized_port_applies_added_flows(self):
+        """Check flows are applied right after _set_flows is called."""
+        port_dict = {'device': 'port-id',
+                     'security_groups': [1]}
+        self._prepare_security_group()
+        self.firewall.prepare_port_filter(port_dict)
+        with self.firewall.defer_apply():
+            self.firewall.prepare_port_filter(port_dict)
+        self.assertEqual(2, self.mock_bridge.apply_flows.call_count)
+
+    def test_update_port_filter_no_changes(self):
+        port_dict = {'device': 'port-id',
+                     'security_groups': [1]}
+        self._prepare_security_group()
+        self.firewall.prepare_port_filter(port_dict)
+        self.mock_bridge.reset_mock()
+        with self.firewall.defer_apply():
+            self.firewall.update_port_filter(port_dict)
+        self.assertFalse(self.mock_bridge.br.delete_flows.called)
+        self.assertFalse(self.mock_bridge.add_flow.called)
+        self.assertEqual(2, self.mock_bridge.apply_flows.call_count)
+
+    def test_update_port_filter_updates_changed_flows(self):
+        port_dict = {'device': 'port-id',
+                     'security_groups': [1]}
+        self._prepare_security_group()
+        self.firewall.prepare_port_filter(port_dict)
+        of_port = self.firewall.sg_port_map.ports['port-id']
+        old_port_flows = self.firewall._port_flows['port-id'].copy()
+        self.firewall.update_security_group_rules(1, [
+            {'ethertype': constants.IPv4,
+             'protocol': constants.PROTO_NAME_TCP,
+             'direction': constants.INGRESS_DIRECTION,
+             'port_range_min': 124,
+             'port_range_max': 124}])
+        self.mock_bridge.reset_mock()
+
+        self.firewall.update_port_filter(port_dict)
+        port_flows = self.firewall._port_flows['port-id']
+        removed_flows = set(old_port_flows) - set(port_flows)
+        added_flows = set(port_flows) - set(old_port_flows)
+        self.assertTrue(removed_flows)
+        self.assertTrue(added_flows)
+        # The new flows are added and applied before the strict deletes
+        calls = [call[0] for call in self.mock_bridge.mock_calls
+                 if call[0] in ('apply_flows', 'br.delete_flows') or
+                 (call[0] == 'br.add_flow' and
+                  ovsfw.get_flow_fingerprint(call[2]) in added_flows)]
+        first_delete = calls.index('br.delete_flows')
+        self.assertEqual(['br.add_flow'] * len(added_flows) + ['apply_flows'],
+                         calls[first_delete - len(added_flows) - 1:
+                               first_delete])
+        self.assertNotIn('br.add_flow', calls[first_delete:])
+        # Only the flows of the removed rules are deleted
+        self.assertEqual(len(removed_flows),
+                         self.mock_bridge.br.delete_flows.call_count)
+        for call in self.mock_bridge.br.delete_flows.call_args_list:
+            self.assertTrue(call[1]['strict'])
+            self.assertNotIn('actions', call[1])
+            self.assertEqual(of_port.ofport, call[1]['reg5'])
+        # Only the flows of the new rules are added, the flows of the
+        # remote group addresses are updated as usual
+        added_port_flows = [
+            call for call in self.mock_bridge.br.add_flow.call_args_list
+            if ovsfw.get_flow_fingerprint(call[1]) in port_flows]
+        self.assertEqual(len(added_flows), len(added_port_flows))
+
     def test_update_port_filter_clean_when_port_not_found(self):
         """Check flows are cleaned if port is not found in the bridge."""
         port_dict = {'device': 'port-id',
@@ -1027,6 +1204,59 @@ class TestOVSFirewallDriver(base.BaseTestCase):
         new_members = {constants.IPv4: [1, 2, 3, 4]}
         self.firewall.update_security_group_members(2, new_members)
 
+    def test_update_security_group_members_delta(self):
+        self._prepare_security_group()
+        mac = 'fa:16:3e:aa:bb:cc'
+        self.firewall.update_security_group_members(
+            2, {constants.IPv6: [('2001:db8::1', mac), ('2001:db8::2', mac)]})
+        with mock.patch.object(self.firewall.conj_ip_manager,
+                               'update_flows_for_remote_group') as update_mock:
+            self.assertTrue(self.firewall.update_security_group_members_delta(
+                2, {constants.IPv6: {('2001:db8::3', mac)}},
+                {constants.IPv6: {('2001:db8::1', mac)}}))
+            update_mock.assert_called_once_with(2)
+        self.assertEqual(
+            {('2001:db8::2', mac), ('2001:db8::3', mac)},
+            set(self.firewall.sg_port_map.get_sg(2).members[constants.IPv6]))
+        self.assertFalse(self.firewall._deferred)
+        self.mock_bridge.apply_flows.assert_called_once_with()
+
+    def test_update_security_group_members_delta_no_change(self):
+        self._prepare_security_group()
+        mac = 'fa:16:3e:aa:bb:cc'
+        self.firewall.update_security_group_members(
+            2, {constants.IPv6: [('2001:db8::1', mac)]})
+        with mock.patch.object(self.firewall.conj_ip_manager,
+                               'update_flows_for_remote_group') as update_mock:
+            self.assertTrue(self.firewall.update_security_group_members_delta(
+                2, {constants.IPv6: {('2001:db8::1', mac)}}, {}))
+        update_mock.assert_not_called()
+
+    def test_update_security_group_members_delta_unknown_group(self):
+        mac = 'fa:16:3e:aa:bb:cc'
+        self.assertFalse(self.firewall.update_security_group_members_delta(
+            'unknown', {constants.IPv6: {('2001:db8::1', mac)}}, {}))
+
+    def test_update_security_group_members_delta_emptied_group(self):
+        self._prepare_security_group()
+        mac = 'fa:16:3e:aa:bb:cc'
+        self.firewall.update_security_group_members(
+            2, {constants.IPv6: [('2001:db8::1', mac)]})
+        with mock.patch.object(self.firewall.conj_ip_manager,
+                               'update_flows_for_remote_group') as update_mock:
+            self.assertTrue(self.firewall.update_security_group_members_delta(
+                2, {}, {constants.IPv6: {('2001:db8::1', mac)}}))
+            update_mock.assert_called_once_with(2)
+            # the emptied group is kept and its conjunction ids are not freed
+            self.assertEqual({constants.IPv6: []},
+                             self.firewall.sg_port_map.get_sg(2).members)
+            self.assertNotIn(2, self.firewall.sg_to_delete)
+            # the ports using the group are refreshed on the next member
+            self.assertFalse(
+                self.firewall.update_security_group_members_delta(
+                    2, {constants.IPv6: {('2001:db8::2', mac)}}, {}))
+        update_mock.assert_called_once_with(2)
+
     def test__cleanup_stale_sg(self):
         self._prepare_security_group()
         self.firewall.sg_to_delete = {1}
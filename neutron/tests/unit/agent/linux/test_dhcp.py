@@ -15,7 +15,9 @@
 
 import copy
 import os
+import time
 from unittest import mock
+import zlib
 
 import netaddr
 from neutron_lib.api.definitions import extra_dhcp_opt as edo_ext
@@ -2381,6 +2383,81 @@ class TestDnsmasq(TestBase):
         # Verify that dhcp_release6 is not called when it is not present
         ipw.assert_not_called()
 
+    def test_output_hosts_file_native_thread(self):
+        self.conf.set_override('dnsmasq_render_in_native_thread', True)
+        dnsmasq = self._get_dnsmasq(FakeDualNetwork())
+        dnsmasq._IS_HOST_TAG_SUPPORTED = False
+        with mock.patch.object(dhcp.tpool, 'execute',
+                               return_value={'port': 'entry\n'}) as execute, \
+                mock.patch.object(dhcp.file_utils, 'replace_file') as replace:
+            dnsmasq._output_hosts_file()
+        execute.assert_called_once_with(dnsmasq._get_hosts_file_entries)
+        replace.assert_called_once_with(mock.ANY, 'entry\n')
+
+    def test_release_unused_leases_direct_release(self):
+        self.conf.set_override('dnsmasq_direct_release', True)
+        dnsmasq = self._get_dnsmasq(FakeDualNetwork())
+
+        ip1 = '192.168.1.2'
+        mac1 = '00:00:80:aa:bb:cc'
+        ip2 = '192.168.1.3'
+        mac2 = '00:00:80:cc:bb:aa'
+        ip3 = '10.0.0.3'
+        mac3 = '00:00:80:bb:aa:cc'
+        ip4 = 'fdca:3ba5:a17a::1'
+        mac4 = '00:00:80:aa:cc:bb'
+
+        old_leases = {(ip1, mac1, None), (ip2, mac2, 'client_id'),
+                      (ip3, mac3, None), (ip4, mac4, None)}
+        dnsmasq._read_hosts_file_leases = mock.Mock(return_value=old_leases)
+        dnsmasq._read_leases_file_leases = mock.Mock(
+            side_effect=[{ip1: {'iaid': mac1, 'client_id': '*',
+                                'server_id': None},
+                          ip2: {'iaid': mac2, 'client_id': 'client_id',
+                                'server_id': None},
+                          ip3: {'iaid': mac3, 'client_id': '*',
+                                'server_id': None},
+                          ip4: {'iaid': 0xff, 'client_id': 'client_id',
+                                'server_id': 'server_id'}},
+                         {}])
+        dnsmasq.network.ports = []
+        dnsmasq._release_lease = mock.Mock()
+        mock_get_ips = mock.patch.object(
+            ip_lib, 'get_devices_with_ip',
+            return_value=[{'cidr': '192.168.1.1/24'},
+                          {'cidr': 'fdca:3ba5:a17a::2/64'}]).start()
+        mock_send = mock.patch.object(priv_dhcp,
+                                      'send_dhcp_release').start()
+
+        dnsmasq._release_unused_leases()
+
+        mock_get_ips.assert_called_once_with(dnsmasq.network.namespace,
+                                             name=dnsmasq.interface_name)
+        mock_send.assert_called_once_with(
+            dnsmasq.interface_name, mock.ANY,
+            namespace=dnsmasq.network.namespace)
+        # the lease of ip3 is not in a subnet of the DHCP port
+        self.assertEqual(
+            sorted([(ip1, mac1, None, '192.168.1.1'),
+                    (ip2, mac2, 'client_id', '192.168.1.1')]),
+            sorted(mock_send.call_args[0][1]))
+        dnsmasq._release_lease.assert_called_once_with(
+            mac4, ip4, constants.IP_VERSION_6, 'client_id', 'server_id',
+            0xff)
+
+    def test_release_unused_leases_direct_release_failure(self):
+        self.conf.set_override('dnsmasq_direct_release', True)
+        dnsmasq = self._get_dnsmasq(FakeDualNetwork())
+        ip1 = '192.168.1.2'
+        mac1 = '00:00:80:aa:bb:cc'
+        mock.patch.object(ip_lib, 'get_devices_with_ip',
+                          return_value=[{'cidr': '192.168.1.1/24'}]).start()
+        mock.patch.object(priv_dhcp, 'send_dhcp_release',
+                          side_effect=OSError('No such device')).start()
+        with mock.patch.object(dhcp.LOG, 'warning') as mock_log_warn:
+            dnsmasq._release_leases_v4([(mac1, ip1, None)])
+        mock_log_warn.assert_called_once_with(mock.ANY, mock.ANY)
+
     def test_release_unused_leases_with_dhcp_port(self):
         dnsmasq = self._get_dnsmasq(FakeNetworkDhcpPort())
         ip1 = '192.168.1.2'
@@ -2793,6 +2870,41 @@ class TestDnsmasq(TestBase):
         if add_bad_line:
             self.assertTrue(mock_log_warn.called)
 
+    def _write_leases_file(self, lines, age):
+        filename = os.path.join(self.get_default_temp_dir().path, 'leases')
+        with open(filename, 'w') as f:
+            f.write(''.join(line + '\n' for line in lines))
+        mtime = time.time() - age
+        os.utime(filename, (mtime, mtime))
+        return filename
+
+    def test_read_leases_file_leases_unchanged_file(self):
+        mock.patch.object(dhcp.Dnsmasq, '_PARSED_LEASES', {}).start()
+        line = '1472673289 aa:bb:cc:00:00:02 192.168.1.2 host-192-168-1-2 *'
+        filename = self._write_leases_file([line], 60)
+        dnsmasq = self._get_dnsmasq(FakeDualNetwork())
+        leases = dnsmasq._read_leases_file_leases(filename)
+        self.assertEqual(['192.168.1.2'], list(leases))
+        with mock.patch.object(dnsmasq, '_parse_leases_file_leases') as parse:
+            self.assertIs(leases, dnsmasq._read_leases_file_leases(filename))
+            parse.assert_not_called()
+
+        line = '1472673289 aa:bb:cc:00:00:03 192.168.1.3 host-192-168-1-3 *'
+        self._write_leases_file([line], 30)
+        self.assertEqual(['192.168.1.3'],
+                         list(dnsmasq._read_leases_file_leases(filename)))
+
+    def test_read_leases_file_leases_recently_modified_file(self):
+        mock.patch.object(dhcp.Dnsmasq, '_PARSED_LEASES', {}).start()
+        line = '1472673289 aa:bb:cc:00:00:02 192.168.1.2 host-192-168-1-2 *'
+        filename = self._write_leases_file([line], 0)
+        dnsmasq = self._get_dnsmasq(FakeDualNetwork())
+        leases = dnsmasq._read_leases_file_leases(filename)
+        self.assertEqual(leases, dnsmasq._read_leases_file_leases(filename))
+        self.assertIsNot(leases,
+                         dnsmasq._read_leases_file_leases(filename))
+        self.assertEqual({}, dhcp.Dnsmasq._PARSED_LEASES)
+
     def test_read_all_leases_file_leases(self):
         self._test_read_leases_file_leases()
 
@@ -3120,6 +3232,173 @@ class TestDnsmasq(TestBase):
                          dm._get_client_id(FakePortWithClientIdNumStr()))
 
 
+class TestDnsmasqIncrementalReload(TestConfBase):
+
+    def setUp(self):
+        super(TestDnsmasqIncrementalReload, self).setUp()
+        self.conf.register_opt(cfg.BoolOpt('enable_isolated_metadata',
+                                           default=True))
+        self.conf.register_opt(cfg.BoolOpt("force_metadata",
+                                           default=False))
+        self.conf.register_opt(cfg.BoolOpt('enable_metadata_network',
+                                           default=False))
+        self.config_parse(self.conf)
+        self.conf.set_override('dhcp_confs', self.get_default_temp_dir().path)
+        self.conf.set_override('dnsmasq_incremental_reload', True)
+        mock.patch.object(dhcp, 'DeviceManager').start()
+        mock.patch.object(ip_lib, 'get_devices_with_ip').start()
+        self.external_process = mock.patch(
+            'neutron.agent.linux.external_process.ProcessManager').start()
+        mock.patch.object(dhcp.Dnsmasq, '_HOSTS_DIRS_ENTRIES', {}).start()
+        self.network = FakeV4Network()
+
+    def _get_dnsmasq(self):
+        dm = dhcp.Dnsmasq(self.conf, self.network,
+                          process_monitor=mock.Mock())
+        dm.interface_name = 'tap0'
+        return dm
+
+    def _read_hosts_dir(self, kind):
+        dm = self._get_dnsmasq()
+        return dm._read_hosts_dir(dm.get_conf_file_name('%s.d' % kind))
+
+    def _reload_allocations(self):
+        self.external_process.reset_mock()
+        self._get_dnsmasq().reload_allocations()
+        enable = self.external_process.return_value.enable
+        enable.assert_called_once_with(reload_cfg=mock.ANY,
+                                       ensure_active=True)
+        return enable.call_args[1]['reload_cfg']
+
+    def test_build_cmdline(self):
+        dm = self._get_dnsmasq()
+        cmd = dm._build_cmdline_callback('/pid')
+        self.assertIn('--dhcp-hostsdir=%s' % dm.get_conf_file_name('host.d'),
+                      cmd)
+        self.assertIn(
+            '--hostsdir=%s' % dm.get_conf_file_name('addn_hosts.d'), cmd)
+        self.assertFalse([arg for arg in cmd
+                          if arg.startswith(('--dhcp-hostsfile=',
+                                             '--addn-hosts='))])
+
+    def test_spawn_process(self):
+        port = FakePort1()
+        self._get_dnsmasq().spawn_process()
+        self.external_process.return_value.enable.assert_called_once_with(
+            reload_cfg=False, ensure_active=True)
+        self.assertEqual(
+            {port.id: '00:00:80:aa:bb:cc,host-192-168-0-2.openstacklocal.,'
+                      '192.168.0.2\n'},
+            self._read_hosts_dir('host'))
+        self.assertEqual(
+            {port.id: '192.168.0.2\thost-192-168-0-2.openstacklocal. '
+                      'host-192-168-0-2\n'},
+            self._read_hosts_dir('addn_hosts'))
+
+    def test_reload_allocations_port_added(self):
+        self._get_dnsmasq().spawn_process()
+        self.network.ports.append(FakePort2())
+        self.assertFalse(self._reload_allocations())
+        self.assertEqual({FakePort1().id, FakePort2().id},
+                         set(self._read_hosts_dir('host')))
+        self.assertEqual({FakePort1().id, FakePort2().id},
+                         set(self._read_hosts_dir('addn_hosts')))
+
+    def test_reload_allocations_unchanged(self):
+        self._get_dnsmasq().spawn_process()
+        self.assertFalse(self._reload_allocations())
+
+    def test_reload_allocations_port_changed(self):
+        self._get_dnsmasq().spawn_process()
+        self.network.ports[0].mac_address = '00:00:80:aa:bb:dd'
+        self.assertTrue(self._reload_allocations())
+        self.assertIn('00:00:80:aa:bb:dd',
+                      self._read_hosts_dir('host')[FakePort1().id])
+
+    def test_reload_allocations_port_removed(self):
+        self.network.ports.append(FakePort2())
+        self._get_dnsmasq().spawn_process()
+        del self.network.ports[1]
+        self.assertTrue(self._reload_allocations())
+        self.assertEqual([FakePort1().id],
+                         list(self._read_hosts_dir('host')))
+        self.assertEqual([FakePort1().id],
+                         list(self._read_hosts_dir('addn_hosts')))
+
+    def test_reload_allocations_opts_changed(self):
+        self._get_dnsmasq().spawn_process()
+        self.network.ports[0].extra_dhcp_opts = [
+            DhcpOpt(opt_name='bootfile-name', opt_value='pxelinux.0')]
+        self.assertTrue(self._reload_allocations())
+
+    def test_reload_allocations_entries_read_from_files(self):
+        self._get_dnsmasq().spawn_process()
+        dhcp.Dnsmasq._HOSTS_DIRS_ENTRIES.clear()
+        self.network.ports.append(FakePort2())
+        self.assertFalse(self._reload_allocations())
+
+    def test_reload_allocations_port_fixed_ip_added(self):
+        self._get_dnsmasq().spawn_process()
+        self.network.ports[0].fixed_ips.append(
+            FakeIPAllocation('192.168.0.4',
+                             'dddddddd-dddd-dddd-dddd-dddddddddddd'))
+        self.assertFalse(self._reload_allocations())
+        self.assertIn('192.168.0.4',
+                      self._read_hosts_dir('addn_hosts')[FakePort1().id])
+
+    def test_reload_allocations_shards(self):
+        self.conf.set_override('dnsmasq_hosts_shards', 4)
+        port1 = FakePort1()
+        port2 = FakePort2()
+        shard1 = 'shard-%02d' % (zlib.crc32(port1.id.encode()) % 4)
+        shard2 = 'shard-%02d' % (zlib.crc32(port2.id.encode()) % 4)
+        self.network.ports = [port1]
+        self._get_dnsmasq().spawn_process()
+        self.assertEqual([shard1], list(self._read_hosts_dir('host')))
+
+        self.network.ports.append(port2)
+        self.assertFalse(self._reload_allocations())
+        hosts = self._read_hosts_dir('host')
+        self.assertEqual({shard1, shard2}, set(hosts))
+        self.assertIn(port2.mac_address, hosts[shard2])
+
+        del self.network.ports[0]
+        self.assertTrue(self._reload_allocations())
+        hosts = self._read_hosts_dir('host')
+        self.assertNotIn(port1.mac_address, ''.join(hosts.values()))
+        self.assertIn(port2.mac_address, hosts[shard2])
+
+    def test_spawn_process_shards_enabled(self):
+        self._get_dnsmasq().spawn_process()
+        self.conf.set_override('dnsmasq_hosts_shards', 4)
+        self._get_dnsmasq().spawn_process()
+        self.assertEqual(
+            ['shard-%02d' % (zlib.crc32(FakePort1().id.encode()) % 4)],
+            list(self._read_hosts_dir('host')))
+
+    def test_release_unused_leases(self):
+        self.network.ports.append(FakePort2())
+        dm = self._get_dnsmasq()
+        dm.spawn_process()
+        del self.network.ports[1]
+        dm._read_leases_file_leases = mock.Mock(return_value={
+            '192.168.0.3': {'iaid': '00:00:f3:aa:bb:cc', 'client_id': '*',
+                            'server_id': None}})
+        dm._release_lease = mock.Mock()
+        with mock.patch.object(dhcp.time, 'sleep'):
+            dm._release_unused_leases()
+        dm._release_lease.assert_any_call(
+            '00:00:f3:aa:bb:cc', '192.168.0.3', constants.IP_VERSION_4,
+            None, None, '00:00:f3:aa:bb:cc')
+
+    def test_disable_drops_entries(self):
+        dm = self._get_dnsmasq()
+        dm.spawn_process()
+        with mock.patch.object(ip_lib, 'delete_network_namespace'):
+            dm.disable()
+        self.assertNotIn(self.network.id, dhcp.Dnsmasq._HOSTS_DIRS_ENTRIES)
+
+
 class TestDeviceManager(TestConfBase):
     def setUp(self):
         super(TestDeviceManager, self).setUp()
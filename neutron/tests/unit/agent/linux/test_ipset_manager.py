@@ -162,3 +162,73 @@ class IpsetManagerTestCase(BaseIpsetManagerTest):
         self.expect_destroy()
         self.ipset.destroy(TEST_SET_ID, ETHERTYPE)
         self.verify_mock_calls()
+
+
+class IpsetManagerDeferredTestCase(BaseIpsetManagerTest):
+
+    def setUp(self):
+        super(IpsetManagerDeferredTestCase, self).setUp()
+        self.ipset.defer_apply_on()
+
+    def _get_set_commands(self, set_name, addresses):
+        return (['create %s hash:net family inet' % set_name,
+                 'create %s hash:net family inet' % (
+                     set_name + ipset_manager.SWAP_SUFFIX)] +
+                ['add %s%s %s' % (set_name, ipset_manager.SWAP_SUFFIX, ip)
+                 for ip in self.ipset._sanitize_addresses(addresses)] +
+                ['swap %s%s %s' % (set_name, ipset_manager.SWAP_SUFFIX,
+                                   set_name),
+                 'destroy %s%s' % (set_name, ipset_manager.SWAP_SUFFIX)])
+
+    def _expect_restore(self, commands):
+        return mock.call(['ipset', 'restore', '-exist'],
+                         process_input='\n'.join(commands),
+                         run_as_root=True, check_exit_code=True,
+                         privsep_exec=True)
+
+    def test_defer_apply_single_restore(self):
+        other_set_name = self.ipset.get_name('other_sgid', ETHERTYPE)
+        self.ipset.set_members(TEST_SET_ID, ETHERTYPE, FAKE_IPS[0:1])
+        self.ipset.set_members('other_sgid', ETHERTYPE, FAKE_IPS[1:2])
+        self.ipset.set_members(TEST_SET_ID, ETHERTYPE, FAKE_IPS[0:3])
+        self.assertTrue(self.ipset.set_name_exists(TEST_SET_NAME))
+        self.execute.assert_not_called()
+
+        self.ipset.defer_apply_off()
+        self.assertEqual([self._expect_restore(
+            self._get_set_commands(TEST_SET_NAME, FAKE_IPS[0:1]) +
+            ['add %s %s' % (TEST_SET_NAME, ip)
+             for ip in self.ipset._sanitize_addresses(FAKE_IPS[1:3])] +
+            self._get_set_commands(other_set_name, FAKE_IPS[1:2]))],
+            self.execute.call_args_list)
+        self.assertFalse(self.ipset.ipset_apply_deferred)
+
+        self.execute.reset_mock()
+        self.ipset.defer_apply_off()
+        self.execute.assert_not_called()
+
+    def test_defer_apply_failure_isolated_per_set(self):
+        other_set_name = self.ipset.get_name('other_sgid', ETHERTYPE)
+        self.ipset.set_members(TEST_SET_ID, ETHERTYPE, FAKE_IPS[0:1])
+        self.ipset.set_members('other_sgid', ETHERTYPE, FAKE_IPS[1:2])
+        self.execute.side_effect = [RuntimeError(), RuntimeError(), None]
+
+        self.ipset.defer_apply_off()
+        test_set_commands = self._get_set_commands(TEST_SET_NAME,
+                                                   FAKE_IPS[0:1])
+        other_set_commands = self._get_set_commands(other_set_name,
+                                                    FAKE_IPS[1:2])
+        self.execute.assert_has_calls([
+            self._expect_restore(test_set_commands + other_set_commands),
+            self._expect_restore(test_set_commands),
+            self._expect_restore(other_set_commands)])
+        self.assertFalse(self.ipset.set_name_exists(TEST_SET_NAME))
+        self.assertTrue(self.ipset.set_name_exists(other_set_name))
+
+    def test_destroy_drops_deferred_set(self):
+        self.ipset.set_members(TEST_SET_ID, ETHERTYPE, FAKE_IPS[0:1])
+        self.ipset.destroy(TEST_SET_ID, ETHERTYPE)
+        self.ipset.defer_apply_off()
+        self.execute.assert_called_once_with(
+            ['ipset', 'destroy', TEST_SET_NAME], process_input=None,
+            run_as_root=True, check_exit_code=False, privsep_exec=True)
@@ -2112,6 +2112,7 @@ class IptablesFirewallEnhancedIpsetTestCase(BaseIptablesFirewallTestCase):
             ipset_manager.IpsetManager.get_name)
         self.firewall.ipset.set_name_exists.return_value = True
         self.firewall.ipset.set_members = mock.Mock(return_value=([], []))
+        self.firewall.ipset.ipset_apply_deferred = False
 
     def _fake_port(self, sg_id=FAKE_SGID):
         return {'device': 'tapfake_dev',
@@ -2150,6 +2151,32 @@ class IptablesFirewallEnhancedIpsetTestCase(BaseIptablesFirewallTestCase):
         ]
         self.firewall.ipset.assert_has_calls(calls, any_order=True)
 
+    def test_update_security_group_members_delta(self):
+        self.firewall.update_security_group_members(
+            'fake_sgid', {'IPv4': [('10.0.0.1', None), ('10.0.0.2', None)]})
+        self.firewall.ipset.reset_mock()
+        self.assertTrue(self.firewall.update_security_group_members_delta(
+            'fake_sgid', {'IPv4': {('10.0.0.3', None)}},
+            {'IPv4': {('10.0.0.1', None)}}))
+        self.assertEqual(
+            {('10.0.0.2', None), ('10.0.0.3', None)},
+            set(self.firewall.ipset.set_members.call_args[0][2]))
+        self.assertEqual(
+            {('10.0.0.2', None), ('10.0.0.3', None)},
+            set(self.firewall.sg_members['fake_sgid']['IPv4']))
+
+    def test_update_security_group_members_delta_new_ipset(self):
+        self.firewall.ipset.set_name_exists.return_value = False
+        self.assertFalse(self.firewall.update_security_group_members_delta(
+            'fake_sgid', {'IPv6': {('fe80::1', None)}}, {}))
+        self.assertFalse(self.firewall.ipset.set_members.called)
+
+    def test_update_security_group_members_delta_without_ipset(self):
+        self.firewall.enable_ipset = False
+        self.assertFalse(self.firewall.update_security_group_members_delta(
+            'fake_sgid', {'IPv4': {('10.0.0.1', None)}}, {}))
+        self.assertFalse(self.firewall.ipset.set_members.called)
+
     def _setup_fake_firewall_members_and_rules(self, firewall):
         firewall.sg_rules = self._fake_sg_rules()
         firewall.pre_sg_rules = self._fake_sg_rules()
@@ -2308,6 +2335,24 @@ class IptablesFirewallEnhancedIpsetTestCase(BaseIptablesFirewallTestCase):
 
         self.firewall.ipset.assert_has_calls(calls, any_order=True)
 
+    def test_filter_defer_apply_off_deferred_ipset_conntrack(self):
+        self.firewall.ipconntrack = mock.Mock()
+        delete_states = (
+            self.firewall.ipconntrack.delete_conntrack_state_by_remote_ips)
+        self.firewall.filter_defer_apply_on()
+        self.firewall.ipset.defer_apply_on.assert_called_once_with()
+        self.firewall.ipset.ipset_apply_deferred = True
+        self.firewall.devices_with_updated_sg_members[FAKE_SGID] = ['dev']
+        self.firewall.ipset.set_members.return_value = ([], ['10.0.0.1/32'])
+        self.firewall.update_security_group_members(
+            FAKE_SGID, {_IPv4: ['10.0.0.2']})
+        delete_states.assert_not_called()
+
+        self.firewall.filter_defer_apply_off()
+        self.firewall.ipset.defer_apply_off.assert_called_once_with()
+        delete_states.assert_called_once_with(['dev'], _IPv4, ['10.0.0.1'])
+        self.assertEqual([], self.firewall._deferred_conntrack_deletes)
+
     def test_filter_defer_apply_off_with_sg_only_ipv6_rule(self):
         self.firewall.sg_rules = self._fake_sg_rules()
         self.firewall.pre_sg_rules = self._fake_sg_rules()
@@ -2378,6 +2423,74 @@ class IptablesFirewallEnhancedIpsetTestCase(BaseIptablesFirewallTestCase):
         self.assertEqual(fake_ipv6_pair, mac_ipv6_pairs)
 
 
+class IptablesFirewallDispatchChainsTestCase(BaseIptablesFirewallTestCase):
+
+    def setUp(self):
+        super(IptablesFirewallDispatchChainsTestCase, self).setUp()
+        self.firewall.dispatch_chains = 4
+        mock.patch.object(self.firewall,
+                          '_add_rules_by_security_group').start()
+        mock.patch.object(self.firewall, '_add_conntrack_jump').start()
+
+    def test_get_port_dispatch_chain(self):
+        port = self._fake_port()
+        self.assertEqual(
+            'sg-chain-00',
+            self.firewall._get_port_dispatch_chain(port, 'sg-chain'))
+        self.assertEqual(
+            'sg-fwd-00', self.firewall._get_port_dispatch_chain(port,
+                                                                'FORWARD'))
+        port['device'] = 'tapfake_dev1'
+        self.assertEqual(
+            'sg-fwd-02', self.firewall._get_port_dispatch_chain(port,
+                                                                'FORWARD'))
+        self.firewall.dispatch_chains = 0
+        self.assertEqual(
+            'FORWARD', self.firewall._get_port_dispatch_chain(port,
+                                                              'FORWARD'))
+
+    def test_setup_chains_apply(self):
+        port = self._fake_port()
+        self.firewall._setup_chains_apply({port['device']: port}, {})
+        for chain in ('sg-chain', 'sg-fwd', 'sg-in'):
+            for index in range(4):
+                self.v4filter_inst.add_chain.assert_any_call(
+                    '%s-%02d' % (chain, index))
+        self.v4filter_inst.add_rule.assert_has_calls([
+            mock.call('sg-chain', '-j $sg-chain-00', top=False,
+                      comment=ic.DISPATCH),
+            mock.call('sg-chain', '-j $sg-chain-03', top=False,
+                      comment=ic.DISPATCH),
+            mock.call('FORWARD', '-j $sg-fwd-00', top=True,
+                      comment=ic.DISPATCH),
+            mock.call('INPUT', '-j $sg-in-00', top=False,
+                      comment=ic.DISPATCH),
+            mock.call('sg-fwd-00', '-m physdev --physdev-out tapfake_dev '
+                      '--physdev-is-bridged -j $sg-chain', top=True,
+                      comment=ic.VM_INT_SG),
+            mock.call('sg-chain-00', '-m physdev --physdev-out tapfake_dev '
+                      '--physdev-is-bridged -j $ifake_dev', top=False,
+                      comment=ic.SG_TO_VM_SG),
+            mock.call('sg-in-00', '-m physdev --physdev-in tapfake_dev '
+                      '--physdev-is-bridged -j $ofake_dev', top=False,
+                      comment=ic.INPUT_TO_SG),
+            mock.call('sg-chain', '-j ACCEPT')], any_order=True)
+        self.assertNotIn(
+            mock.call('FORWARD', '-m physdev --physdev-out tapfake_dev '
+                      '--physdev-is-bridged -j $sg-chain', top=True,
+                      comment=ic.VM_INT_SG),
+            self.v4filter_inst.add_rule.mock_calls)
+
+    def test_remove_chains_apply(self):
+        port = self._fake_port()
+        self.firewall._remove_chains_apply({port['device']: port}, {})
+        for chain in ('sg-chain', 'sg-fwd', 'sg-in'):
+            for index in range(4):
+                self.v4filter_inst.remove_chain.assert_any_call(
+                    '%s-%02d' % (chain, index))
+        self.v4filter_inst.remove_chain.assert_any_call('sg-chain')
+
+
 class OVSHybridIptablesFirewallTestCase(BaseIptablesFirewallTestCase):
 
     def test__populate_initial_zone_map(self):
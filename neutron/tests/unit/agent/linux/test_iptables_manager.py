@@ -14,6 +14,7 @@
 #    limitations under the License.
 
 import os
+import random
 import sys
 from unittest import mock
 
@@ -1351,6 +1352,271 @@ class IptablesManagerStateFulTestCaseEmptyCustomBinaryNameIPv6(
     use_ipv6 = True
 
 
+class IptablesManagerNftBackendTestCase(IptablesManagerBaseTestCase):
+
+    def setUp(self):
+        super(IptablesManagerNftBackendTestCase, self).setUp()
+        cfg.CONF.set_override('iptables_backend', 'nft', 'AGENT')
+        self.iptables = iptables_manager.IptablesManager()
+
+    def _get_restore_dump(self, filter_rules):
+        iptables_args = dict(IPTABLES_ARG, filter_rules=filter_rules)
+        return (FILTER_RESTORE_DUMP % iptables_args + MANGLE_RESTORE_DUMP +
+                NAT_RESTORE_DUMP + RAW_RESTORE_DUMP)
+
+    def test_get_binary(self):
+        self.assertEqual('iptables-nft', self.iptables._get_binary('iptables'))
+        self.assertEqual('ip6tables-nft-save',
+                         self.iptables._get_binary('ip6tables', 'save'))
+        self.assertEqual('iptables-nft-restore',
+                         self.iptables._get_binary('iptables', 'restore'))
+
+    def test_apply_replaces_changed_chain(self):
+        restore_input = ('# Generated by iptables_manager\n'
+                         '*filter\n'
+                         '-F %(bn)s-test-filter\n'
+                         '-A %(bn)s-test-filter -j DROP\n'
+                         '-A %(bn)s-test-filter -i tap-xxx -j ACCEPT\n'
+                         'COMMIT\n'
+                         '# Completed by iptables_manager\n' % IPTABLES_ARG)
+        expected_calls_and_values = [
+            (mock.call(['iptables-nft-save'], run_as_root=True,
+                       privsep_exec=True),
+             self._get_restore_dump(
+                 '-A %(bn)s-test-filter -i tap-xxx -j ACCEPT\n' %
+                 IPTABLES_ARG)),
+            (mock.call(['iptables-nft-restore', '-n'],
+                       process_input=restore_input,
+                       run_as_root=True, privsep_exec=True,
+                       log_fail_as_error=False),
+             None),
+        ]
+        tools.setup_mock_calls(self.execute, expected_calls_and_values)
+
+        self.iptables.ipv4['filter'].add_chain('test-filter')
+        self.iptables.ipv4['filter'].add_rule('test-filter', '-j DROP')
+        self.iptables.ipv4['filter'].add_rule('test-filter',
+                                              '-i tap-xxx -j ACCEPT')
+        self.iptables.apply()
+
+        tools.verify_mock_calls(self.execute, expected_calls_and_values)
+
+    def test_apply_unchanged_chains(self):
+        expected_calls_and_values = [
+            (mock.call(['iptables-nft-save'], run_as_root=True,
+                       privsep_exec=True),
+             self._get_restore_dump(
+                 '-A %(bn)s-test-filter -i tap-xxx -j ACCEPT\n' %
+                 IPTABLES_ARG)),
+        ]
+        tools.setup_mock_calls(self.execute, expected_calls_and_values)
+
+        self.iptables.ipv4['filter'].add_chain('test-filter')
+        self.iptables.ipv4['filter'].add_rule('test-filter',
+                                              '-i tap-xxx -j ACCEPT')
+        self.assertEqual([], self.iptables.apply())
+
+        tools.verify_mock_calls(self.execute, expected_calls_and_values)
+
+    def test_generate_chain_replace_commands(self):
+        old_rules = [':INPUT ACCEPT [0:0]',
+                     ':old-chain - [0:0]',
+                     ':empty-chain - [0:0]',
+                     ':kept-chain - [0:0]',
+                     '-A INPUT -j old-chain',
+                     '-A INPUT -j kept-chain',
+                     '-A old-chain -j DROP',
+                     '-A kept-chain -j ACCEPT']
+        new_rules = [':INPUT ACCEPT [0:0]',
+                     ':kept-chain - [0:0]',
+                     ':new-chain - [0:0]',
+                     '-A INPUT -j kept-chain',
+                     '-A INPUT -j new-chain',
+                     '-A kept-chain -j ACCEPT',
+                     '-A kept-chain -j DROP',
+                     '-A new-chain -j DROP']
+        self.assertEqual(
+            [':new-chain - [0:0]',
+             '-D INPUT 1',
+             '-I INPUT 2 -j new-chain',
+             '-A kept-chain -j DROP',
+             '-A new-chain -j DROP',
+             '-F old-chain',
+             '-X empty-chain',
+             '-X old-chain'],
+            iptables_manager._generate_chain_replace_commands(old_rules,
+                                                              new_rules))
+
+    def test_generate_chain_replace_commands_flushes_changed_chain(self):
+        old_rules = [':FORWARD ACCEPT [0:0]',
+                     ':port-chain - [0:0]',
+                     '-A FORWARD -j port-chain',
+                     '-A port-chain -j RETURN',
+                     '-A port-chain -j DROP']
+        new_rules = [':FORWARD ACCEPT [0:0]',
+                     ':port-chain - [0:0]',
+                     '-A FORWARD -j port-chain',
+                     '-A port-chain -j DROP']
+        self.assertEqual(
+            ['-F port-chain',
+             '-A port-chain -j DROP'],
+            iptables_manager._generate_chain_replace_commands(old_rules,
+                                                              new_rules))
+
+    def test_get_builtin_chains(self):
+        self.assertEqual(
+            {'INPUT', 'FORWARD'},
+            iptables_manager._get_builtin_chains(
+                [':INPUT ACCEPT [10:200]',
+                 ':FORWARD DROP [0:0]',
+                 ':user-chain - [0:0]',
+                 ':our-chain',
+                 '-A INPUT -j user-chain']))
+
+
+class IptablesManagerRulesMirrorTestCase(IptablesManagerBaseTestCase):
+
+    def setUp(self):
+        super(IptablesManagerRulesMirrorTestCase, self).setUp()
+        cfg.CONF.set_override('iptables_resync_interval', 60, 'AGENT')
+        self.monotonic = mock.patch.object(
+            iptables_manager.time, 'monotonic', return_value=1000).start()
+        self.iptables = iptables_manager.IptablesManager()
+        self.execute.return_value = ''
+
+    def _get_commands(self):
+        commands = [call[0][0][0] for call in self.execute.call_args_list]
+        self.execute.reset_mock()
+        return commands
+
+    def test_apply_skips_save_within_interval(self):
+        self.iptables.apply()
+        self.assertEqual(['iptables-save', 'iptables-restore'],
+                         self._get_commands())
+
+        self.iptables.ipv4['filter'].add_rule('INPUT', '-j DROP')
+        self.iptables.apply()
+        self.assertEqual(['iptables-restore'], self._get_commands())
+        # nothing changed since the last apply
+        self.assertEqual([], self.iptables.apply())
+        self.assertEqual([], self._get_commands())
+
+        self.monotonic.return_value = 1060
+        self.iptables.apply()
+        self.assertEqual(['iptables-save', 'iptables-restore'],
+                         self._get_commands())
+
+    def test_apply_diffs_against_mirror(self):
+        self.iptables.ipv4['filter'].add_rule('INPUT', '-j DROP')
+        self.iptables.apply()
+        self.execute.reset_mock()
+
+        self.iptables.ipv4['filter'].remove_rule('INPUT', '-j DROP')
+        self.assertEqual(['# Generated by iptables_manager',
+                          '*filter',
+                          '-D %(bn)s-INPUT 1' % IPTABLES_ARG,
+                          'COMMIT',
+                          '# Completed by iptables_manager'],
+                         self.iptables.apply())
+        self.assertEqual(['iptables-restore'], self._get_commands())
+
+    def test_apply_saves_after_restore_failure(self):
+        self.iptables.apply()
+        self.iptables.ipv4['filter'].add_rule('INPUT', '-j DROP')
+        self.execute.side_effect = [RuntimeError(), '', '']
+        self.execute.reset_mock()
+        self.assertRaises(RuntimeError, self.iptables.apply)
+        self.assertEqual(['iptables-restore'], self._get_commands())
+
+        self.iptables.ipv4['filter'].add_rule('INPUT', '-j DROP')
+        self.iptables.apply()
+        self.assertEqual(['iptables-save', 'iptables-restore'],
+                         self._get_commands())
+
+    def test_apply_saves_new_table(self):
+        self.iptables.apply()
+        self.iptables.ipv4['security'] = iptables_manager.IptablesTable(
+            binary_name=self.iptables.wrap_name)
+        self.execute.reset_mock()
+        self.iptables.apply()
+        self.assertEqual('iptables-save', self._get_commands()[0])
+
+    def test_apply_restore_failure_namespace_deleted(self):
+        self.iptables.namespace = 'test'
+        self.iptables.apply()
+        self.iptables.ipv4['filter'].add_rule('INPUT', '-j DROP')
+        self.execute.side_effect = RuntimeError
+        with mock.patch.object(iptables_manager.ip_lib,
+                               'network_namespace_exists',
+                               return_value=False):
+            self.assertEqual([], self.iptables.apply())
+
+
+class IptablesChainDiffTestCase(base.BaseTestCase):
+
+    @staticmethod
+    def _apply_commands(chain, rules, commands):
+        rules = list(rules)
+        for command in commands:
+            action, chain_name, index, rule = (command.split(' ', 3) +
+                                               [''])[:4]
+            if action == '-D':
+                del rules[int(index) - 1]
+            else:
+                rules.insert(int(index) - 1,
+                             ('-A %s %s' % (chain, rule)).rstrip())
+        return rules
+
+    def _test_chain_diff(self, old_rules, new_rules, expected=None):
+        old_rules = ['-A chain %s' % rule for rule in old_rules]
+        new_rules = ['-A chain %s' % rule for rule in new_rules]
+        commands = iptables_manager._generate_chain_diff_iptables_commands(
+            'chain', old_rules, new_rules)
+        self.assertEqual(new_rules,
+                         self._apply_commands('chain', old_rules, commands))
+        if expected is not None:
+            self.assertEqual(expected, commands)
+
+    def test_append(self):
+        self._test_chain_diff(['a', 'b'], ['a', 'b', 'c', 'd'],
+                              ['-I chain 3 c', '-I chain 4 d'])
+
+    def test_insert(self):
+        self._test_chain_diff(['a', 'b'], ['a', 'c', 'b'], ['-I chain 2 c'])
+
+    def test_remove(self):
+        self._test_chain_diff(['a', 'b', 'c', 'd'], ['a', 'd'],
+                              ['-D chain 2', '-D chain 2'])
+
+    def test_replace(self):
+        self._test_chain_diff(['a', 'b', 'c', 'd'], ['a', 'e', 'c', 'f'],
+                              ['-D chain 2', '-I chain 2 e', '-D chain 4',
+                               '-I chain 4 f'])
+
+    def test_move(self):
+        self._test_chain_diff(['a', 'b', 'c', 'd'], ['d', 'a', 'b', 'c'],
+                              ['-I chain 1 d', '-D chain 5'])
+
+    def test_duplicated_rules(self):
+        self._test_chain_diff(['a', 'x', 'b', 'x', 'x', 'c'],
+                              ['x', 'c', 'x', 'a', 'b', 'x'])
+
+    def test_empty_chains(self):
+        self._test_chain_diff([], ['a', 'b'], ['-I chain 1 a',
+                                               '-I chain 2 b'])
+        self._test_chain_diff(['a', 'b'], [], ['-D chain 1', '-D chain 1'])
+        self._test_chain_diff([], [], [])
+
+    def test_random_changes(self):
+        for _attempt in range(50):
+            old_rules = [str(random.randint(0, 30)) for _rule in range(30)]
+            new_rules = [rule for rule in old_rules if random.random() > 0.2]
+            for _insert in range(random.randint(0, 10)):
+                new_rules.insert(random.randint(0, len(new_rules)),
+                                 str(random.randint(0, 40)))
+            self._test_chain_diff(old_rules, new_rules)
+
+
 class IptablesManagerStateLessTestCase(base.BaseTestCase):
 
     def setUp(self):
@@ -12,14 +12,18 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import copy
 from unittest import mock
 
 from neutron_lib.callbacks import events
 from neutron_lib.callbacks import registry
+from neutron_lib import constants
 from neutron_lib import context
+from oslo_utils import uuidutils
 
 from neutron.agent import resource_cache
 from neutron.api.rpc.callbacks import events as events_rpc
+from neutron.objects import securitygroup
 from neutron.tests import base
 
 
@@ -112,6 +116,57 @@ class RemoteResourceCacheTestCase(base.BaseTestCase):
         self.assertCountEqual([geese[3]],
                               self.rcache.get_resources('goose', is_small))
 
+    def test_get_resources_indexed(self):
+        self.rcache = resource_cache.RemoteResourceCache(
+            ['duck', 'goose'], indexes={'goose': ('size', 'tags')})
+        mock.patch.object(self.rcache, '_puller').start()
+        geese = [OVOLikeThing(3, size='large', tags=['a', 'b']),
+                 OVOLikeThing(5, size='medium', tags=['b']),
+                 OVOLikeThing(4, size='large', tags=[]),
+                 OVOLikeThing(6, size='small', tags=['a'])]
+        for goose in geese:
+            self.rcache.record_resource_update(self.ctx, 'goose', goose)
+        self.assertCountEqual(
+            [geese[0], geese[2]],
+            self.rcache.get_resources('goose', {'size': ('large', )}))
+        self.assertCountEqual(
+            [geese[0], geese[3]],
+            self.rcache.get_resources('goose', {'tags': ('a', )}))
+        self.assertCountEqual(
+            [geese[0], geese[1], geese[3]],
+            self.rcache.get_resources('goose', {'tags': ('a', 'b')}))
+        self.assertCountEqual(
+            [geese[0]],
+            self.rcache.get_resources('goose', {'size': ('large', ),
+                                                'tags': ('a', )}))
+        self.assertEqual(
+            [], self.rcache.get_resources('goose', {'size': ('xlarge', )}))
+
+        # the indexes follow the updates and deletions of the resources
+        self.rcache.record_resource_update(
+            self.ctx, 'goose', OVOLikeThing(3, revision_number=11,
+                                            size='small', tags=['b']))
+        self.rcache.record_resource_delete(self.ctx, 'goose', 4)
+        self.assertEqual(
+            [], self.rcache.get_resources('goose', {'size': ('large', )}))
+        self.assertCountEqual(
+            [3, 6], [goose.id for goose in self.rcache.get_resources(
+                'goose', {'size': ('small', )})])
+        self.assertEqual(
+            [6], [goose.id for goose in self.rcache.get_resources(
+                'goose', {'tags': ('a', )})])
+        self.assertEqual({'hits': 8, 'misses': 0},
+                         self.rcache.get_index_stats()['goose'])
+
+    def test_get_resources_not_indexed(self):
+        self.rcache.record_resource_update(
+            self.ctx, 'goose', OVOLikeThing(3, size='large'))
+        self.assertEqual(
+            1, len(self.rcache.get_resources('goose', {'size': ('large', )})))
+        self.assertEqual({'duck': {'hits': 0, 'misses': 0},
+                          'goose': {'hits': 0, 'misses': 1}},
+                         self.rcache.get_index_stats())
+
     def test_match_resources_with_func(self):
         geese = [OVOLikeThing(3, size='large'), OVOLikeThing(5, size='medium'),
                  OVOLikeThing(4, size='xlarge'), OVOLikeThing(6, size='small')]
@@ -204,3 +259,157 @@ class RemoteResourceCacheTestCase(base.BaseTestCase):
         for goose in geese:
             self.assertIsNone(
                 self.rcache.get_resource_by_id('goose', goose.id))
+
+
+class CompactRemoteResourceCacheTestCase(base.BaseTestCase):
+    def setUp(self):
+        super(CompactRemoteResourceCacheTestCase, self).setUp()
+        self.ctx = context.get_admin_context()
+        self.rcache = resource_cache.RemoteResourceCache(
+            ['SecurityGroupRule'], compact=True)
+        mock.patch.object(self.rcache, '_puller').start()
+        self.sg_id = uuidutils.generate_uuid()
+
+    def _make_rule(self, revision_number=1, **kwargs):
+        rule = {'id': uuidutils.generate_uuid(),
+                'project_id': 'project',
+                'security_group_id': self.sg_id,
+                'direction': constants.INGRESS_DIRECTION,
+                'ethertype': constants.IPv4,
+                'protocol': constants.PROTO_NAME_TCP,
+                'port_range_min': 22,
+                'port_range_max': 22,
+                'remote_group_id': None,
+                'remote_address_group_id': None,
+                'remote_ip_prefix': None,
+                'normalized_cidr': None,
+                'revision_number': revision_number}
+        rule.update(kwargs)
+        return securitygroup.SecurityGroupRule(**rule)
+
+    def test_get_resource_by_id(self):
+        rule = self._make_rule()
+        self.rcache.record_resource_update(self.ctx, 'SecurityGroupRule',
+                                           rule)
+        cached_item = self.rcache._type_cache('SecurityGroupRule')[rule.id]
+        self.assertIsInstance(cached_item, resource_cache.CompactResource)
+        self.assertEqual(rule.id, cached_item.id)
+        self.assertEqual(1, cached_item.revision_number)
+
+        cached_rule = self.rcache.get_resource_by_id('SecurityGroupRule',
+                                                     rule.id)
+        self.assertIsInstance(cached_rule, securitygroup.SecurityGroupRule)
+        self.assertIsNot(rule, cached_rule)
+        self.assertEqual(rule.to_dict(), cached_rule.to_dict())
+
+    def test_get_resources(self):
+        rules = [self._make_rule(), self._make_rule(),
+                 self._make_rule(security_group_id=uuidutils.generate_uuid())]
+        for rule in rules:
+            self.rcache.record_resource_update(self.ctx, 'SecurityGroupRule',
+                                               rule)
+        self.assertCountEqual(
+            [rules[0].id, rules[1].id],
+            [rule.id for rule in self.rcache.get_resources(
+                'SecurityGroupRule', {'security_group_id': (self.sg_id, )})])
+        self.assertCountEqual(
+            [rules[0].id, rules[1].id, rules[2].id],
+            [rule.id for rule in self.rcache.get_resources(
+                'SecurityGroupRule', {'port_range_min': (22, )})])
+
+    def test_get_resources_not_loaded(self):
+        rule = self._make_rule()
+        self.rcache.record_resource_update(self.ctx, 'SecurityGroupRule',
+                                           rule)
+        cached_item = self.rcache._type_cache('SecurityGroupRule')[rule.id]
+        self.assertEqual([cached_item], self.rcache.get_resources(
+            'SecurityGroupRule', {'security_group_id': (self.sg_id, )},
+            load=False))
+        self.assertEqual({}, self.rcache._loaded_by_type_and_id[
+            'SecurityGroupRule'])
+
+    def test_record_resource_update_and_delete(self):
+        received_kw = []
+        receiver = lambda r, e, t, payload: received_kw.append(payload)
+        registry.subscribe(receiver, 'SecurityGroupRule', events.AFTER_UPDATE)
+        registry.subscribe(receiver, 'SecurityGroupRule', events.AFTER_DELETE)
+        rule = self._make_rule()
+        self.rcache.record_resource_update(self.ctx, 'SecurityGroupRule',
+                                           rule)
+        updated_rule = self._make_rule(revision_number=2, id=rule.id,
+                                       port_range_max=23)
+        self.rcache.record_resource_update(self.ctx, 'SecurityGroupRule',
+                                           updated_rule)
+        self.assertEqual(2, len(received_kw))
+        self.assertEqual(rule.to_dict(), received_kw[1].states[0].to_dict())
+        self.assertEqual({'port_range_max'},
+                         received_kw[1].metadata['changed_fields'])
+
+        self.rcache.record_resource_delete(self.ctx, 'SecurityGroupRule',
+                                           rule.id)
+        self.assertEqual(updated_rule.to_dict(),
+                         received_kw[2].states[0].to_dict())
+        self.assertEqual([], self.rcache.get_resources(
+            'SecurityGroupRule', {'security_group_id': (self.sg_id, )}))
+
+    def test_compact_resource_shared_layout(self):
+        compact_rules = [
+            resource_cache.CompactResource.from_object(self._make_rule())
+            for _i in range(2)]
+        self.assertIs(compact_rules[0]._layout, compact_rules[1]._layout)
+        self.assertIs(compact_rules[0].security_group_id,
+                      compact_rules[1].security_group_id)
+        self.assertRaises(AttributeError, getattr, compact_rules[0], 'foo')
+
+    def test_loaded_resources_reused(self):
+        rule = self._make_rule()
+        self.rcache.record_resource_update(self.ctx, 'SecurityGroupRule',
+                                           rule)
+        with mock.patch.object(resource_cache.CompactResource, 'materialize',
+                               autospec=True,
+                               side_effect=lambda record: rule) as mat:
+            self.assertIs(rule, self.rcache.get_resource_by_id(
+                'SecurityGroupRule', rule.id))
+            self.assertEqual([rule], self.rcache.get_resources(
+                'SecurityGroupRule', {'security_group_id': (self.sg_id, )}))
+        mat.assert_called_once_with(mock.ANY)
+
+    def test_loaded_resources_expired(self):
+        self.rcache._loaded_cache_size = 1
+        rules = [self._make_rule(), self._make_rule()]
+        for rule in rules:
+            self.rcache.record_resource_update(self.ctx, 'SecurityGroupRule',
+                                               rule)
+        first = self.rcache.get_resource_by_id('SecurityGroupRule',
+                                               rules[0].id)
+        self.rcache.get_resource_by_id('SecurityGroupRule', rules[1].id)
+        self.assertIsNot(first, self.rcache.get_resource_by_id(
+            'SecurityGroupRule', rules[0].id))
+
+    def test_loaded_resource_dropped_on_update(self):
+        rule = self._make_rule()
+        self.rcache.record_resource_update(self.ctx, 'SecurityGroupRule',
+                                           rule)
+        self.assertEqual(22, self.rcache.get_resource_by_id(
+            'SecurityGroupRule', rule.id).port_range_max)
+        self.rcache.record_resource_update(
+            self.ctx, 'SecurityGroupRule',
+            self._make_rule(revision_number=2, id=rule.id,
+                            port_range_max=23))
+        self.assertEqual(23, self.rcache.get_resource_by_id(
+            'SecurityGroupRule', rule.id).port_range_max)
+        self.rcache.record_resource_delete(self.ctx, 'SecurityGroupRule',
+                                           rule.id)
+        self.assertEqual({}, self.rcache._loaded_by_type_and_id[
+            'SecurityGroupRule'])
+
+    def test_private_attributes_not_looked_up(self):
+        rule = self._make_rule()
+        self.rcache.record_resource_update(self.ctx, 'SecurityGroupRule',
+                                           rule)
+        cached_item = self.rcache._type_cache('SecurityGroupRule')[rule.id]
+        self.assertRaises(AttributeError, getattr, cached_item, '_rule')
+        record = resource_cache.CompactResource.__new__(
+            resource_cache.CompactResource)
+        self.assertRaises(AttributeError, getattr, record, 'id')
+        self.assertEqual(rule.id, copy.copy(cached_item).id)
@@ -371,9 +371,16 @@ class TestCacheBackedPluginApi(base.BaseTestCase):
         rpc.CacheBackedPluginApi(lib_topics.PLUGIN)
 
         rcache_class.assert_called_once_with(
-            rpc.CacheBackedPluginApi.RESOURCE_TYPES)
+            rpc.CacheBackedPluginApi.RESOURCE_TYPES, compact=False)
         rcache_obj.start_watcher.assert_called_once_with()
 
+    @mock.patch('neutron.agent.resource_cache.RemoteResourceCache')
+    def test_initialization_with_compact_cache(self, rcache_class):
+        rpc.CacheBackedPluginApi(lib_topics.PLUGIN, compact_cache=True)
+
+        rcache_class.assert_called_once_with(
+            rpc.CacheBackedPluginApi.RESOURCE_TYPES, compact=True)
+
     @mock.patch('neutron.agent.resource_cache.RemoteResourceCache')
     def test_initialization_with_custom_resource(self, rcache_class):
         CUSTOM = 'test'
@@ -386,5 +393,5 @@ class TestCacheBackedPluginApi(base.BaseTestCase):
         CustomCacheBackedPluginApi(lib_topics.PLUGIN)
 
         rcache_class.assert_called_once_with(
-            CustomCacheBackedPluginApi.RESOURCE_TYPES)
+            CustomCacheBackedPluginApi.RESOURCE_TYPES, compact=False)
         rcache_obj.start_watcher.assert_called_once_with()
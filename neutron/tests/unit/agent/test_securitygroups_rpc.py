@@ -15,10 +15,14 @@
 
 import collections
 import contextlib
+import functools
 from unittest import mock
 
 import netaddr
 from neutron_lib.api.definitions import allowedaddresspairs as addr_apidef
+from neutron_lib.callbacks import events
+from neutron_lib.callbacks import registry
+from neutron_lib.callbacks import resources
 from neutron_lib import constants as const
 from neutron_lib import context
 from neutron_lib.plugins import directory
@@ -35,10 +39,16 @@ from neutron.agent.linux import iptables_manager
 from neutron.agent.linux import utils as linux_utils
 from neutron.agent import securitygroups_rpc as sg_rpc
 from neutron.api.rpc.handlers import securitygroups_rpc
+from neutron.db.models import securitygroup as sg_models
 from neutron.db import securitygroups_rpc_base as sg_db_rpc
 from neutron.extensions import securitygroup as ext_sg
+from neutron.objects import network as network_obj
+from neutron.objects import ports as port_obj
+from neutron.objects import securitygroup as sg_obj
+from neutron.services.revisions import revision_plugin
 from neutron.tests import base
 from neutron.tests.unit.extensions import test_securitygroup as test_sg
+from neutron.tests.unit import testlib_api
 
 FAKE_PREFIX = {const.IPv4: '10.0.0.0/24',
                const.IPv6: '2001:db8::/64'}
@@ -843,6 +853,216 @@ class SGServerRpcCallBackTestCase(test_sg.SecurityGroupDBTestCase):
             self._delete('ports', port_id2)
 
 
+class SecurityGroupServerRpcCacheTestCase(base.BaseTestCase):
+
+    def setUp(self):
+        super(SecurityGroupServerRpcCacheTestCase, self).setUp()
+        cfg.CONF.set_override('info_cache_expiration_time', 60,
+                              group='SECURITYGROUP')
+        self.ctx = context.get_admin_context()
+        self.plugin = sg_db_rpc.SecurityGroupServerRpcMixin()
+        self.plugin.notifier = mock.Mock()
+        self.query_ips = mock.patch.object(
+            self.plugin, '_query_ips_for_remote_group',
+            side_effect=lambda ctx, sg_ids: {
+                sg_id: {('10.0.0.1', None)} for sg_id in sg_ids}).start()
+        self.query_stateful = mock.patch.object(
+            self.plugin, '_query_sgs_stateful',
+            side_effect=lambda ctx, sg_ids: {
+                sg_id: True for sg_id in sg_ids}).start()
+        self.versions = {}
+        mock.patch.object(
+            self.plugin, '_query_revision_numbers',
+            side_effect=lambda ctx, model, ids: {
+                id_: self.versions.get(id_, 1) for id_ in ids}).start()
+        mock.patch.object(
+            self.plugin, '_query_remote_group_versions',
+            side_effect=lambda ctx, sg_ids: {
+                sg_id: self.versions.get(sg_id, (1, 1, 1))
+                for sg_id in sg_ids}).start()
+
+    def _publish_port_update(self, original_port, port):
+        registry.publish(resources.PORT, events.AFTER_UPDATE, self,
+                         payload=events.DBEventPayload(
+                             self.ctx, resource_id='port_id',
+                             states=(original_port, port)))
+
+    def test_select_ips_for_remote_group_cached(self):
+        ips = self.plugin._select_ips_for_remote_group(
+            self.ctx, ['sg1', 'sg2'])
+        self.assertEqual({'sg1': {('10.0.0.1', None)},
+                          'sg2': {('10.0.0.1', None)}}, ips)
+        ips = self.plugin._select_ips_for_remote_group(
+            self.ctx, ['sg1', 'sg3'])
+        self.assertEqual({'sg1': {('10.0.0.1', None)},
+                          'sg3': {('10.0.0.1', None)}}, ips)
+        self.assertEqual(2, self.query_ips.call_count)
+        self.assertEqual(['sg3'], self.query_ips.call_args[0][1])
+        self.assertEqual(
+            {'member_ips': {'hits': 1, 'misses': 3, 'hit_ratio': 0.25}},
+            self.plugin.get_sg_info_cache_stats())
+
+    def test_select_ips_for_remote_group_cache_disabled(self):
+        cfg.CONF.set_override('info_cache_expiration_time', 0,
+                              group='SECURITYGROUP')
+        plugin = sg_db_rpc.SecurityGroupServerRpcMixin()
+        with mock.patch.object(plugin, '_query_ips_for_remote_group',
+                               return_value={}) as query_ips:
+            plugin._select_ips_for_remote_group(self.ctx, ['sg1'])
+            plugin._select_ips_for_remote_group(self.ctx, ['sg1'])
+        self.assertEqual(2, query_ips.call_count)
+        self.assertEqual({}, plugin.get_sg_info_cache_stats())
+
+    def test_select_ips_for_remote_group_version_changed(self):
+        # the ports are changed by another worker, without notification
+        self.plugin._select_ips_for_remote_group(self.ctx, ['sg1', 'sg2'])
+        self.versions['sg1'] = (2, 5, 2)
+        self.plugin._select_ips_for_remote_group(self.ctx, ['sg1', 'sg2'])
+        self.assertEqual(['sg1'], self.query_ips.call_args[0][1])
+        self.plugin._select_ips_for_remote_group(self.ctx, ['sg1', 'sg2'])
+        self.assertEqual(2, self.query_ips.call_count)
+
+    def test_security_group_revision_changed_invalidates_stateful(self):
+        self.plugin._is_security_group_stateful(self.ctx, 'sg1')
+        self.versions['sg1'] = 2
+        self.plugin._is_security_group_stateful(self.ctx, 'sg1')
+        self.assertEqual(2, self.query_stateful.call_count)
+
+    def test_security_group_info_for_ports_stateful_selected_once(self):
+        rules = [('port1', {'security_group_id': sg_id,
+                            'direction': 'ingress', 'ethertype': 'IPv4',
+                            'protocol': 'tcp', 'port_range_min': port,
+                            'port_range_max': port})
+                 for sg_id in ('sg1', 'sg2') for port in range(1, 11)]
+        with mock.patch.object(self.plugin, '_select_rules_for_ports',
+                               return_value=rules), \
+                mock.patch.object(self.plugin, '_select_sg_ids_for_ports',
+                                  return_value=[('sg1', ), ('sg2', )]), \
+                mock.patch.object(self.plugin, '_apply_provider_rule'), \
+                mock.patch.object(self.plugin,
+                                  '_query_revision_numbers') as revisions:
+            revisions.side_effect = lambda ctx, model, ids: {
+                id_: 1 for id_ in ids}
+            for _i in range(2):
+                sg_info = self.plugin.security_group_info_for_ports(
+                    self.ctx, {'port1': {'fixed_ips': []}})
+        self.assertEqual(2, revisions.call_count)
+        self.query_stateful.assert_called_once_with(self.ctx, mock.ANY)
+        self.assertCountEqual(['sg1', 'sg2'],
+                              self.query_stateful.call_args[0][1])
+        self.assertTrue(all(rule['stateful'] for sg_rules in
+                            sg_info['security_groups'].values()
+                            for rule in sg_rules))
+        self.assertEqual({'hits': 2, 'misses': 2, 'hit_ratio': 0.5},
+                         self.plugin.get_sg_info_cache_stats()['stateful'])
+
+    def test_port_fixed_ips_update_invalidates_member_ips(self):
+        self.plugin._select_ips_for_remote_group(self.ctx, ['sg1', 'sg2'])
+        original_port = {'fixed_ips': ['10.0.0.1'], 'mac_address': 'mac',
+                         'device_owner': 'compute:nova',
+                         ext_sg.SECURITYGROUPS: ['sg1']}
+        port = dict(original_port, fixed_ips=['10.0.0.2'])
+        self._publish_port_update(original_port, port)
+        self.plugin._select_ips_for_remote_group(self.ctx, ['sg1', 'sg2'])
+        self.assertEqual(['sg1'], self.query_ips.call_args[0][1])
+
+    def test_port_status_update_keeps_member_ips(self):
+        self.plugin._select_ips_for_remote_group(self.ctx, ['sg1'])
+        original_port = {'fixed_ips': ['10.0.0.1'], 'mac_address': 'mac',
+                         'device_owner': 'compute:nova', 'status': 'DOWN',
+                         ext_sg.SECURITYGROUPS: ['sg1']}
+        port = dict(original_port, status='ACTIVE')
+        self._publish_port_update(original_port, port)
+        self.plugin._select_ips_for_remote_group(self.ctx, ['sg1'])
+        self.query_ips.assert_called_once_with(self.ctx, ['sg1'])
+
+    def test_security_group_update_invalidates_stateful(self):
+        self.assertTrue(
+            self.plugin._is_security_group_stateful(self.ctx, 'sg1'))
+        self.assertTrue(
+            self.plugin._is_security_group_stateful(self.ctx, 'sg1'))
+        self.query_stateful.assert_called_once_with(self.ctx, ['sg1'])
+        registry.publish(resources.SECURITY_GROUP, events.AFTER_UPDATE, self,
+                         payload=events.DBEventPayload(
+                             self.ctx, resource_id='sg1',
+                             states=({}, {})))
+        self.plugin._is_security_group_stateful(self.ctx, 'sg1')
+        self.assertEqual(2, self.query_stateful.call_count)
+
+    def test_security_group_rule_delete_invalidates_rules(self):
+        with mock.patch.object(self.plugin, '_select_rules_for_sgs',
+                               return_value={'sg1': []}) as select_rules:
+            select = functools.partial(self.plugin._get_cached_sg_info,
+                                       'rules', ['sg1'], select_rules,
+                                       lambda ids: {'sg1': 1})
+            select()
+            select()
+            registry.publish(resources.SECURITY_GROUP_RULE,
+                             events.AFTER_DELETE, self,
+                             payload=events.DBEventPayload(
+                                 self.ctx, resource_id='rule_id',
+                                 metadata={'security_group_id': 'sg1'}))
+            select()
+        self.assertEqual(2, select_rules.call_count)
+
+
+class SecurityGroupServerRpcCacheVersionsTestCase(testlib_api.SqlTestCase):
+
+    def setUp(self):
+        super(SecurityGroupServerRpcCacheVersionsTestCase, self).setUp()
+        # the revision numbers are bumped by the revision plugin
+        revision_plugin.RevisionPlugin()
+        self.ctx = context.get_admin_context()
+        self.plugin = sg_db_rpc.SecurityGroupServerRpcMixin()
+        self.network = network_obj.Network(self.ctx, name='net')
+        self.network.create()
+        self.sg = sg_obj.SecurityGroup(self.ctx, name='sg')
+        self.sg.create()
+
+    def _create_port(self):
+        port = port_obj.Port(
+            self.ctx, network_id=self.network.id, admin_state_up=True,
+            status='ACTIVE', device_id='device', device_owner='compute:nova',
+            mac_address=tools.get_random_EUI(),
+            security_group_ids={self.sg.id})
+        port.create()
+        return port
+
+    def _get_member_version(self):
+        return self.plugin._query_remote_group_versions(
+            self.ctx, [self.sg.id]).get(self.sg.id)
+
+    def test_query_revision_numbers(self):
+        revisions = self.plugin._query_revision_numbers(
+            self.ctx, sg_models.SecurityGroup, [self.sg.id, 'unknown'])
+        self.assertEqual({self.sg.id: self.sg.revision_number}, revisions)
+
+    def test_query_sgs_stateful(self):
+        stateless_sg = sg_obj.SecurityGroup(self.ctx, name='stateless',
+                                            stateful=False)
+        stateless_sg.create()
+        self.assertEqual(
+            {self.sg.id: True, stateless_sg.id: False},
+            self.plugin._query_sgs_stateful(
+                self.ctx, [self.sg.id, stateless_sg.id]))
+
+    def test_query_remote_group_versions(self):
+        self.assertIsNone(self._get_member_version())
+        port1 = self._create_port()
+        version = self._get_member_version()
+        self.assertEqual(1, version[0])
+
+        port1.name = 'port1'
+        port1.update()
+        self.assertNotEqual(version, self._get_member_version())
+
+        # the same number of members, the new port has a higher ID
+        version = self._get_member_version()
+        port1.delete()
+        self._create_port()
+        self.assertNotEqual(version, self._get_member_version())
+
+
 class SecurityGroupAgentRpcTestCaseForNoneDriver(base.BaseTestCase):
     def test_init_firewall_with_none_driver(self):
         set_enable_security_groups(False)
@@ -990,6 +1210,27 @@ class SecurityGroupAgentRpcTestCase(BaseSecurityGroupAgentRpcTestCase):
         self.assertFalse(self.agent.refresh_firewall.called)
         self.assertFalse(self.firewall.security_group_updated.called)
 
+    def test_security_groups_member_delta(self):
+        self.agent.refresh_firewall = mock.Mock()
+        update_delta = self.firewall.update_security_group_members_delta
+        update_delta.return_value = True
+        delta = ({'IPv4': {('10.0.0.1', 'fa:16:3e:00:00:01')}}, {})
+        self.agent.security_groups_member_delta({'fake_sgid2': delta,
+                                                 'fake_sgid3': delta})
+        update_delta.assert_called_once_with('fake_sgid2', *delta)
+        self.assertFalse(self.agent.refresh_firewall.called)
+
+    def test_security_groups_member_delta_not_supported(self):
+        self.agent.refresh_firewall = mock.Mock()
+        self.firewall.update_security_group_members_delta.return_value = (
+            False)
+        delta = ({'IPv4': {('10.0.0.1', 'fa:16:3e:00:00:01')}}, {})
+        self.agent.security_groups_member_delta({'fake_sgid2': delta})
+        self.agent.refresh_firewall.assert_called_once_with(
+            [self.fake_device['device']])
+        self.firewall.security_group_updated.assert_called_once_with(
+            'sg_member', {'fake_sgid2'})
+
     def test_address_group_updated(self):
         ag_list = ['fake_agid1', 'fake_agid2']
         sg_list = ['fake_sgid1', 'fake_sgid2']
@@ -1422,6 +1663,97 @@ class SecurityGroupAgentRpcWithDeferredRefreshTestCase(
         self.assertFalse(self.agent.prepare_devices_filter.called)
         self.assertFalse(self.firewall.security_group_updated.called)
 
+    def test_security_groups_member_delta(self):
+        self.agent.prepare_devices_filter = mock.Mock()
+        self.agent.refresh_firewall = mock.Mock()
+        update_delta = self.firewall.update_security_group_members_delta
+        update_delta.return_value = True
+        mac = 'fa:16:3e:00:00:01'
+        self.agent.security_groups_member_delta(
+            {'fake_sgid2': ({'IPv4': {('10.0.0.1', mac)}},
+                            {'IPv4': {('10.0.0.2', mac)}})})
+        self.agent.security_groups_member_delta(
+            {'fake_sgid2': ({'IPv4': {('10.0.0.2', mac)}},
+                            {'IPv4': {('10.0.0.1', mac)},
+                             'IPv6': {('2001:db8::1', mac)}})})
+        self.assertFalse(update_delta.called)
+        self.assertTrue(self.agent.firewall_refresh_needed())
+        self.assertFalse(self.agent.devices_to_refilter)
+
+        self.agent.setup_port_filters(set(), set())
+        update_delta.assert_called_once_with(
+            'fake_sgid2', {'IPv4': {('10.0.0.2', mac)}},
+            {'IPv4': {('10.0.0.1', mac)}, 'IPv6': {('2001:db8::1', mac)}})
+        self.assertFalse(self.agent.refresh_firewall.called)
+        self.assertFalse(self.agent.firewall_refresh_needed())
+
+    def test_security_groups_member_delta_not_supported(self):
+        self.agent.prepare_devices_filter = mock.Mock()
+        self.agent.refresh_firewall = mock.Mock()
+        self.firewall.update_security_group_members_delta.return_value = (
+            False)
+        self.agent.security_groups_member_delta(
+            {'fake_sgid2': ({'IPv4': {('10.0.0.1', None)}}, {})})
+        self.agent.setup_port_filters(set(), set())
+        self.agent.refresh_firewall.assert_called_once_with(
+            set(['fake_device']))
+        self.assertFalse(self.agent.firewall_refresh_needed())
+
+    def test_refresh_stats(self):
+        self.agent.refresh_firewall = mock.Mock()
+        self.agent.security_groups_rule_updated(['fake_sgid1'])
+        self.agent.security_groups_member_updated(['fake_sgid2'])
+        self.agent.setup_port_filters(set(), set())
+        self.agent.refresh_firewall.assert_called_once_with(
+            set(['fake_device']))
+        self.assertEqual({'updates_received': 2,
+                          'refreshes_performed': 1,
+                          'devices_pending': 0,
+                          'member_deltas_pending': 0},
+                         self.agent.get_refresh_stats())
+
+    @mock.patch.object(sg_rpc.time, 'monotonic')
+    def test_setup_port_filters_debounced(self, monotonic):
+        self.agent.refresh_debounce_interval = 2
+        self.agent.prepare_devices_filter = mock.Mock()
+        self.agent.refresh_firewall = mock.Mock()
+        with self.add_fake_device(device='fake_device_2',
+                                  sec_groups=['fake_sgid2']):
+            monotonic.return_value = 100
+            self.agent.security_groups_rule_updated(['fake_sgid1'])
+            monotonic.return_value = 101
+            self.agent.security_groups_rule_updated(['fake_sgid2'])
+            self.assertFalse(self.agent.firewall_refresh_needed())
+            self.agent.setup_port_filters(set(), set())
+            self.assertFalse(self.agent.refresh_firewall.called)
+            self.assertEqual(set(['fake_device', 'fake_device_2']),
+                             self.agent.devices_to_refilter)
+
+            monotonic.return_value = 102
+            self.assertTrue(self.agent.firewall_refresh_needed())
+            self.agent.setup_port_filters(set(), set())
+            self.agent.refresh_firewall.assert_called_once_with(
+                set(['fake_device', 'fake_device_2']))
+            self.assertFalse(self.agent.devices_to_refilter)
+            self.assertIsNone(self.agent._refilter_pending_since)
+
+    @mock.patch.object(sg_rpc.time, 'monotonic')
+    def test_setup_port_filters_debounced_updated_ports(self, monotonic):
+        self.agent.refresh_debounce_interval = 2
+        self.agent.prepare_devices_filter = mock.Mock()
+        self.agent.refresh_firewall = mock.Mock()
+        monotonic.return_value = 100
+        self.agent.security_groups_rule_updated(['fake_sgid1'])
+        self.agent.setup_port_filters(set(['fake_new_device']),
+                                      set(['fake_device']))
+        self.agent.prepare_devices_filter.assert_called_once_with(
+            set(['fake_new_device']))
+        # the pending device is refreshed as an updated device
+        self.agent.refresh_firewall.assert_called_once_with(
+            set(['fake_device']))
+        self.assertFalse(self.agent.devices_to_refilter)
+        self.assertIsNone(self.agent._refilter_pending_since)
+
 
 class FakeSGNotifierAPI(securitygroups_rpc.SecurityGroupAgentRpcApiMixin):
     def __init__(self):
@@ -102,6 +102,24 @@ class TestDhcpRpcCallback(base.BaseTestCase):
                      'ports': []}]
         self.assertEqual(expected, networks)
 
+    def test_get_changed_networks_info(self):
+        networks = [{'id': 'a', 'revision_number': 1},
+                    {'id': 'b', 'revision_number': 1},
+                    {'id': 'c', 'revision_number': 1}]
+        self.plugin.get_networks.return_value = networks
+        self.plugin.get_ports.return_value = [
+            {'id': 'p', 'network_id': 'a', 'revision_number': 3}]
+        self.plugin.get_subnets.return_value = []
+        expected = self.callbacks.get_active_networks_info(
+            mock.Mock(), host='host')
+        network_revisions = {
+            'a': utils.get_dhcp_network_revision(expected[0]),
+            'b': 'stale'}
+        result = self.callbacks.get_changed_networks_info(
+            mock.Mock(), host='host', network_revisions=network_revisions)
+        self.assertEqual({'networks': expected[1:],
+                          'network_ids': ['a', 'b', 'c']}, result)
+
     def _test_get_active_networks_info_enable_dhcp_filter(self,
                                                           enable_dhcp_filter):
         plugin_retval = [{'id': 'a'}, {'id': 'b'}]
@@ -67,12 +67,15 @@ class SGAgentRpcCallBackMixinTestCase(base.BaseTestCase):
 
 class SecurityGroupServerAPIShimTestCase(base.BaseTestCase):
 
+    compact = False
+
     def setUp(self):
         super(SecurityGroupServerAPIShimTestCase, self).setUp()
         objects.register_objects()
         resource_types = [resources.PORT, resources.SECURITYGROUP,
                           resources.SECURITYGROUPRULE, resources.ADDRESSGROUP]
-        self.rcache = resource_cache.RemoteResourceCache(resource_types)
+        self.rcache = resource_cache.RemoteResourceCache(
+            resource_types, compact=self.compact)
         # prevent any server lookup attempts
         mock.patch.object(self.rcache, '_flood_cache_for_query').start()
         self.shim = securitygroups_rpc.SecurityGroupServerAPIShim(self.rcache)
@@ -85,6 +88,7 @@ class SecurityGroupServerAPIShimTestCase(base.BaseTestCase):
                  'network_id': uuidutils.generate_uuid(),
                  'security_group_ids': set(),
                  'device_owner': 'compute:None',
+                 'mac_address': netaddr.EUI('fa:16:3e:aa:bb:cc'),
                  'allowed_address_pairs': []}
         attrs['fixed_ips'] = [ports.IPAllocation(
             port_id=attrs['id'], subnet_id=uuidutils.generate_uuid(),
@@ -189,14 +193,45 @@ class SecurityGroupServerAPIShimTestCase(base.BaseTestCase):
 
     def test_sg_member_update_events(self):
         s1 = self._make_security_group_ovo()
+        mac = str(netaddr.EUI('fa:16:3e:aa:bb:cc'))
         p1 = self._make_port_ovo(ip='1.1.1.1', security_group_ids={s1.id})
+        self.sg_agent.security_groups_member_delta.assert_called_with(
+            {s1.id: ({'IPv4': {('1.1.1.1', mac)}}, {})})
         self._make_port_ovo(ip='2.2.2.2', security_group_ids={s1.id})
-        self.sg_agent.security_groups_member_updated.assert_called_with(
-            {s1.id})
-        self.sg_agent.security_groups_member_updated.reset_mock()
+        self.sg_agent.security_groups_member_delta.assert_called_with(
+            {s1.id: ({'IPv4': {('2.2.2.2', mac)}}, {})})
+        self.sg_agent.security_groups_member_delta.reset_mock()
         self.rcache.record_resource_delete(self.ctx, 'Port', p1.id)
-        self.sg_agent.security_groups_member_updated.assert_called_with(
-            {s1.id})
+        self.sg_agent.security_groups_member_delta.assert_called_with(
+            {s1.id: ({}, {'IPv4': {('1.1.1.1', mac)}})})
+        self.assertFalse(
+            self.sg_agent.security_groups_member_updated.called)
+
+    def test_sg_member_update_events_port_updated(self):
+        s1 = self._make_security_group_ovo()
+        s2 = self._make_security_group_ovo()
+        mac = str(netaddr.EUI('fa:16:3e:aa:bb:cc'))
+        p1 = self._make_port_ovo(ip='1.1.1.1', security_group_ids={s1.id},
+                                 revision_number=1)
+        p1 = p1.obj_clone()
+        p1.revision_number = 2
+        p1.security_group_ids = {s1.id, s2.id}
+        p1.fixed_ips = [ports.IPAllocation(
+            port_id=p1.id, subnet_id=uuidutils.generate_uuid(),
+            network_id=p1.network_id, ip_address='1.1.1.2')]
+        self.rcache.record_resource_update(self.ctx, 'Port', p1)
+        self.sg_agent.security_groups_member_delta.assert_called_with(
+            {s1.id: ({'IPv4': {('1.1.1.2', mac)}},
+                     {'IPv4': {('1.1.1.1', mac)}}),
+             s2.id: ({'IPv4': {('1.1.1.2', mac)}}, {})})
+
+    def test_sg_member_update_events_address_still_used(self):
+        s1 = self._make_security_group_ovo()
+        p1 = self._make_port_ovo(ip='1.1.1.1', security_group_ids={s1.id})
+        self._make_port_ovo(ip='1.1.1.1', security_group_ids={s1.id})
+        self.sg_agent.security_groups_member_delta.reset_mock()
+        self.rcache.record_resource_delete(self.ctx, 'Port', p1.id)
+        self.assertFalse(self.sg_agent.security_groups_member_delta.called)
 
     def test_get_secgroup_ids_for_address_group(self):
         ag = self._make_address_group_ovo()
@@ -215,3 +250,39 @@ class SecurityGroupServerAPIShimTestCase(base.BaseTestCase):
         self.rcache.record_resource_delete(self.ctx, resources.ADDRESSGROUP,
             ag.id)
         self.sg_agent.address_group_deleted.assert_called_with(ag.id)
+
+
+class SecurityGroupServerAPIShimCompactTestCase(
+        SecurityGroupServerAPIShimTestCase):
+
+    compact = True
+
+    def test_sg_parent_ops_affect_rules(self):
+        # the rules are built again from the compact records, compare them
+        # by value
+        s1 = self._make_security_group_ovo()
+        filters = {'security_group_id': (s1.id, )}
+        self.assertEqual(
+            [rule.to_dict() for rule in s1.rules],
+            [rule.to_dict() for rule in self.rcache.get_resources(
+                'SecurityGroupRule', filters)])
+        self.rcache.record_resource_delete(self.ctx, 'SecurityGroup', s1.id)
+        self.assertEqual(
+            [],
+            self.rcache.get_resources('SecurityGroupRule', filters))
+
+    def test_member_ips_read_from_cached_records(self):
+        s1 = self._make_security_group_ovo()
+        mac = str(netaddr.EUI('fa:16:3e:aa:bb:cc'))
+        self._make_port_ovo(ip='1.1.1.1', security_group_ids={s1.id})
+        p2 = self._make_port_ovo(ip='2.2.2.2', security_group_ids={s1.id})
+        self.rcache._loaded_by_type_and_id['Port'].clear()
+        with mock.patch.object(resource_cache.CompactResource,
+                               'materialize') as materialize:
+            self.assertEqual(
+                {s1.id: {('1.1.1.1', mac), ('2.2.2.2', mac)}},
+                self.shim._select_ips_for_remote_group(self.ctx, [s1.id]))
+            self.assertEqual(
+                {s1.id: ({}, {'IPv4': {('2.2.2.2', mac)}})},
+                self.shim._get_member_deltas(p2, None))
+        self.assertFalse(materialize.called)
@@ -28,6 +28,7 @@ from osprofiler import profiler
 import testscenarios
 import testtools
 
+from neutron.agent.linux import dhcp
 from neutron.common import utils
 from neutron.tests import base
 from neutron.tests.unit import tests
@@ -209,6 +210,55 @@ class TestFipServices(base.BaseTestCase):
         self._test_is_fip_serviced(constants.DEVICE_OWNER_COMPUTE_PREFIX, True)
 
 
+class TestGetDhcpNetworkRevision(base.BaseTestCase):
+
+    def setUp(self):
+        super(TestGetDhcpNetworkRevision, self).setUp()
+        self.network = {
+            'id': 'net', 'revision_number': 1,
+            'subnets': [{'id': 'sub1', 'revision_number': 2,
+                         'enable_dhcp': True},
+                        {'id': 'sub2', 'revision_number': 3,
+                         'enable_dhcp': False}],
+            'non_local_subnets': [],
+            'ports': [{'id': 'port1', 'revision_number': 4},
+                      {'id': 'port2', 'revision_number': 5}]}
+        self.revision = utils.get_dhcp_network_revision(self.network)
+
+    def test_same_network(self):
+        network = dict(self.network, ports=self.network['ports'][::-1])
+        self.assertEqual(self.revision,
+                         utils.get_dhcp_network_revision(network))
+
+    def test_dhcp_disabled_subnet_ignored(self):
+        network = dict(self.network, subnets=self.network['subnets'][:1])
+        self.assertEqual(self.revision,
+                         utils.get_dhcp_network_revision(network))
+
+    def test_port_changed(self):
+        network = dict(self.network, ports=[
+            {'id': 'port1', 'revision_number': 4},
+            {'id': 'port2', 'revision_number': 6}])
+        self.assertNotEqual(self.revision,
+                            utils.get_dhcp_network_revision(network))
+
+    def test_port_removed(self):
+        network = dict(self.network, ports=self.network['ports'][:1])
+        self.assertNotEqual(self.revision,
+                            utils.get_dhcp_network_revision(network))
+
+    def test_subnet_moved_to_non_local_subnets(self):
+        network = dict(self.network, subnets=[],
+                       non_local_subnets=self.network['subnets'][:1])
+        self.assertNotEqual(self.revision,
+                            utils.get_dhcp_network_revision(network))
+
+    def test_network_model(self):
+        network = dhcp.NetModel(self.network)
+        self.assertEqual(self.revision,
+                         utils.get_dhcp_network_revision(network))
+
+
 class TestIpToCidr(base.BaseTestCase):
     def test_ip_to_cidr_ipv4_default(self):
         self.assertEqual('15.1.2.3/32', utils.ip_to_cidr('15.1.2.3'))
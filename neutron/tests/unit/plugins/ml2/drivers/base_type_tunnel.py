@@ -398,6 +398,33 @@ class TunnelRpcCallbackTestMixin(object):
                   'host': HOST_TWO}
         self._test_tunnel_sync(kwargs, False)
 
+    def test_tunnel_sync_called_with_tunnels_version(self):
+        kwargs = {'tunnel_ip': TUNNEL_IP_ONE, 'tunnel_type': self.TYPE,
+                  'host': HOST_ONE}
+        endpoint_one = {'ip_address': TUNNEL_IP_ONE, 'host': HOST_ONE}
+        endpoint_two = {'ip_address': TUNNEL_IP_TWO, 'host': HOST_TWO}
+        driver = self.callbacks._type_manager.drivers[self.TYPE].obj
+        with mock.patch.object(self.notifier, 'tunnel_update'), \
+                mock.patch.object(driver, 'add_endpoint'), \
+                mock.patch.object(driver, 'get_endpoints') as get_endpoints:
+            get_endpoints.return_value = [endpoint_one]
+            details = self.callbacks.tunnel_sync('fake_context', **kwargs)
+            self.assertEqual([endpoint_one], details['tunnels'])
+            kwargs['tunnels_version'] = details['tunnels_version']
+
+            # The endpoints didn't change since the previous sync
+            details = self.callbacks.tunnel_sync('fake_context', **kwargs)
+            self.assertEqual([], details['tunnels'])
+            self.assertEqual(kwargs['tunnels_version'],
+                             details['tunnels_version'])
+
+            # A new endpoint was added
+            get_endpoints.return_value = [endpoint_one, endpoint_two]
+            details = self.callbacks.tunnel_sync('fake_context', **kwargs)
+            self.assertEqual([endpoint_one, endpoint_two], details['tunnels'])
+            self.assertNotEqual(kwargs['tunnels_version'],
+                                details['tunnels_version'])
+
     def test_tunnel_sync_called_without_tunnel_ip(self):
         kwargs = {'tunnel_type': self.TYPE, 'host': None}
         self._test_tunnel_sync_raises(kwargs)
@@ -13,8 +13,12 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import copy
 from unittest import mock
 
+from os_ken.ofproto import ofproto_v1_3
+from os_ken.ofproto import ofproto_v1_3_parser
+
 from neutron.agent.common import ovs_lib
 from neutron.plugins.ml2.drivers.openvswitch.agent.openflow.native \
     import ofswitch
@@ -56,3 +60,163 @@ class OVSAgentBridgeTestCase(ovs_test_base.OVSOSKenTestBase):
         br = self.br_int_cls('br-int')
         with mock.patch.object(br, 'get_datapath_id', return_value=None):
             self.assertRaises(RuntimeError, br._get_dp)
+
+
+class OVSAgentBridgeFlowDiffTestCase(ovs_test_base.OVSOSKenTestBase):
+    def setUp(self):
+        super(OVSAgentBridgeFlowDiffTestCase, self).setUp()
+        self.br = self.br_int_cls('br-int')
+        self.dp = mock.Mock()
+        mock.patch.object(self.br, '_get_dp', return_value=(
+            self.dp, ofproto_v1_3, ofproto_v1_3_parser)).start()
+        self.send_msg = mock.patch.object(self.br, '_send_msg').start()
+        self.dump_flows = mock.patch.object(self.br, 'dump_flows').start()
+        mock.patch.object(self.br, 'db_get_val', return_value={
+            ofswitch.FLOW_DIFF_COOKIE_KEY: '1234'}).start()
+        self.instructions = [ofproto_v1_3_parser.OFPInstructionGotoTable(
+            table_id=60)]
+
+    def _flow(self, in_port, cookie=0x1234, duration_sec=1000,
+              instructions=None):
+        return ofproto_v1_3_parser.OFPFlowStats(
+            table_id=0, duration_sec=duration_sec, duration_nsec=0,
+            priority=2, cookie=cookie,
+            match=ofproto_v1_3_parser.OFPMatch(in_port=in_port),
+            instructions=instructions or self.instructions)
+
+    def _start_flow_diff(self):
+        self.dump_flows.return_value = [self._flow(1), self._flow(2),
+                                        self._flow(3, cookie=0x5678)]
+        self.br.start_flow_diff()
+
+    def test_start_flow_diff_reuses_stored_cookie(self):
+        self._start_flow_diff()
+        self.assertEqual(0x1234, self.br.default_cookie)
+        self.assertEqual(2, len(self.br._flow_diff['flows']))
+
+    def test_install_unchanged_flow_not_sent(self):
+        self._start_flow_diff()
+        self.br.install_instructions(self.instructions, priority=2,
+                                     in_port=1)
+        self.send_msg.assert_not_called()
+        self.br.install_instructions(self.instructions, priority=2,
+                                     in_port=3)
+        self.br.install_instructions([], priority=2, in_port=2)
+        self.assertEqual(2, self.send_msg.call_count)
+
+    def test_install_flow_after_uninstall_sent(self):
+        self._start_flow_diff()
+        self.br.uninstall_flows(in_port=1)
+        self.send_msg.reset_mock()
+        self.br.install_instructions(self.instructions, priority=2,
+                                     in_port=1)
+        self.send_msg.assert_called_once_with(mock.ANY, active_bundle=None)
+
+    def test_cleanup_flows_deletes_stale_flows(self):
+        self._start_flow_diff()
+        # The flow diff started 10 seconds ago
+        self.br._flow_diff['start'] -= 10
+        self.br.install_instructions(self.instructions, priority=2,
+                                     in_port=1)
+        self.br.install_instructions(self.instructions, priority=2,
+                                     in_port=4)
+        self.dump_flows.return_value = [self._flow(1), self._flow(2),
+                                        self._flow(4, duration_sec=0)]
+        with mock.patch.object(self.br, 'bundled') as bundled, \
+                mock.patch.object(self.br, '_dump_and_clean'):
+            self.br.cleanup_flows()
+        bundle = bundled.return_value.__enter__.return_value
+        bundle.uninstall_flows.assert_called_once_with(
+            table_id=0, strict=True, priority=2,
+            match=self.dump_flows.return_value[1].match)
+        self.assertEqual({}, self.br._flow_diff)
+
+    def test_cleanup_flows_finishes_flow_diff_of_clones(self):
+        self._start_flow_diff()
+        clone = copy.copy(self.br)
+        self.assertTrue(clone._flow_diff)
+        self.dump_flows.return_value = []
+        with mock.patch.object(self.br, '_dump_and_clean'):
+            self.br.cleanup_flows()
+        self.assertEqual({}, clone._flow_diff)
+        clone.install_instructions(self.instructions, priority=2,
+                                   in_port=1)
+        self.send_msg.assert_called_once_with(mock.ANY, active_bundle=None)
+
+
+class OVSAgentBridgeFlowTransactionTestCase(ovs_test_base.OVSOSKenTestBase):
+    def setUp(self):
+        super(OVSAgentBridgeFlowTransactionTestCase, self).setUp()
+        self.br = self.br_int_cls('br-int')
+        self.dp = mock.Mock()
+        mock.patch.object(self.br, '_get_dp', return_value=(
+            self.dp, ofproto_v1_3, ofproto_v1_3_parser)).start()
+        self.send_msg = mock.patch.object(
+            self.br, '_send_msg_retry', side_effect=self._fake_send).start()
+
+    @staticmethod
+    def _fake_send(app, msg, reply_cls, reply_multi):
+        if isinstance(msg, ofproto_v1_3_parser.ONFBundleCtrlMsg):
+            # Each ONF_BCT_*_REPLY follows its ONF_BCT_*_REQUEST
+            return mock.Mock(type=msg.type + 1)
+
+    def _sent_msg_types(self):
+        return [
+            ('ctrl', args[1].type)
+            if isinstance(args[1], ofproto_v1_3_parser.ONFBundleCtrlMsg)
+            else type(args[1]).__name__
+            for args, _kwargs in self.send_msg.call_args_list]
+
+    def _install_flows(self, num_flows):
+        for in_port in range(num_flows):
+            self.br.install_drop(in_port=in_port)
+
+    def test_flow_transaction(self):
+        with self.br.flow_transaction():
+            self._install_flows(2)
+            self.br.uninstall_flows(in_port=1)
+        self.assertEqual(
+            [('ctrl', ofproto_v1_3.ONF_BCT_OPEN_REQUEST),
+             'ONFBundleAddMsg', 'ONFBundleAddMsg', 'ONFBundleAddMsg',
+             ('ctrl', ofproto_v1_3.ONF_BCT_COMMIT_REQUEST)],
+            self._sent_msg_types())
+        self.send_msg.reset_mock()
+        self._install_flows(1)
+        self.assertEqual(['OFPFlowMod'], self._sent_msg_types())
+
+    def test_flow_transaction_max_flow_mods(self):
+        mock.patch.object(ofswitch, 'FLOW_TRANSACTION_MAX_FLOW_MODS',
+                          2).start()
+        with self.br.flow_transaction():
+            self._install_flows(3)
+        self.assertEqual(
+            [('ctrl', ofproto_v1_3.ONF_BCT_OPEN_REQUEST),
+             'ONFBundleAddMsg', 'ONFBundleAddMsg',
+             ('ctrl', ofproto_v1_3.ONF_BCT_COMMIT_REQUEST),
+             ('ctrl', ofproto_v1_3.ONF_BCT_OPEN_REQUEST),
+             'ONFBundleAddMsg',
+             ('ctrl', ofproto_v1_3.ONF_BCT_COMMIT_REQUEST)],
+            self._sent_msg_types())
+
+    def test_commit_flow_transaction(self):
+        with self.br.flow_transaction():
+            self._install_flows(1)
+            self.br.commit_flow_transaction()
+            self.br.commit_flow_transaction()
+            self._install_flows(1)
+        self.assertEqual(
+            [('ctrl', ofproto_v1_3.ONF_BCT_OPEN_REQUEST),
+             'ONFBundleAddMsg',
+             ('ctrl', ofproto_v1_3.ONF_BCT_COMMIT_REQUEST),
+             ('ctrl', ofproto_v1_3.ONF_BCT_OPEN_REQUEST),
+             'ONFBundleAddMsg',
+             ('ctrl', ofproto_v1_3.ONF_BCT_COMMIT_REQUEST)],
+            self._sent_msg_types())
+        self.send_msg.reset_mock()
+        self.br.commit_flow_transaction()
+        self.send_msg.assert_not_called()
+
+    def test_flow_transaction_no_flows(self):
+        with self.br.flow_transaction():
+            pass
+        self.send_msg.assert_not_called()
@@ -18,6 +18,7 @@ import sys
 import time
 from unittest import mock
 
+import eventlet
 import netaddr
 from neutron_lib.agent import constants as agent_consts
 from neutron_lib.api.definitions import portbindings
@@ -207,6 +208,14 @@ class TestOvsNeutronAgent(object):
                 pass
             setup_physical_bridges.assert_called_once_with(mock.ANY)
 
+    def test_startup_times_reported(self):
+        startup_times = self.agent.agent_state['configurations'][
+            'startup_times']
+        # Tunneling is disabled
+        self.assertEqual({'integration_bridge', 'physical_bridges',
+                          'bridges', 'ancillary_bridges'},
+                         set(startup_times))
+
     def test_datapath_type_system(self):
         # verify kernel datapath is default
         expected = constants.OVS_DATAPATH_SYSTEM
@@ -911,6 +920,57 @@ class TestOvsNeutronAgent(object):
             self.assertTrue(func.called)
             self.assertIn('id', binding_no_activated_devices)
 
+    def test_treat_devices_added_updated_chunked(self):
+        cfg.CONF.set_override('rpc_devices_details_chunk_size', 2, 'AGENT')
+        devices = ['dev1', 'dev2', 'dev3', 'dev4', 'dev5']
+
+        def fake_get_details(context, devices, agent_id, host,
+                             agent_restarted):
+            return {'devices': [{'device': dev} for dev in devices
+                                if dev != 'dev4'],
+                    'failed_devices': [dev for dev in devices
+                                       if dev == 'dev4']}
+
+        with mock.patch.object(self.agent.plugin_rpc,
+                               'get_devices_details_list_and_failed_devices',
+                               side_effect=fake_get_details) as get_details,\
+                mock.patch.object(self.agent.int_br, 'get_vifs_by_ids',
+                                  return_value={}) as get_vifs,\
+                mock.patch.object(self.agent.ext_manager, 'delete_port'):
+            skip_devs, _, _, failed_devices, _, _ = (
+                self.agent.treat_devices_added_or_updated(devices, False,
+                                                          set()))
+        self.assertEqual(3, get_details.call_count)
+        self.assertEqual(
+            [mock.call(['dev1', 'dev2']), mock.call(['dev3']),
+             mock.call(['dev5'])],
+            get_vifs.call_args_list)
+        self.assertEqual(['dev1', 'dev2', 'dev3', 'dev5'], skip_devs)
+        self.assertEqual({'dev4'}, failed_devices)
+
+    def test_get_devices_details_chunks_closed(self):
+        cfg.CONF.set_override('rpc_devices_details_chunk_size', 2, 'AGENT')
+        with mock.patch.object(eventlet, 'spawn') as spawn:
+            chunks = self.agent._get_devices_details_chunks(
+                ['dev1', 'dev2', 'dev3'], False)
+            self.assertEqual(spawn.return_value.wait.return_value,
+                             next(chunks))
+            # the details of the second chunk are being retrieved
+            self.assertEqual(2, spawn.call_count)
+            chunks.close()
+        spawn.return_value.kill.assert_called_once_with()
+
+    def test_get_devices_details_chunks_exhausted(self):
+        cfg.CONF.set_override('rpc_devices_details_chunk_size', 2, 'AGENT')
+        with mock.patch.object(self.agent.plugin_rpc,
+                               'get_devices_details_list_and_failed_devices',
+                               side_effect=lambda context, devices, *args:
+                               devices):
+            self.assertEqual(
+                [['dev1', 'dev2'], ['dev3']],
+                list(self.agent._get_devices_details_chunks(
+                    ['dev1', 'dev2', 'dev3'], False)))
+
     def test_treat_devices_added_updated_ignores_invalid_ofport(self):
         port = mock.Mock()
         port.ofport = -1
@@ -1201,6 +1261,61 @@ class TestOvsNeutronAgent(object):
     def test_process_network_port_with_empty_port(self):
         self._test_process_network_ports({})
 
+    def test_process_network_ports_flow_transactions(self):
+        cfg.CONF.set_override('flow_transactions', True, 'AGENT')
+        self.agent.enable_tunneling = True
+        self.agent.tun_br = mock.MagicMock()
+        self.agent.phys_brs = {'physnet1': mock.MagicMock()}
+        with mock.patch.object(self.agent, '_process_network_ports') as pnp,\
+                mock.patch.object(self.agent.int_br,
+                                  'flow_transaction') as int_transaction:
+            self.agent.process_network_ports({}, False)
+        pnp.assert_called_once_with({}, False)
+        for transaction in (int_transaction,
+                            self.agent.tun_br.flow_transaction,
+                            self.agent.phys_brs['physnet1'].flow_transaction):
+            transaction.assert_called_once_with()
+            transaction.return_value.__enter__.assert_called_once()
+            transaction.return_value.__exit__.assert_called_once()
+
+    def test_process_network_ports_flow_transaction_committed(self):
+        cfg.CONF.set_override('flow_transactions', True, 'AGENT')
+        self.agent.enable_tunneling = True
+        self.agent.tun_br = mock.MagicMock()
+        self.agent.phys_brs = {'physnet1': mock.MagicMock()}
+        port_info = {'current': {'tap0'}, 'added': {'tap0'},
+                     'removed': {'tap1'}}
+        calls = mock.Mock()
+        self.agent.tun_br.commit_flow_transaction = calls.tun_commit
+        self.agent.phys_brs['physnet1'].commit_flow_transaction = (
+            calls.phys_commit)
+        with mock.patch.object(self.agent, 'treat_devices_added_or_updated',
+                               return_value=(set(), set(), ['tap0'], set(),
+                                             set(), set())), \
+                mock.patch.object(self.agent, '_add_port_tag_info'), \
+                mock.patch.object(self.agent,
+                                  'process_install_ports_egress_flows'), \
+                mock.patch.object(self.agent.int_br, 'flow_transaction'), \
+                mock.patch.object(self.agent.int_br,
+                                  'commit_flow_transaction',
+                                  calls.int_commit), \
+                mock.patch.object(self.agent.sg_agent, 'setup_port_filters',
+                                  calls.setup_port_filters), \
+                mock.patch.object(self.agent, '_bind_devices',
+                                  calls.bind_devices), \
+                mock.patch.object(self.agent, 'treat_devices_removed',
+                                  calls.treat_devices_removed):
+            calls.bind_devices.return_value = set()
+            calls.treat_devices_removed.return_value = set()
+            self.agent.process_network_ports(port_info, False)
+        commits = [mock.call.int_commit(), mock.call.phys_commit(),
+                   mock.call.tun_commit()]
+        self.assertEqual(
+            commits + [mock.call.setup_port_filters({'tap0'}, set())] +
+            commits + [mock.call.bind_devices(['tap0'])] +
+            commits + [mock.call.treat_devices_removed({'tap1'})],
+            calls.mock_calls)
+
     @mock.patch.object(linux_utils, 'execute', return_value=False)
     def test_hybrid_plug_flag_based_on_firewall(self, *args):
         cfg.CONF.set_default(
@@ -1454,6 +1569,37 @@ class TestOvsNeutronAgent(object):
             self.agent.network_update(context=None, network=network)
         self.assertEqual(set(), self.agent.updated_ports)
 
+    def test_network_update_ports_per_iteration(self):
+        self.agent.network_update_ports_per_iteration = 2
+        network = {'id': TEST_NETWORK_ID1}
+        network_ports = {TEST_PORT_ID1, TEST_PORT_ID2, TEST_PORT_ID3}
+        for port_id in network_ports:
+            self.agent._update_port_network(port_id, network['id'])
+        with mock.patch.object(self.agent.plugin_rpc, 'get_network_details'), \
+                mock.patch.object(self.agent,
+                                  '_update_network_segmentation_id'):
+            self.agent.network_update(context=None, network=network)
+        self.agent.port_update("unused_context", port={'id': 'port-bound'})
+        self.assertEqual(set(), self.agent.updated_ports)
+        self.assertTrue(self.agent._agent_has_updates(mock.Mock(
+            is_polling_required=False)))
+
+        # The port update is processed first, then up to 2 network ports
+        updated_ports = self.agent._get_queued_port_updates()
+        self.assertIn('port-bound', updated_ports)
+        self.assertEqual(3, len(updated_ports))
+        self.assertTrue(updated_ports - {'port-bound'} < network_ports)
+        self.assertEqual(network_ports - updated_ports,
+                         self.agent._get_queued_port_updates())
+        self.assertTrue(self.agent.port_update_queue.empty())
+
+    def test_queued_network_update_port_deleted(self):
+        self.agent.network_update_ports_per_iteration = 2
+        self.agent._queue_port_update(TEST_PORT_ID1,
+                                      ovs_agent.PRIORITY_NETWORK_UPDATE)
+        self.agent.port_delete(context=None, port_id=TEST_PORT_ID1)
+        self.assertEqual(set(), self.agent._get_queued_port_updates())
+
     def test_update_port_network(self):
         """Ensure ports are associated and moved across networks correctly."""
         self.agent._update_port_network(TEST_PORT_ID1, TEST_NETWORK_ID1)
@@ -1736,6 +1882,32 @@ class TestOvsNeutronAgent(object):
         self._test_setup_physical_bridges_change_from_veth_to_patch_conf(
             port_exists=True)
 
+    def test_setup_physical_bridges_parallel(self):
+        self.agent.parallel_bridge_setup = True
+        with mock.patch.object(self.agent, 'br_phys_cls') as phys_br_cls,\
+                mock.patch.object(self.agent, '_check_bridge_datapath_id'),\
+                mock.patch.object(self.agent,
+                                  '_setup_physical_bridge') as setup_br,\
+                mock.patch.object(ovs_lib.BaseOVS, 'get_bridges',
+                                  return_value=['br-eth', 'br-eth2']),\
+                mock.patch.object(self.mod_agent.eventlet, 'spawn',
+                                  wraps=eventlet.spawn) as spawn:
+            self.agent.setup_physical_bridges({'physnet1': 'br-eth',
+                                               'physnet2': 'br-eth2'})
+        setup_br.assert_has_calls(
+            [mock.call('physnet1', 'br-eth', phys_br_cls.return_value),
+             mock.call('physnet2', 'br-eth2', phys_br_cls.return_value)],
+            any_order=True)
+        self.assertEqual(2, spawn.call_count)
+
+    def test_run_bridge_setups_parallel_error(self):
+        self.agent.parallel_bridge_setup = True
+        setup_ok = mock.Mock()
+        setup_error = mock.Mock(side_effect=RuntimeError)
+        self.assertRaises(RuntimeError, self.agent._run_bridge_setups,
+                          [(setup_error, ()), (setup_ok, ('br-eth',))])
+        setup_ok.assert_called_once_with('br-eth')
+
     def test_setup_tunnel_br(self):
         self.tun_br = mock.Mock()
         with mock.patch.object(self.agent.int_br,
@@ -2230,6 +2402,87 @@ class TestOvsNeutronAgent(object):
             self.agent.tunnel_delete(context=None, **kwargs)
             self.assertTrue(clean_tun_fn.called)
 
+    def test_tunnel_sync_bulk(self):
+        fake_tunnel_details = {'tunnels': [{'ip_address': '200.200.200.200'},
+                                           {'ip_address': '100.100.100.100'},
+                                           {'ip_address': '300.300.300.300'}],
+                               'tunnels_version': 'version-2'}
+        self.agent.bulk_tunnel_sync = True
+        self.agent.tunnel_types = ['vxlan']
+        self.agent.tun_br_ofports = {'vxlan': {'200.200.200.200': 1}}
+        self.agent.tunnels_version = {'vxlan': 'version-1'}
+        with mock.patch.object(self.agent.plugin_rpc, 'tunnel_sync',
+                               return_value=fake_tunnel_details) as sync,\
+                mock.patch.object(
+                    self.agent.tun_br, 'add_tunnel_ports',
+                    return_value={'vxlan-64646464': 2}) as add_ports,\
+                mock.patch.object(self.agent.tun_br,
+                                  'setup_tunnel_port') as setup_port,\
+                mock.patch.object(
+                    self.agent,
+                    '_setup_tunnel_flood_flow') as _setup_tunnel_flood_flow:
+            self.assertFalse(self.agent.tunnel_sync())
+            sync.assert_called_once_with(
+                self.agent.context, self.agent.local_ip, 'vxlan',
+                self.agent.conf.host, tunnels_version='version-1')
+            add_ports.assert_called_once_with(
+                {'vxlan-64646464': '100.100.100.100'}, self.agent.local_ip,
+                'vxlan', self.agent.vxlan_udp_port, self.agent.dont_fragment,
+                self.agent.tunnel_csum, self.agent.tos)
+            setup_port.assert_called_once_with('vxlan', 2)
+            _setup_tunnel_flood_flow.assert_called_once_with(
+                self.agent.tun_br, 'vxlan')
+        self.assertEqual({'200.200.200.200': 1, '100.100.100.100': 2},
+                         self.agent.tun_br_ofports['vxlan'])
+        self.assertEqual('version-2', self.agent.tunnels_version['vxlan'])
+
+    def test_tunnel_sync_bulk_port_failure(self):
+        fake_tunnel_details = {'tunnels': [{'ip_address': '100.100.100.100'}],
+                               'tunnels_version': 'version-2'}
+        self.agent.bulk_tunnel_sync = True
+        self.agent.tunnel_types = ['vxlan']
+        with mock.patch.object(self.agent.plugin_rpc, 'tunnel_sync',
+                               return_value=fake_tunnel_details),\
+                mock.patch.object(
+                    self.agent.tun_br, 'add_tunnel_ports',
+                    return_value={
+                        'vxlan-64646464': ovs_lib.INVALID_OFPORT}),\
+                mock.patch.object(self.agent, '_setup_tunnel_flood_flow'):
+            self.assertTrue(self.agent.tunnel_sync())
+        self.assertNotIn('100.100.100.100',
+                         self.agent.tun_br_ofports['vxlan'])
+        # The version is not stored so the next sync gets every endpoint
+        self.assertNotIn('vxlan', self.agent.tunnels_version)
+
+    def test_tunnel_update_bulk(self):
+        self.agent._setup_tunnel_port = mock.Mock()
+        self.agent.enable_tunneling = True
+        self.agent.bulk_tunnel_sync = True
+        self.agent.tunnel_types = ['gre']
+        self.agent.l2_pop = False
+        for tunnel_ip in ('10.10.10.10', '10.10.10.11'):
+            self.agent.tunnel_update(context=None, tunnel_ip=tunnel_ip,
+                                     tunnel_type='gre')
+        self.agent._setup_tunnel_port.assert_not_called()
+        self.assertEqual({'10.10.10.10', '10.10.10.11'},
+                         self.agent.pending_tunnels['gre'])
+
+        with mock.patch.object(self.agent, '_setup_tunnel_ports',
+                               return_value={'10.10.10.11'}) as setup_ports:
+            self.agent.process_pending_tunnels()
+            setup_ports.assert_called_once_with(
+                self.agent.tun_br, {'10.10.10.10', '10.10.10.11'}, 'gre')
+        # The failed tunnel port is retried in the next iteration
+        self.assertEqual({'10.10.10.11'}, self.agent.pending_tunnels['gre'])
+
+    def test_tunnel_delete_bulk_pending(self):
+        self.agent.enable_tunneling = True
+        self.agent.tunnel_types = ['gre']
+        self.agent.pending_tunnels['gre'].add('10.10.10.10')
+        self.agent.tunnel_delete(context=None, tunnel_ip='10.10.10.10',
+                                 tunnel_type='gre')
+        self.assertFalse(self.agent.pending_tunnels['gre'])
+
     def test_reset_tunnel_ofports(self):
         tunnel_handles = self.agent.tun_br_ofports
         self.agent.tun_br_ofports = {'gre': {'10.10.10.10': '1'}}
@@ -2392,6 +2645,72 @@ class TestOvsNeutronAgent(object):
             self.assertTrue(update_stale.called)
             cleanup.assert_not_called()
 
+    def _test_requeue_port_info_changes(self, incremental_port_sync,
+                                        port_info, expected_result,
+                                        expected_failed_devices,
+                                        retries_map=None,
+                                        expected_retries_map=None):
+        self.agent.incremental_port_sync = incremental_port_sync
+        failed_devices = {'added': {'tap9'}, 'removed': set()}
+        failed_ancillary_devices = {'added': set(), 'removed': set()}
+        ancillary_port_info = ovs_agent.PortInfo(added={'tap5'})
+        retries_map = {} if retries_map is None else retries_map
+        self.assertEqual(
+            expected_result,
+            self.agent._requeue_port_info_changes(
+                mock.Mock(), port_info, ancillary_port_info,
+                failed_devices, failed_ancillary_devices, retries_map))
+        self.assertEqual(expected_failed_devices, failed_devices)
+        if expected_retries_map is not None:
+            self.assertEqual(expected_retries_map, retries_map)
+
+    def test_requeue_port_info_changes(self):
+        port_info = ovs_agent.PortInfo(current={'tap0', 'tap1'},
+                                       added={'tap1'}, removed={'tap2'})
+        self._test_requeue_port_info_changes(
+            True, port_info, True,
+            {'added': {'tap1', 'tap9'}, 'removed': {'tap2'}},
+            retries_map={'tap9': 1},
+            expected_retries_map={'tap1': 1, 'tap2': 1, 'tap5': 1,
+                                  'tap9': 2})
+
+    def test_requeue_port_info_changes_max_retries(self):
+        port_info = ovs_agent.PortInfo(current={'tap0', 'tap1'},
+                                       added={'tap1'}, removed={'tap2'})
+        retries_map = {'tap1': constants.MAX_DEVICE_RETRIES}
+        self._test_requeue_port_info_changes(
+            True, port_info, False, {'added': {'tap9'}, 'removed': set()},
+            retries_map=retries_map,
+            expected_retries_map=dict(retries_map))
+
+    def test_requeue_port_info_changes_disabled(self):
+        port_info = ovs_agent.PortInfo(current={'tap0', 'tap1'},
+                                       added={'tap1'}, removed={'tap2'})
+        self._test_requeue_port_info_changes(
+            False, port_info, False, {'added': {'tap9'}, 'removed': set()})
+
+    def test_requeue_port_info_changes_no_port_info(self):
+        self._test_requeue_port_info_changes(
+            True, {}, False, {'added': {'tap9'}, 'removed': set()})
+
+    def test_process_port_info_sync_stats(self):
+        polling_manager = mock.Mock()
+        polling_manager.get_events.return_value = {
+            'added': [], 'removed': [], 'modified': []}
+        failed_devices = {'added': set(), 'removed': set()}
+        with mock.patch.object(self.agent, 'scan_ports',
+                               return_value=ovs_agent.PortInfo()), \
+                mock.patch.object(self.agent, 'process_ports_events',
+                                  return_value=(ovs_agent.PortInfo(),
+                                                ovs_agent.PortInfo(),
+                                                set())):
+            for sync in (False, True, False):
+                self.agent.process_port_info(
+                    time.time(), polling_manager, sync, False, set(), set(),
+                    set(), 0, set(), failed_devices, failed_devices)
+        self.assertEqual({'full': 1, 'incremental': 2},
+                         self.agent.port_sync_stats)
+
     def test_set_rpc_timeout(self):
         with mock.patch.object(n_rpc.BackingOffClient,
                                'set_max_timeout') as smt:
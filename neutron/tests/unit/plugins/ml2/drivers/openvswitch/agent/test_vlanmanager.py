@@ -125,3 +125,20 @@ class TestLocalVlanManager(base.BaseTestCase):
         self.assertEqual(1001, self.vlan_manager.get('net_id').segmentation_id)
         self.vlan_manager.update_segmentation_id('net_id', 1002)
         self.assertEqual(1002, self.vlan_manager.get('net_id').segmentation_id)
+
+    def test_get_net_uuid_vif_ports_updated(self):
+        self.vlan_manager.add('net_id', 1, 'vlan', 'phys_net', 1001)
+        lvm = self.vlan_manager.get('net_id')
+        lvm.vif_ports['port-id'] = 'port'
+        self.assertEqual('net_id', self.vlan_manager.get_net_uuid('port-id'))
+        lvm.vif_ports.pop('port-id')
+        self.assertRaises(vlanmanager.VifIdNotFound,
+                          self.vlan_manager.get_net_uuid, 'port-id')
+
+    def test_get_net_uuid_after_pop(self):
+        self.vlan_manager.add('net_id', 1, 'vlan', 'phys_net', 1001,
+                              {'port-id': 'port'})
+        self.vlan_manager.pop('net_id')
+        self.assertRaises(vlanmanager.VifIdNotFound,
+                          self.vlan_manager.get_net_uuid, 'port-id')
+        self.assertFalse(self.vlan_manager._port_index)
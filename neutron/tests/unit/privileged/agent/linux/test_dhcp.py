@@ -0,0 +1,74 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import socket
+from unittest import mock
+
+from neutron.privileged.agent.linux import dhcp as priv_dhcp
+from neutron.tests import base
+
+
+class BuildDhcpReleasePacketTestCase(base.BaseTestCase):
+
+    def _build_packet(self, client_id):
+        packet = priv_dhcp._build_dhcp_release_packet(
+            '192.168.1.2', 'fa:16:3e:aa:bb:cc', client_id, '192.168.1.1')
+        self.assertEqual(priv_dhcp.DHCP_PACKET_SIZE, len(packet))
+        # op, htype, hlen, hops and the zeroed xid, secs and flags
+        self.assertEqual(b'\x01\x01\x06\x00' + b'\x00' * 8, packet[:12])
+        self.assertEqual(socket.inet_aton('192.168.1.2'), packet[12:16])
+        self.assertEqual(b'\x00' * 12, packet[16:28])
+        self.assertEqual(b'\xfa\x16\x3e\xaa\xbb\xcc' + b'\x00' * 10,
+                         packet[28:44])
+        self.assertEqual(b'\x63\x82\x53\x63', packet[236:240])
+        self.assertEqual(b'\x35\x01\x07\x36\x04' +
+                         socket.inet_aton('192.168.1.1'), packet[240:249])
+        return packet[249:].rstrip(b'\x00')
+
+    def test_build_dhcp_release_packet(self):
+        self.assertEqual(b'\xff', self._build_packet(None))
+
+    def test_build_dhcp_release_packet_no_client_id(self):
+        self.assertEqual(b'\xff', self._build_packet('*'))
+
+    def test_build_dhcp_release_packet_hex_client_id(self):
+        self.assertEqual(b'\x3d\x03\x01\xfa\x16\xff',
+                         self._build_packet('01:fa:16'))
+
+    def test_build_dhcp_release_packet_string_client_id(self):
+        self.assertEqual(b'\x3d\x04host\xff', self._build_packet('host'))
+
+
+class CreateSocketTestCase(base.BaseTestCase):
+
+    @mock.patch.object(priv_dhcp.os, 'close')
+    @mock.patch.object(priv_dhcp.os, 'open', return_value=10)
+    @mock.patch.object(priv_dhcp.socket, 'socket')
+    @mock.patch.object(priv_dhcp.netns, 'setns')
+    def test_create_socket_namespace(self, mock_setns, mock_socket,
+                                     mock_open, mock_close):
+        self.assertEqual(mock_socket.return_value,
+                         priv_dhcp._create_socket('qdhcp-net'))
+        mock_setns.assert_has_calls([mock.call('qdhcp-net', flags=0),
+                                     mock.call(10, flags=0)])
+        mock_close.assert_called_once_with(10)
+
+    @mock.patch.object(priv_dhcp.os, 'close')
+    @mock.patch.object(priv_dhcp.os, 'open', return_value=10)
+    @mock.patch.object(priv_dhcp.socket, 'socket')
+    @mock.patch.object(priv_dhcp.netns, 'setns',
+                       side_effect=OSError('No such file or directory'))
+    def test_create_socket_namespace_not_found(self, mock_setns, mock_socket,
+                                               mock_open, mock_close):
+        self.assertRaises(OSError, priv_dhcp._create_socket, 'qdhcp-net')
+        mock_socket.assert_not_called()
+        mock_close.assert_called_once_with(10)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Time of an IptablesManager apply adding one port to a synthetic ruleset.
+
+The ruleset holds the chains and rules of a firewall with PORTS ports.
+By default the commands are not run, iptables-save returns the synthetic
+ruleset and the time reported is the time spent computing the commands sent
+to iptables-restore, for each iptables_backend.
+
+With --execute, the ruleset is loaded in a network namespace created for
+each iptables_backend and the time reported is the time of the real apply:
+iptables-save, computing the commands and iptables-restore. This must be run
+as root on a host providing the iptables and iptables-nft commands.
+
+Usage: benchmark_iptables_apply.py [--execute] [PORTS]
+"""
+
+import sys
+import time
+from unittest import mock
+
+from oslo_concurrency import processutils
+from oslo_config import cfg
+
+from neutron.agent.linux import iptables_manager
+from neutron.agent.linux import utils as linux_utils
+
+RULES_PER_PORT = 8
+
+
+def add_port(manager, index):
+    table = manager.ipv4['filter']
+    for direction in ('i', 'o'):
+        chain = '%s%08x' % (direction, index)
+        table.add_chain(chain)
+        table.add_rule('sg-chain', '-m physdev --physdev-in tap%08x '
+                       '--physdev-is-bridged -j $%s' % (index, chain))
+        table.add_rule(chain, '-m state --state RELATED,ESTABLISHED '
+                       '-j RETURN')
+        for rule in range(RULES_PER_PORT):
+            table.add_rule(chain, '-s 10.%d.%d.%d/32 -p tcp --dport %d '
+                           '-j RETURN' % (index >> 16 & 0xff,
+                                          index >> 8 & 0xff, index & 0xff,
+                                          rule + 1))
+        table.add_rule(chain, '-j $sg-fallback')
+
+
+def get_save_output(manager):
+    lines = []
+    for name, table in sorted(manager.ipv4.items()):
+        lines.append('*%s' % name)
+        for line in manager._modify_rules([], table, name):
+            lines.append(line + ' - [0:0]' if line.startswith(':') else line)
+        lines.append('COMMIT')
+    return '\n'.join(lines)
+
+
+def execute(args, process_input=None, **kwargs):
+    return processutils.execute(*args, process_input=process_input)[0]
+
+
+def get_manager(num_ports, namespace=None):
+    manager = iptables_manager.IptablesManager(external_lock=False,
+                                               namespace=namespace)
+    table = manager.ipv4['filter']
+    table.add_chain('sg-chain')
+    table.add_chain('sg-fallback')
+    table.add_rule('sg-fallback', '-j DROP')
+    for index in range(num_ports):
+        add_port(manager, index)
+    return manager
+
+
+def report(backend, num_ports, num_rules, elapsed, commands):
+    print("%-8s %8d ports %10d rules %8.2f s apply %8d commands" % (
+        backend, num_ports, num_rules, elapsed, len(commands)))
+
+
+def measure(num_ports, backend):
+    cfg.CONF.set_override('iptables_backend', backend, 'AGENT')
+    manager = get_manager(num_ports)
+    save_output = get_save_output(manager)
+    add_port(manager, num_ports)
+
+    def execute(args, **kwargs):
+        return save_output if args[0].endswith('-save') else ''
+
+    with mock.patch.object(linux_utils, 'execute', side_effect=execute):
+        start = time.time()
+        commands = manager.apply()
+        elapsed = time.time() - start
+    report(backend, num_ports, save_output.count('\n-A '), elapsed,
+           commands)
+
+
+def measure_execute(num_ports, backend):
+    cfg.CONF.set_override('iptables_backend', backend, 'AGENT')
+    namespace = 'benchmark-iptables-%s' % backend
+    processutils.execute('ip', 'netns', 'add', namespace)
+    try:
+        manager = get_manager(num_ports, namespace=namespace)
+        num_rules = get_save_output(manager).count('\n-A ')
+        with mock.patch.object(linux_utils, 'execute', side_effect=execute):
+            manager.apply()
+            add_port(manager, num_ports)
+            start = time.time()
+            commands = manager.apply()
+            elapsed = time.time() - start
+        report(backend, num_ports, num_rules, elapsed, commands)
+    finally:
+        processutils.execute('ip', 'netns', 'delete', namespace)
+
+
+def main():
+    args = sys.argv[1:]
+    measure_func = measure
+    if args and args[0] == '--execute':
+        measure_func = measure_execute
+        args = args[1:]
+    num_ports = int(args[0]) if args else 10000
+    for backend in ('iptables', 'nft'):
+        measure_func(num_ports, backend)
+
+
+if __name__ == '__main__':
+    main()
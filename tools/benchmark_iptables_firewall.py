@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Firewall refresh of the iptables firewall driver adding one port to PORTS.
+
+The commands are not run, the rules last applied are used as the rules of
+the kernel. The time reported is the time spent by the driver and the
+iptables manager to compute the commands sent to iptables-restore, for each
+iptables_backend, with and without the dispatch chains.
+
+Usage: benchmark_iptables_firewall.py [PORTS]
+"""
+
+import sys
+import time
+from unittest import mock
+
+from oslo_config import cfg
+from oslo_utils import uuidutils
+
+from neutron.agent.linux import iptables_firewall
+from neutron.agent.linux import utils as linux_utils
+from neutron.conf.agent import common as agent_config
+from neutron.conf.agent import securitygroups_rpc as sc_cfg
+
+SG_ID = uuidutils.generate_uuid()
+SG_RULES = [{'direction': 'ingress', 'ethertype': 'IPv4',
+             'protocol': 'tcp', 'port_range_min': 22,
+             'port_range_max': 22},
+            {'direction': 'ingress', 'ethertype': 'IPv4',
+             'remote_group_id': SG_ID},
+            {'direction': 'egress', 'ethertype': 'IPv4'},
+            {'direction': 'egress', 'ethertype': 'IPv6'}]
+
+
+def make_port(index):
+    return {'device': 'tap%08x-00' % index,
+            'mac_address': 'fa:16:3e:%02x:%02x:%02x' % (
+                index >> 16 & 0xff, index >> 8 & 0xff, index & 0xff),
+            'network_id': 'net',
+            'device_owner': 'compute:nova',
+            'fixed_ips': ['10.%d.%d.%d' % (index >> 16 & 0xff,
+                                           index >> 8 & 0xff, index & 0xff)],
+            'security_groups': [SG_ID],
+            'security_group_source_groups': [SG_ID]}
+
+
+def measure(num_ports, backend, dispatch_chains):
+    cfg.CONF.set_override('iptables_backend', backend, 'AGENT')
+    cfg.CONF.set_override('iptables_resync_interval', 3600, 'AGENT')
+    cfg.CONF.set_override('iptables_dispatch_chains', dispatch_chains,
+                          'SECURITYGROUP')
+    commands = []
+
+    def execute(args, **kwargs):
+        if args[0].endswith('-restore'):
+            commands.append(kwargs['process_input'].count('\n'))
+        return ''
+
+    with mock.patch.object(linux_utils, 'execute', side_effect=execute):
+        firewall = iptables_firewall.IptablesFirewallDriver()
+        firewall.iptables.external_lock = False
+        firewall.update_security_group_rules(SG_ID, SG_RULES)
+        ports = [make_port(index) for index in range(num_ports + 1)]
+        firewall.update_security_group_members(
+            SG_ID, {'IPv4': [(port['fixed_ips'][0], port['mac_address'])
+                             for port in ports]})
+        with firewall.defer_apply():
+            for port in ports[:-1]:
+                firewall.prepare_port_filter(port)
+        del commands[:]
+        start = time.time()
+        with firewall.defer_apply():
+            firewall.prepare_port_filter(ports[-1])
+        elapsed = time.time() - start
+    print("%-8s %3d dispatch chains %8d ports %8.2f s refresh %8d "
+          "commands" % (backend, dispatch_chains, num_ports, elapsed,
+                        sum(commands)))
+
+
+def main():
+    agent_config.register_root_helper(cfg.CONF)
+    sc_cfg.register_securitygroups_opts()
+    cfg.CONF.set_override('lock_path', '/tmp', 'oslo_concurrency')
+    num_ports = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    for backend in ('iptables', 'nft'):
+        for dispatch_chains in (0, 16):
+            measure(num_ports, backend, dispatch_chains)
+
+
+if __name__ == '__main__':
+    main()
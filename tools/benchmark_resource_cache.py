@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Memory usage of the agent resource cache filled with synthetic ports.
+
+Each cache layout is measured in a new process, reporting the growth of the
+resident set size of the process while filling the cache.
+
+Usage: benchmark_resource_cache.py [PORTS]
+"""
+
+import gc
+import os
+import resource
+import subprocess
+import sys
+import time
+from unittest import mock
+
+import netaddr
+from neutron_lib import context
+from oslo_utils import uuidutils
+
+from neutron.agent import resource_cache
+from neutron.api.rpc.handlers import resources_rpc
+from neutron import objects
+from neutron.objects.port.extensions import port_security
+from neutron.objects import ports
+
+
+def get_rss():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def make_port(index, network_id, subnet_id, sg_id):
+    port_id = uuidutils.generate_uuid()
+    return ports.Port(
+        id=port_id, project_id=uuidutils.generate_uuid(dashed=False),
+        name='', network_id=network_id,
+        mac_address=netaddr.EUI('fa:16:3e:%02x:%02x:%02x' % (
+            index >> 16 & 0xff, index >> 8 & 0xff, index & 0xff)),
+        admin_state_up=True, device_id=uuidutils.generate_uuid(),
+        device_owner='compute:nova', status='ACTIVE',
+        fixed_ips=[ports.IPAllocation(
+            port_id=port_id, subnet_id=subnet_id, network_id=network_id,
+            ip_address=netaddr.IPAddress(0x0a000000 + index))],
+        security_group_ids={sg_id}, allowed_address_pairs=[],
+        bindings=[ports.PortBinding(
+            port_id=port_id, host='compute-%d' % (index % 100),
+            vif_type='ovs', vnic_type='normal', profile={},
+            vif_details={'port_filter': True, 'ovs_hybrid_plug': False})],
+        binding_levels=[], dhcp_options=[], distributed_bindings=[],
+        qos_policy_id=None, qos_network_policy_id=None,
+        security=port_security.PortSecurity(
+            id=port_id, port_security_enabled=True),
+        revision_number=1)
+
+
+def measure(num_ports, compact):
+    objects.register_objects()
+    ctx = context.get_admin_context()
+    # the server is never queried, all the ports are pushed to the cache
+    with mock.patch.object(resources_rpc, 'ResourcesPullRpcApi'):
+        rcache = resource_cache.RemoteResourceCache(['Port'], compact=compact)
+    rcache._puller.bulk_pull.return_value = []
+    network_id = uuidutils.generate_uuid()
+    subnet_id = uuidutils.generate_uuid()
+    sg_id = uuidutils.generate_uuid()
+    gc.collect()
+    rss_before = get_rss()
+    start = time.time()
+    # the ports bound to compute-0, read again and again by its agent
+    local_port_ids = []
+    for index in range(num_ports):
+        # the ports are received from the server, they don't share strings
+        port = make_port(index, network_id, subnet_id, sg_id)
+        rcache.record_resource_update(ctx, 'Port', port)
+        if index % 100 == 0:
+            local_port_ids.append(port.id)
+    elapsed = time.time() - start
+    gc.collect()
+    rss = get_rss() - rss_before
+    start = time.time()
+    matched = rcache.get_resources('Port', {'security_group_ids': (sg_id,)})
+    lookup = time.time() - start
+    local_lookups = []
+    for _round in range(2):
+        start = time.time()
+        for port_id in local_port_ids:
+            rcache.get_resource_by_id('Port', port_id)
+        local_lookups.append(time.time() - start)
+    print("%-8s %8d ports %10.1f MiB RSS %8.1f s fill %8.2f s lookup "
+          "of %d ports, %.3f s then %.3f s lookup of %d local ports" % (
+              'compact' if compact else 'default', num_ports,
+              rss / 2.0 ** 20, elapsed, lookup, len(matched),
+              local_lookups[0], local_lookups[1], len(local_port_ids)))
+
+
+def main():
+    if len(sys.argv) > 2:
+        measure(int(sys.argv[1]), sys.argv[2] == 'compact')
+        return
+    num_ports = sys.argv[1] if len(sys.argv) > 1 else '100000'
+    for layout in ('default', 'compact'):
+        subprocess.check_call(
+            [sys.executable, os.path.abspath(__file__), num_ports, layout])
+
+
+if __name__ == '__main__':
+    main()
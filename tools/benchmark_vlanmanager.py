@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Microbenchmark of the OVS agent local VLAN manager lookups.
+
+Usage: benchmark_vlanmanager.py [NETWORKS [PORTS_PER_NETWORK]]
+"""
+
+import collections
+import sys
+import timeit
+
+from neutron.plugins.ml2.drivers.openvswitch.agent import vlanmanager
+
+VifPort = collections.namedtuple('VifPort', 'vif_id ofport')
+
+
+def populate(networks, ports_per_network):
+    manager = vlanmanager.LocalVlanManager()
+    ofport = 1
+    for net in range(networks):
+        vif_ports = {}
+        for _port in range(ports_per_network):
+            vif_id = 'port-%d' % ofport
+            vif_ports[vif_id] = VifPort(vif_id, ofport)
+            ofport += 1
+        manager.add('net-%d' % net, net + 1, 'vxlan', None, net + 1000,
+                    vif_ports)
+    return manager, ofport - 1
+
+
+def linear_get_net_uuid(manager, vif_id):
+    # The lookup done before the VLAN manager indexes were added
+    for network_id, vlan_mapping in manager.items():
+        if vif_id in vlan_mapping.vif_ports:
+            return network_id
+
+
+def main():
+    networks = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    ports_per_network = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    manager, last_ofport = populate(networks, ports_per_network)
+    last_vif_id = 'port-%d' % last_ofport
+    number = 1000
+    benchmarks = [
+        ('linear get_net_uuid',
+         lambda: linear_get_net_uuid(manager, last_vif_id)),
+        ('get_net_uuid', lambda: manager.get_net_uuid(last_vif_id)),
+    ]
+    print("%d networks, %d ports per network, %d lookups" %
+          (networks, ports_per_network, number))
+    for name, func in benchmarks:
+        elapsed = timeit.timeit(func, number=number)
+        print("%-24s %10.3f us/lookup" % (name, elapsed * 1e6 / number))
+
+
+if __name__ == '__main__':
+    main()